@@ -0,0 +1,99 @@
+import math
+import re
+
+# --- CONFIGURATION ---
+CHARS_PER_TOKEN = 3.5            # Estimation grossière pour du texte juridique français
+PROMPT_OVERHEAD_TOKENS = 400     # Consignes fixes de generate_qa_pairs
+TARGET_PROMPT_TOKENS = 3000      # Taille visée pour le texte juridique d'un appel
+MAX_OUTPUT_TOKENS = 8192         # Limite de sortie de gemini-2.0-flash
+TOKENS_PER_ANSWER = 300          # ~215 tokens par paire en moyenne dans all_qa.jsonl, plus une marge
+SOURCE_TOKENS_PER_PAIR = 50      # Une paire demandée pour ~50 tokens d'article
+MIN_PAIRS_PER_CHUNK = 2
+MAX_PAIRS_PER_CHUNK = 6
+
+# Ancien découpage fixe, conservé pour mesurer le gain
+FIXED_CHUNKS_PER_CALL = 3
+FIXED_PAIRS_PER_CHUNK = 3
+
+PARAGRAPH_SPLIT_RE = re.compile(r"\n\s*\n|\n(?=\s*(?:\d+[.)-]|[-•]))")
+
+
+# --- Token estimation ---
+def estimate_tokens(text):
+    return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def pairs_for_chunk(tokens):
+    pairs = round(tokens / SOURCE_TOKENS_PER_PAIR)
+    return min(MAX_PAIRS_PER_CHUNK, max(MIN_PAIRS_PER_CHUNK, pairs))
+
+
+def max_pairs_per_call():
+    return max(1, int(MAX_OUTPUT_TOKENS * 0.9) // TOKENS_PER_ANSWER)
+
+
+# --- Oversized articles ---
+def split_long_chunk(chunk, target_tokens=TARGET_PROMPT_TOKENS):
+    """Split an article larger than the target on paragraph boundaries."""
+    if estimate_tokens(chunk) <= target_tokens:
+        return [chunk]
+    pieces, current = [], ""
+    for paragraph in PARAGRAPH_SPLIT_RE.split(chunk):
+        candidate = f"{current}\n\n{paragraph}" if current else paragraph
+        if current and estimate_tokens(candidate) > target_tokens:
+            pieces.append(current)
+            current = paragraph
+        else:
+            current = candidate
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+# --- Packing ---
+def pack_chunks(chunks, target_tokens=TARGET_PROMPT_TOKENS):
+    """
+    Group consecutive article chunks into LLM calls.
+
+    A call is closed when adding the next chunk would exceed the prompt
+    target or when the requested pairs would no longer fit in the output
+    limit. Yields (first_index, last_index, texts, num_pairs), indices
+    referring to the original chunk list (1-based, inclusive).
+    """
+    pair_cap = max_pairs_per_call()
+    texts, num_pairs, tokens, first = [], 0, 0, None
+
+    for index, chunk in enumerate(chunks, start=1):
+        for piece in split_long_chunk(chunk, target_tokens):
+            piece_tokens = estimate_tokens(piece)
+            piece_pairs = pairs_for_chunk(piece_tokens)
+            if texts and (tokens + piece_tokens > target_tokens or num_pairs + piece_pairs > pair_cap):
+                yield first, last, texts, num_pairs
+                texts, num_pairs, tokens, first = [], 0, 0, None
+            if first is None:
+                first = index
+            last = index
+            texts.append(piece)
+            tokens += piece_tokens
+            num_pairs += min(piece_pairs, pair_cap)
+
+    if texts:
+        yield first, last, texts, num_pairs
+
+
+# --- Measurement ---
+def compare_call_counts(chunks):
+    fixed_calls = math.ceil(len(chunks) / FIXED_CHUNKS_PER_CALL)
+    fixed_pairs = FIXED_PAIRS_PER_CHUNK * len(chunks)
+    packed = list(pack_chunks(chunks))
+    packed_prompt_tokens = [
+        PROMPT_OVERHEAD_TOKENS + sum(estimate_tokens(text) for text in texts) for _, _, texts, _ in packed
+    ]
+    return {
+        "chunks": len(chunks),
+        "fixed_calls": fixed_calls,
+        "packed_calls": len(packed),
+        "fixed_pairs": fixed_pairs,
+        "packed_pairs": sum(num_pairs for *_, num_pairs in packed),
+        "max_prompt_tokens": max(packed_prompt_tokens, default=0),
+    }
@@ -1,12 +1,100 @@
+import argparse
 import json
+import os
+import re
 
-input_file = "C:\\Users\\jozef\\OneDrive\\Desktop\\JudiciAIre\\JudiciAIre Model\\all_qa.jsonl"
-output_file = "C:\\Users\\jozef\\OneDrive\\Desktop\\JudiciAIre\\JudiciAIre Model\\fichier_sans_source.jsonl"
+import pandas as pd
 
-with open(input_file, "r", encoding="utf-8") as infile, open(output_file, "w", encoding="utf-8") as outfile:
-    for line in infile:
-        data = json.loads(line)
-        # Supprimer le texte à partir de "\n\nSource: CODE DE LA FAMILLE" dans le champ "output"
-        if "output" in data:
-            data["output"] = data["output"].replace("\n\nSource: CODE DE LA FAMILLE", "")
-        outfile.write(json.dumps(data, ensure_ascii=False) + "\n")
+from qa_parser import normalize_source, strip_source
+
+# --- CONFIGURATION ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+INPUT_FILE = os.path.join(BASE_DIR, "all_qa.jsonl")
+OUTPUT_FILE = os.path.join(BASE_DIR, "fichier_sans_source.jsonl")
+TEXT_COLUMNS = ["input", "output"]
+SOURCE_COLUMN = "output"
+SOURCE_MODE = "strip"      # "strip" supprime la source, "normalize" la réécrit en "\n\nSource: ...", "keep" n'y touche pas
+BATCH_ROWS = 50_000        # Lignes lues par lot (le corpus actuel tient dans un seul lot)
+
+# --- Precompiled patterns ---
+# Source trailers are handled by qa_parser (also duplicated ones: Gemini's own
+# "Source : X" line followed by the one added by parse_qa_pairs).
+INVISIBLE_CHARS_RE = re.compile("[\u0640\u200b\ufeff]")   # tatweel, zero-width space, BOM
+HORIZONTAL_SPACE_RE = re.compile("[ \t\u00a0]+")
+LINE_EDGE_SPACE_RE = re.compile(r" *\n *")
+BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+# --- Vectorized cleaning ---
+def normalize_text(series):
+    series = series.fillna("").astype(str)
+    series = series.str.replace("\r\n", "\n", regex=False)
+    series = series.str.normalize("NFC")
+    series = series.str.replace(INVISIBLE_CHARS_RE, "", regex=True)
+    series = series.str.replace(HORIZONTAL_SPACE_RE, " ", regex=True)
+    series = series.str.replace(LINE_EDGE_SPACE_RE, "\n", regex=True)
+    series = series.str.replace(BLANK_LINES_RE, "\n\n", regex=True)
+    return series.str.strip()
+
+
+def clean_sources(series, mode=SOURCE_MODE):
+    if mode == "keep":
+        return series
+    if mode == "strip":
+        return series.map(strip_source).str.strip()
+    if mode == "normalize":
+        return series.map(normalize_source)
+    raise ValueError(f"Unknown source mode: {mode}")
+
+
+def clean_frame(df, source_mode=SOURCE_MODE):
+    for column in TEXT_COLUMNS:
+        if column in df.columns:
+            df[column] = normalize_text(df[column])
+    if SOURCE_COLUMN in df.columns:
+        df[SOURCE_COLUMN] = clean_sources(df[SOURCE_COLUMN], source_mode)
+
+    present = [column for column in TEXT_COLUMNS if column in df.columns]
+    if present:
+        df = df[(df[present] != "").all(axis=1)]
+    return df
+
+
+# --- Batch I/O ---
+def iter_batches(input_file, batch_rows=BATCH_ROWS):
+    with pd.read_json(input_file, lines=True, chunksize=batch_rows, dtype=False, encoding="utf-8") as reader:
+        for batch in reader:
+            yield batch
+
+
+def write_batch(outfile, df):
+    outfile.writelines(
+        json.dumps(record, ensure_ascii=False) + "\n" for record in df.to_dict("records")
+    )
+
+
+def clean_file(input_file, output_file, source_mode=SOURCE_MODE, batch_rows=BATCH_ROWS):
+    rows_in = rows_out = 0
+    with open(output_file, "w", encoding="utf-8") as outfile:
+        for batch in iter_batches(input_file, batch_rows):
+            rows_in += len(batch)
+            cleaned = clean_frame(batch, source_mode)
+            rows_out += len(cleaned)
+            write_batch(outfile, cleaned)
+    return rows_in, rows_out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nettoyage du corpus Q&A (sources, espaces, Unicode).")
+    parser.add_argument("--input", default=INPUT_FILE)
+    parser.add_argument("--output", default=OUTPUT_FILE)
+    parser.add_argument("--source-mode", choices=["strip", "normalize", "keep"], default=SOURCE_MODE)
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS)
+    args = parser.parse_args()
+
+    rows_in, rows_out = clean_file(args.input, args.output, args.source_mode, args.batch_rows)
+    print(f"✅ {rows_out}/{rows_in} lignes écrites dans '{args.output}' ({rows_in - rows_out} vides supprimées)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+
+# generator.py configures logging and Gemini at import time, so it is only
+# imported inside the coordinator, worker and merge entry points (each worker
+# then logs to its own file, see GENERATOR_LOG_FILE). Only the coordinator
+# starts a fresh log: restarted workers and merge append (GENERATOR_LOG_MODE),
+# and status does not import generator at all.
+
+# --- CONFIGURATION ---
+QUEUE_DB = "work_queue.sqlite3"   # File d'attente durable partagée par le coordinateur et les workers
+SHARD_DIR = "outputs_shards"      # Un fichier JSONL par worker, fusionnés à la fin
+NUM_WORKERS = 2
+LEASE_SECONDS = 600               # Une tâche non confirmée dans ce délai est reprise par un autre worker
+HEARTBEAT_SECONDS = 30
+POLL_SECONDS = 5
+MAX_ATTEMPTS = 5
+COORDINATOR_LOG_FILE = "processing.coordinator.log"
+
+logger = logging.getLogger("distributed")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    file TEXT NOT NULL,
+    source TEXT NOT NULL,
+    first_chunk INTEGER NOT NULL,
+    last_chunk INTEGER NOT NULL,
+    num_pairs INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result_count INTEGER,
+    UNIQUE (file, first_chunk, last_chunk)
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_until);
+CREATE TABLE IF NOT EXISTS workers (
+    name TEXT PRIMARY KEY,
+    pid INTEGER,
+    keys INTEGER,
+    heartbeat REAL
+);
+"""
+
+
+# --- Durable work queue (SQLite) ---
+class WorkQueue:
+    def __init__(self, path=QUEUE_DB):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def enqueue(self, file, source, first, last, num_pairs, text):
+        # INSERT OR IGNORE keeps re-runs of the coordinator idempotent.
+        self.conn.execute(
+            "INSERT OR IGNORE INTO tasks (file, source, first_chunk, last_chunk, num_pairs, text) VALUES (?, ?, ?, ?, ?, ?)",
+            (file, source, first, last, num_pairs, text),
+        )
+
+    def lease(self, worker):
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute(
+                "UPDATE tasks SET status = 'failed' WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, MAX_ATTEMPTS),
+            )
+            row = self.conn.execute(
+                "SELECT * FROM tasks WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?) "
+                "ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    "UPDATE tasks SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                    (worker, now + LEASE_SECONDS, row["id"]),
+                )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return row
+
+    def heartbeat(self, worker, task_id=None):
+        now = time.time()
+        self.conn.execute("UPDATE workers SET heartbeat = ? WHERE name = ?", (now, worker))
+        if task_id is not None:
+            self.conn.execute(
+                "UPDATE tasks SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+                (now + LEASE_SECONDS, task_id, worker),
+            )
+
+    def register(self, worker, keys):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO workers (name, pid, keys, heartbeat) VALUES (?, ?, ?, ?)",
+            (worker, os.getpid(), keys, time.time()),
+        )
+
+    def complete(self, task_id, worker, result_count):
+        cursor = self.conn.execute(
+            "UPDATE tasks SET status = 'done', result_count = ?, lease_until = NULL "
+            "WHERE id = ? AND worker = ? AND status = 'leased'",
+            (result_count, task_id, worker),
+        )
+        return cursor.rowcount == 1
+
+    def release(self, task_id, worker):
+        self.conn.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "worker = NULL, lease_until = NULL WHERE id = ? AND worker = ?",
+            (MAX_ATTEMPTS, task_id, worker),
+        )
+
+    def counts(self):
+        rows = self.conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+        return Counter({status: count for status, count in rows})
+
+    def has_open_tasks(self):
+        counts = self.counts()
+        return counts["pending"] + counts["leased"] > 0
+
+    def completed_tasks(self):
+        return self.conn.execute("SELECT id, file, worker FROM tasks WHERE status = 'done'").fetchall()
+
+    def workers(self):
+        return self.conn.execute("SELECT * FROM workers ORDER BY name").fetchall()
+
+
+class Heartbeat(threading.Thread):
+    """Keeps the current task's lease alive while a slow Gemini call (or retry sleep) runs."""
+
+    def __init__(self, db_path, worker):
+        super().__init__(daemon=True)
+        self.db_path = db_path
+        self.worker = worker
+        self.task_id = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        queue = WorkQueue(self.db_path)
+        while not self.stopped.wait(HEARTBEAT_SECONDS):
+            queue.heartbeat(self.worker, self.task_id)
+
+
+# --- Worker ---
+def keys_for_worker(api_keys, index, num_workers):
+    return api_keys[index::num_workers]
+
+
+def run_worker(index, num_workers, db_path=QUEUE_DB):
+    # The pid makes a restarted worker a distinct lease owner, so results its
+    # crashed predecessor appended for an unfinished task are dropped at merge.
+    worker = f"worker-{index}.{os.getpid()}"
+    os.environ["GENERATOR_LOG_FILE"] = f"processing.worker-{index}.log"
+    os.environ["GENERATOR_LOG_MODE"] = "a"
+    import generator
+
+    keys = keys_for_worker(generator.API_KEYS, index, num_workers)
+    if not keys:
+        logger.error(f"[Error] {worker}: no API key left for this worker ({len(generator.API_KEYS)} keys, {num_workers} workers).")
+        return
+    generator.API_KEYS = keys
+    generator.current_key_index = 0
+    generator.configure_gemini()
+    generator.model = generator.genai.GenerativeModel(generator.MODEL_NAME)
+
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    shard_file = os.path.join(SHARD_DIR, f"{worker}.jsonl")
+    queue = WorkQueue(db_path)
+    queue.register(worker, len(keys))
+    heartbeat = Heartbeat(db_path, worker)
+    heartbeat.start()
+
+    calls = 0
+    logger.info(f"👷 {worker} started with {len(keys)} API key(s)")
+    while True:
+        task = queue.lease(worker)
+        if task is None:
+            if not queue.has_open_tasks():
+                break
+            time.sleep(POLL_SECONDS)
+            continue
+
+        heartbeat.task_id = task["id"]
+        logger.info(f"📄 {worker}: {task['file']} chunks {task['first_chunk']} to {task['last_chunk']} (attempt {task['attempts'] + 1})")
+        try:
+            # Not safe_generate_qa_pairs: it turns API/quota/network failures into
+            # an empty result, which would complete the task with 0 pairs for good
+            stats = Counter()
+            qa_pairs = generator.generate_with_key_rotation(task["text"], task["num_pairs"], task["source"], stats)
+            generator.log_batch_yield(stats, task["num_pairs"])
+        except Exception as e:
+            logger.error(f"[Error] {worker}: task {task['id']} failed, released for retry: {e}")
+            queue.release(task["id"], worker)
+            heartbeat.task_id = None
+            continue
+
+        generator.append_to_jsonl(shard_file, [
+            {**pair, "task_id": task["id"], "worker": worker, "file": task["file"]} for pair in qa_pairs
+        ])
+        if not queue.complete(task["id"], worker, len(qa_pairs)):
+            logger.warning(f"[Warning] {worker}: lease on task {task['id']} was lost, results will be ignored at merge.")
+        heartbeat.task_id = None
+
+        calls += 1
+        if calls % generator.SLEEP_AFTER == 0:
+            logger.info(f"⏳ {worker}: sleeping {generator.SLEEP_SECONDS}s to avoid rate limits...")
+            time.sleep(generator.SLEEP_SECONDS)
+
+    heartbeat.stopped.set()
+    logger.info(f"✅ {worker}: queue drained, {calls} calls made")
+
+
+# --- Coordinator ---
+def enqueue_corpus(queue):
+    import generator
+    from batching import pack_chunks
+    from source_detection import detect_source
+
+    total = 0
+    for subdir, _, files in os.walk(generator.PDF_DIR):
+        for file in files:
+            if not file.lower().endswith('.pdf'):
+                continue
+            pdf_path = os.path.join(subdir, file)
+            chunks = generator.extract_text_chunks_from_pdf(pdf_path)
+            if not chunks:
+                logger.warning(f"[Warning] No valid text chunks in {file}. Skipping.")
+                continue
+            source, method, _ = detect_source(pdf_path, llm_fallback=generator.detect_source_name, fallback_text=chunks[0])
+            tasks = list(pack_chunks(chunks))
+            for first, last, batch, num_pairs in tasks:
+                queue.enqueue(pdf_path, source, first, last, num_pairs, "\n\n".join(batch))
+            total += len(tasks)
+            logger.info(f"📥 {file}: {len(tasks)} tasks, source '{source}' (via {method})")
+    return total
+
+
+def merge_shards(queue):
+    """Write one <pdf>.jsonl per document from the shards, keeping only results of the lease that completed each task."""
+    import generator
+
+    owners = {row["id"]: row["worker"] for row in queue.completed_tasks()}
+    per_file = {}
+    duplicates = 0
+    if os.path.isdir(SHARD_DIR):
+        for shard in sorted(os.listdir(SHARD_DIR)):
+            with open(os.path.join(SHARD_DIR, shard), "r", encoding="utf-8") as f:
+                for line in f:
+                    item = json.loads(line)
+                    task_id = item.pop("task_id")
+                    if owners.get(task_id) != item.pop("worker"):
+                        duplicates += 1
+                        continue
+                    per_file.setdefault(item.pop("file"), []).append((task_id, item))
+
+    os.makedirs(generator.OUTPUT_DIR, exist_ok=True)
+    for pdf_path, items in per_file.items():
+        items.sort(key=lambda entry: entry[0])  # back to chunk order
+        output_file = os.path.join(generator.OUTPUT_DIR, f"{os.path.splitext(os.path.basename(pdf_path))[0]}.jsonl")
+        open(output_file, 'w', encoding='utf-8').close()
+        generator.append_to_jsonl(output_file, [item for _, item in items])
+    if duplicates:
+        logger.info(f"🧹 Dropped {duplicates} results from expired leases")
+    generator.merge_all_jsonl_outputs(generator.OUTPUT_DIR)
+
+
+def log_status(queue):
+    counts = queue.counts()
+    now = time.time()
+    stale = [w["name"] for w in queue.workers() if w["heartbeat"] and now - w["heartbeat"] > 2 * HEARTBEAT_SECONDS]
+    logger.info(
+        f"📊 Queue: {counts['done']} done, {counts['leased']} leased, {counts['pending']} pending, "
+        f"{counts['failed']} failed" + (f" | no heartbeat from {', '.join(stale)}" if stale else "")
+    )
+
+
+def run_coordinator(num_workers=NUM_WORKERS, db_path=QUEUE_DB):
+    os.environ.setdefault("GENERATOR_LOG_FILE", COORDINATOR_LOG_FILE)
+    import generator  # sets up logging for the coordinator
+
+    # A worker without any key exits at once with code 0 and is never restarted
+    if not generator.API_KEYS:
+        logger.error("[Error] No API keys configured.")
+        return
+    if num_workers > len(generator.API_KEYS):
+        logger.warning(f"[Warning] {len(generator.API_KEYS)} API keys for {num_workers} workers, starting {len(generator.API_KEYS)}")
+        num_workers = len(generator.API_KEYS)
+
+    queue = WorkQueue(db_path)
+    logger.info(f"📥 Enqueued {enqueue_corpus(queue)} tasks into '{db_path}'")
+
+    # spawn on every platform: workers must import generator themselves to get their own log file.
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+    while queue.has_open_tasks():
+        if processes and all(process.exitcode == 0 for process in processes.values()):
+            logger.error("[Error] Every worker exited while tasks are still open, stopping.")
+            break
+        for index in range(num_workers):
+            process = processes.get(index)
+            if process is None or (not process.is_alive() and process.exitcode != 0):
+                if process is not None:
+                    logger.warning(f"[Warning] worker-{index} exited with code {process.exitcode}, restarting it")
+                processes[index] = context.Process(target=run_worker, args=(index, num_workers, db_path))
+                processes[index].start()
+        time.sleep(HEARTBEAT_SECONDS)
+        log_status(queue)
+
+    for process in processes.values():
+        process.join()
+    log_status(queue)
+    merge_shards(queue)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Génération distribuée des paires Q&A.")
+    parser.add_argument("mode", choices=["run", "worker", "status", "merge"])
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS)
+    parser.add_argument("--index", type=int, default=0, help="Worker index (mode worker)")
+    parser.add_argument("--db", default=QUEUE_DB)
+    args = parser.parse_args()
+
+    if args.mode == "run":
+        run_coordinator(args.workers, args.db)
+    elif args.mode == "worker":
+        run_worker(args.index, args.workers, args.db)
+    elif args.mode == "status":
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s", stream=sys.stdout)
+        log_status(WorkQueue(args.db))
+    else:
+        os.environ.setdefault("GENERATOR_LOG_FILE", COORDINATOR_LOG_FILE)
+        os.environ.setdefault("GENERATOR_LOG_MODE", "a")
+        import generator  # noqa: F401  (logging setup)
+        merge_shards(WorkQueue(args.db))
+
+
+if __name__ == "__main__":
+    main()
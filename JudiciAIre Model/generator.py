@@ -6,14 +6,19 @@ import re
 from PyPDF2 import PdfReader
 import logging
 import sys
+from collections import Counter
+from qa_parser import parse_qa_pairs, yield_ratio
+from batching import pack_chunks, compare_call_counts
+from source_detection import detect_source
 
 # Setup logging
-log_filename = "processing.log"
+log_filename = os.environ.get("GENERATOR_LOG_FILE", "processing.log")  # distributed.py gives each worker its own file
+log_mode = os.environ.get("GENERATOR_LOG_MODE", "w")                   # "a": distributed.py workers and merge keep the existing log
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(message)s",
     handlers=[
-        logging.FileHandler(log_filename, mode='w', encoding='utf-8'),
+        logging.FileHandler(log_filename, mode=log_mode, encoding='utf-8'),
         logging.StreamHandler(sys.stdout)  # Optional: to also print to console
     ]
 )
@@ -32,10 +37,10 @@ API_KEYS = [
 PDF_DIR = "code"          # Parent directory containing subdirectories with PDF files
 OUTPUT_DIR = "outputs_ar"     # Directory to save JSONL output files
 MODEL_NAME = "models/gemini-2.0-flash"
-PAIRS_PER_CHUNK = 3
-CHUNKS_PER_CALL = 3
-SLEEP_AFTER = 10
+SLEEP_AFTER = 10           # Calls between rate-limit pauses (chunk packing is configured in batching.py)
 SLEEP_SECONDS = 60
+MIN_YIELD_RATIO = 0.3        # Below this parsed/requested ratio a batch is flagged
+MAX_LOW_YIELD_BATCHES = 3    # Consecutive flagged batches before a file is abandoned
 
 # --- Initialize Gemini ---
 current_key_index = 0
@@ -58,7 +63,7 @@ def extract_text_chunks_from_pdf(file_path):
         print(f"[Error] PDF extraction failed: {e}")
         return []
 
-# --- Detect source title from content ---
+# --- Detect source title from content (LLM fallback for source_detection.detect_source) ---
 def detect_source_name(text_chunk):
     try:
         prompt = f"""
@@ -130,7 +135,7 @@ Texte :
 #     response = model.generate_content(prompt)
 #     return parse_qa_pairs(response.text.strip(), source)
 
-def generate_qa_pairs(text, num_pairs, source):
+def generate_qa_pairs(text, num_pairs, source, stats=None):
     prompt = f"""
 Tu es un assistant juridique spécialisé en droit marocain.
 
@@ -160,16 +165,20 @@ Voici le texte à analyser :
 {text}
 """
     response = model.generate_content(prompt)
-    return parse_qa_pairs(response.text.strip(), source)
+    return parse_qa_pairs(response.text.strip(), source, stats)
 
 # --- Retry wrapper with key rotation ---
-def safe_generate_qa_pairs(text, num_pairs, source):
+class GenerationError(Exception):
+    """The Gemini call failed (API/network error, or quota exhausted on every key after all retries)."""
+
+
+def generate_with_key_rotation(text, num_pairs, source, stats=None):
     global current_key_index, model
     retries = 5
     delay = 60
     for _ in range(retries):
         try:
-            return generate_qa_pairs(text, num_pairs, source)
+            return generate_qa_pairs(text, num_pairs, source, stats)
         except Exception as e:
             err_str = str(e).lower()
             if "quota" in err_str or "resourceexhausted" in err_str:
@@ -183,25 +192,26 @@ def safe_generate_qa_pairs(text, num_pairs, source):
                 configure_gemini()
                 model = genai.GenerativeModel(MODEL_NAME)
             else:
-                print(f"Error: {e}")
-                break
-    return []
-
-# --- Parse QA pairs ---
-def parse_qa_pairs(text, source):
-    qa_pairs = []
-    lines = text.split("\n")
-    current_q = None
-    for line in lines:
-        if line.startswith("Q:"):
-            current_q = line.replace("Q:", "").strip()
-        elif line.startswith("A:") and current_q:
-            answer = line.replace("A:", "").strip()
-            if not answer.endswith(f"Source: {source}"):
-                answer += f"\n\nSource: {source}"
-            qa_pairs.append({"input": current_q, "output": answer})
-            current_q = None
-    return qa_pairs
+                raise GenerationError(str(e)) from e
+    raise GenerationError(f"quota still exceeded after {retries} attempts")
+
+
+def safe_generate_qa_pairs(text, num_pairs, source, stats=None):
+    try:
+        return generate_with_key_rotation(text, num_pairs, source, stats)
+    except GenerationError as e:
+        print(f"Error: {e}")
+        return []
+
+# --- Per-batch yield check ---
+def log_batch_yield(stats, num_pairs):
+    ratio = yield_ratio(stats, num_pairs)
+    print(f"📊 Yield: {stats['pairs']}/{num_pairs} pairs ({ratio:.0%}), "
+          f"{stats['unanswered']} unanswered, {stats['orphan_answers']} orphan answers")
+    if ratio < MIN_YIELD_RATIO:
+        print(f"[Warning] Low yield ({ratio:.0%} < {MIN_YIELD_RATIO:.0%}): check the response format.")
+        return False
+    return True
 
 # --- Append to JSONL ---
 def append_to_jsonl(file_path, data):
@@ -256,24 +266,29 @@ def main():
                 print(f"[Warning] No valid text chunks in {file}. Skipping.")
                 continue
 
-            source = detect_source_name(chunks[0])
-            print(f"📌 Source: {source}")
+            source, method, confidence = detect_source(pdf_path, llm_fallback=detect_source_name, fallback_text=chunks[0])
+            print(f"📌 Source: {source} (via {method}, confidence {confidence:.2f})")
 
             output_file = os.path.join(OUTPUT_DIR, f"{os.path.splitext(file)[0]}.jsonl")
             open(output_file, 'w', encoding='utf-8').close()
 
             total_pairs = 0
-            for i in range(0, len(chunks), CHUNKS_PER_CALL):
-                batch = chunks[i:i + CHUNKS_PER_CALL]
+            low_yield_batches = 0
+            for call_index, (first, last, batch, num_pairs) in enumerate(pack_chunks(chunks), start=1):
                 combined_text = "\n\n".join(batch)
-                num_pairs = PAIRS_PER_CHUNK * len(batch)
 
-                print(f"📄 Processing chunks {i + 1} to {i + len(batch)}...")
-                qa_pairs = safe_generate_qa_pairs(combined_text, num_pairs, source)
+                print(f"📄 Processing chunks {first} to {last} ({num_pairs} pairs requested)...")
+                stats = Counter()
+                qa_pairs = safe_generate_qa_pairs(combined_text, num_pairs, source, stats)
                 append_to_jsonl(output_file, qa_pairs)
                 total_pairs += len(qa_pairs)
 
-                if (i // CHUNKS_PER_CALL + 1) % SLEEP_AFTER == 0:
+                low_yield_batches = 0 if log_batch_yield(stats, num_pairs) else low_yield_batches + 1
+                if low_yield_batches >= MAX_LOW_YIELD_BATCHES:
+                    print(f"[Error] {low_yield_batches} consecutive low-yield batches, abandoning {file}.")
+                    break
+
+                if call_index % SLEEP_AFTER == 0:
                     print(f"⏳ Sleeping {SLEEP_SECONDS}s to avoid rate limits...")
                     time.sleep(SLEEP_SECONDS)
 
@@ -286,5 +301,25 @@ def main():
     print(f"\n🎯 Total Q&A pairs across all directories: {grand_total_pairs}")
     merge_all_jsonl_outputs(OUTPUT_DIR)
 
+# --- Dry run: API calls with fixed vs packed batches ---
+def plan_calls():
+    totals = Counter()
+    for subdir, _, files in os.walk(PDF_DIR):
+        for file in files:
+            if not file.lower().endswith('.pdf'):
+                continue
+            report = compare_call_counts(extract_text_chunks_from_pdf(os.path.join(subdir, file)))
+            totals.update(report)
+            print(f"📐 {file}: {report['chunks']} chunks, calls {report['fixed_calls']} -> {report['packed_calls']}, "
+                  f"pairs {report['fixed_pairs']} -> {report['packed_pairs']}, "
+                  f"largest prompt ~{report['max_prompt_tokens']} tokens")
+    saved = totals['fixed_calls'] - totals['packed_calls']
+    ratio = saved / totals['fixed_calls'] if totals['fixed_calls'] else 0.0
+    print(f"\n📐 Total calls {totals['fixed_calls']} -> {totals['packed_calls']} ({ratio:.0%} fewer), "
+          f"pairs requested {totals['fixed_pairs']} -> {totals['packed_pairs']}")
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if "--plan" in sys.argv:
+        plan_calls()
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import re
+import time
+import unicodedata
+
+import numpy as np
+
+from prompt_template import ASSISTANT_TAG, USER_TAG, format_prompt
+from qa_parser import split_source_trailers
+
+# Rule-based reward functions for GRPO (`reward_funcs=LEGAL_REWARD_FUNCS`).
+# Each takes the whole batch of completions and returns one float per
+# completion; the scans run once over the joined batch, not per completion.
+
+# --- CONFIGURATION ---
+CODE_DIR = "code"
+ARTICLE_INDEX_FILE = "article_index.json"   # {source: [numéros d'articles]} extrait des PDF de code/
+DATA_FILE = "all_qa.jsonl"
+MIN_ANSWER_CHARS = 150                      # ~1er percentile des réponses de all_qa.jsonl
+MAX_ANSWER_CHARS = 1200                     # ~99e percentile
+LENGTH_DECAY_CHARS = 300                    # Distance aux bornes où la récompense de longueur atteint 0
+
+SEPARATOR = "\x00"
+ARTICLE_RE = re.compile(r"\bArticle\s+(premier|1er|\d+)", re.IGNORECASE)
+CITATION_RE = re.compile(
+    r"(?:\barticles?|\bart\.|المادة|المواد|الفصل|الفصول)\s*"
+    r"(?P<numbers>(?:premier|1er|\d+)(?:\s*(?:,|et|ou|à|و|-)\s*\d+)*)",
+    re.IGNORECASE,
+)
+NUMBER_RE = re.compile(r"premier|1er|\d+", re.IGNORECASE)
+LAW_NUMBER_RE = re.compile(r"\b(\d+)\s*-\s*(\d+)\b")
+ARABIC_DIGITS = str.maketrans("٠١٢٣٤٥٦٧٨٩", "0123456789")
+
+
+# --- Source names ---
+def source_key(name):
+    """Normalized source name: "Loi n° 37 -99 relative à l’état civil." == "loi n° 37-99 relative a l'etat civil"."""
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    name = re.sub(r"\s*-\s*", "-", name.replace("’", "'").casefold())
+    return re.sub(r"\s+", " ", name).strip(" .;:*")
+
+
+def _article_number(text):
+    return 1 if text.lower() in ("premier", "1er") else int(text)
+
+
+# --- Article index ---
+class ArticleIndex:
+    """Article numbers of every law in code/, under the source names used by the dataset."""
+
+    def __init__(self, sources):
+        self.sources = {name: set(numbers) for name, numbers in sources.items()}
+        self.all_articles = set().union(*self.sources.values()) if self.sources else set()
+        self._by_key = {source_key(name): name for name in self.sources}
+        self._by_law_number = {}
+        for name in self.sources:
+            match = LAW_NUMBER_RE.search(name)
+            if match:
+                self._by_law_number[match.groups()] = name
+
+    def resolve(self, source):
+        if not source:
+            return None
+        name = self._by_key.get(source_key(source))
+        if name is None:
+            match = LAW_NUMBER_RE.search(source)
+            name = self._by_law_number.get(match.groups()) if match else None
+        return name
+
+    def articles(self, source):
+        name = self.resolve(source)
+        return self.sources[name] if name is not None else self.all_articles
+
+    @classmethod
+    def build(cls, code_dir=CODE_DIR):
+        from PyPDF2 import PdfReader
+        from source_detection import DEFAULT_SOURCE, detect_source
+
+        sources = {}
+        for root, _, files in os.walk(code_dir):
+            for file in sorted(files):
+                if not file.lower().endswith(".pdf"):
+                    continue
+                path = os.path.join(root, file)
+                text = "\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+                source, _, _ = detect_source(path)
+                if source == DEFAULT_SOURCE:
+                    source = os.path.splitext(file)[0]
+                numbers = {_article_number(n) for n in ARTICLE_RE.findall(text)}
+                sources.setdefault(source, set()).update(numbers)
+                print(f"📚 {file}: {len(numbers)} articles -> '{source}'")
+        return cls(sources)
+
+    def save(self, path=ARTICLE_INDEX_FILE):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({name: sorted(numbers) for name, numbers in self.sources.items()}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=ARTICLE_INDEX_FILE, code_dir=CODE_DIR):
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return cls(json.load(f))
+        index = cls.build(code_dir)
+        index.save(path)
+        return index
+
+
+_article_index = None
+
+
+def get_article_index():
+    global _article_index
+    if _article_index is None:
+        _article_index = ArticleIndex.load()
+    return _article_index
+
+
+# --- Batch helpers ---
+def completion_texts(completions):
+    """Plain strings, or the assistant message of conversational completions."""
+    if completions and isinstance(completions[0], list):
+        return [completion[-1]["content"] for completion in completions]
+    return list(completions)
+
+
+def prompt_texts(prompts):
+    if prompts and isinstance(prompts[0], list):
+        prompts = [next((m["content"] for m in reversed(p) if m["role"] == "user"), "") for p in prompts]
+    return [p.replace(USER_TAG, "").replace(ASSISTANT_TAG, "") for p in prompts]
+
+
+def _offsets(texts):
+    lengths = np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+    starts = np.zeros(len(texts), dtype=np.int64)
+    np.cumsum(lengths[:-1] + len(SEPARATOR), out=starts[1:])
+    return starts, lengths
+
+
+def scan(pattern, texts):
+    """One regex pass over the joined batch; returns the owning text index of each match and the matches."""
+    starts, _ = _offsets(texts)
+    matches = list(pattern.finditer(SEPARATOR.join(texts)))
+    owners = np.searchsorted(starts, [m.start() for m in matches], side="right") - 1
+    return owners, matches
+
+
+def script_counts(texts):
+    """(arabic_letters, latin_letters) per text, counted on the code points of the whole batch at once."""
+    if not texts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    starts, _ = _offsets(texts)
+    # Trailing separator: an empty last text still owns one (non-letter) code point
+    codes = np.frombuffer((SEPARATOR.join(texts) + SEPARATOR).encode("utf-32-le"), dtype=np.uint32)
+    arabic = (codes >= 0x0620) & (codes <= 0x064A)
+    lower = codes | 0x20
+    latin = ((lower >= ord("a")) & (lower <= ord("z"))) | ((codes >= 0xC0) & (codes <= 0xFF))
+    return np.add.reduceat(arabic, starts), np.add.reduceat(latin, starts)
+
+
+def is_arabic(texts):
+    arabic, latin = script_counts(texts)
+    return arabic > latin
+
+
+def split_trailers(texts):
+    """(bodies, trailer matches): the answer without its final source line, and that line's match or None."""
+    bodies, trailers = [], []
+    for text in texts:
+        body, matches = split_source_trailers(text)
+        bodies.append(body)
+        trailers.append(matches[0] if matches else None)
+    return bodies, trailers
+
+
+# --- Rewards ---
+def citation_reward(prompts, completions, **kwargs):
+    """+1 when every cited article exists in the cited law, -1 when none does, 0 without any citation."""
+    texts = completion_texts(completions)
+    index = get_article_index()
+    if not index.all_articles:
+        return [0.0] * len(texts)
+    _, trailers = split_trailers(texts)
+    sources = [match.group("source").strip() if match else None for match in trailers]
+    owners, matches = scan(CITATION_RE, [t.translate(ARABIC_DIGITS) for t in texts])
+    valid = np.zeros(len(texts))
+    total = np.zeros(len(texts))
+    for owner, match in zip(owners.tolist(), matches):
+        known = index.articles(sources[owner])
+        for number in NUMBER_RE.findall(match.group("numbers")):
+            total[owner] += 1
+            valid[owner] += _article_number(number) in known
+    return np.where(total > 0, (2 * valid - total) / np.maximum(total, 1), 0.0).tolist()
+
+
+def source_reward(prompts, completions, source=None, **kwargs):
+    """
+    0 without a final "Source:" / "المصدر:" line. Otherwise 0.5, plus 0.25 when
+    the label matches the answer's language and 0.25 when the named law is the
+    expected one (`source` dataset column) or, when the row has none, at least a
+    law of the index.
+    """
+    index = get_article_index()
+    bodies, trailers = split_trailers(completion_texts(completions))
+    arabic = is_arabic(bodies)
+    rewards = []
+    for i, match in enumerate(trailers):
+        if not match:
+            rewards.append(0.0)
+            continue
+        label_ok = ("المصدر" in match.group(0)) == bool(arabic[i])
+        named = index.resolve(match.group("source").strip())
+        # Rows without an expected source (None / empty column) only need a known law
+        expected_source = source[i] if source is not None else None
+        if expected_source:
+            expected = index.resolve(expected_source) or expected_source
+            source_ok = named == expected or source_key(match.group("source")) == source_key(expected_source)
+        else:
+            source_ok = named is not None
+        rewards.append(0.5 + 0.25 * label_ok + 0.25 * source_ok)
+    return rewards
+
+
+def language_reward(prompts, completions, **kwargs):
+    """1 when the answer is written in the question's script (Arabic vs Latin), else 0."""
+    bodies, _ = split_trailers(completion_texts(completions))
+    return (is_arabic(prompt_texts(prompts)) == is_arabic(bodies)).astype(float).tolist()
+
+
+def length_reward(prompts, completions, **kwargs):
+    """1 inside [MIN_ANSWER_CHARS, MAX_ANSWER_CHARS], decaying linearly to 0 over LENGTH_DECAY_CHARS outside."""
+    _, lengths = _offsets(completion_texts(completions))
+    outside = np.maximum(MIN_ANSWER_CHARS - lengths, 0) + np.maximum(lengths - MAX_ANSWER_CHARS, 0)
+    return np.clip(1.0 - outside / LENGTH_DECAY_CHARS, 0.0, 1.0).tolist()
+
+
+LEGAL_REWARD_FUNCS = [citation_reward, source_reward, language_reward, length_reward]
+
+
+# --- Benchmark ---
+def benchmark(data_file=DATA_FILE, size=10_000):
+    with open(data_file, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records = (records * (size // len(records) + 1))[:size]
+    prompts = [format_prompt(r["input"]) for r in records]
+    completions = [r["output"] for r in records]
+    get_article_index()
+    for reward_func in LEGAL_REWARD_FUNCS:
+        start = time.perf_counter()
+        rewards = reward_func(prompts, completions)
+        elapsed = time.perf_counter() - start
+        print(f"⏱️ {reward_func.__name__}: {size / elapsed:,.0f} complétions/s, moyenne {np.mean(rewards):.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Récompenses GRPO basées sur les règles (citations, source, langue, longueur).")
+    parser.add_argument("--build-index", action="store_true", help="Reconstruit article_index.json depuis code/")
+    parser.add_argument("--benchmark", type=int, metavar="N", help="Mesure le débit sur N réponses de all_qa.jsonl")
+    args = parser.parse_args()
+
+    if args.build_index:
+        index = ArticleIndex.build()
+        index.save()
+        print(f"✅ {sum(len(v) for v in index.sources.values())} articles, {len(index.sources)} sources")
+    if args.benchmark:
+        benchmark(size=args.benchmark)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import sys
+
+# --- Template ---
+# Single source of truth for the prompt format. Training (notebook, token_cache)
+# and every inference path (backend app.py, run.py) import it from here: the
+# generation prompt must be an exact prefix of the training text, otherwise the
+# model never sees its answer start and keeps on generating.
+USER_TAG = "<|user|>"
+ASSISTANT_TAG = "<|assistant|>"
+PROMPT_TEMPLATE = USER_TAG + "\n{input}\n" + ASSISTANT_TAG + "\n"
+TRAIN_TEMPLATE = PROMPT_TEMPLATE + "{output}"
+
+# A model trained without EOS continues with the next turn: cut there.
+STOP_STRINGS = [USER_TAG]
+
+# Échantillons utilisés par check_template_parity (français, arabe, accolades)
+PARITY_EXAMPLES = [
+    {"input": "À qui s'applique le Code de la Famille ?",
+     "output": "Le Code de la Famille s'applique à tous les Marocains.\n\nSource: Code de la Famille"},
+    {"input": "ما هي شروط الزواج؟", "output": "يشترط الإيجاب والقبول.\n\nالمصدر: مدونة الأسرة"},
+    {"input": "Article {12} ?", "output": "Voir l'article 12.\n\nSource: Dahir {1-04-22}"},
+]
+
+
+# --- Formatting ---
+def format_prompt(question):
+    """Generation prompt: the training text up to (and including) the assistant tag."""
+    return PROMPT_TEMPLATE.format(input=question)
+
+
+def format_example(example, eos_token=""):
+    return TRAIN_TEMPLATE.format(input=example["input"], output=example["output"]) + eos_token
+
+
+def format_batch(batch, eos_token=""):
+    """Batched formatter for `dataset.map(format_batch, batched=True)`: one call per column batch."""
+    return {
+        "text": [
+            TRAIN_TEMPLATE.format(input=question, output=answer) + eos_token
+            for question, answer in zip(batch["input"], batch["output"])
+        ]
+    }
+
+
+def extract_answer(generated_text):
+    """Answer part of a decoded generation (prompt tokens excluded), cut at the next turn."""
+    for stop in STOP_STRINGS:
+        index = generated_text.find(stop)
+        if index != -1:
+            generated_text = generated_text[:index]
+    return generated_text.strip()
+
+
+# --- Parity check ---
+def check_template_parity(tokenizer=None, examples=PARITY_EXAMPLES):
+    """
+    Raise ValueError when the serving prompt is no longer a prefix of the
+    training text, as strings and, with a tokenizer, as token ids (a merge
+    across the prompt/answer boundary would break it just as well).
+    """
+    for example in examples:
+        prompt = format_prompt(example["input"])
+        text = format_example(example)
+        if format_batch({"input": [example["input"]], "output": [example["output"]]})["text"] != [text]:
+            raise ValueError("format_batch and format_example disagree")
+        if not text.startswith(prompt) or text[len(prompt):] != example["output"]:
+            raise ValueError(f"Inference prompt is not a prefix of the training text: {prompt!r}")
+        if extract_answer(example["output"] + "\n" + format_prompt("?")) != example["output"].strip():
+            raise ValueError("extract_answer does not cut at the next turn")
+        if tokenizer is not None:
+            prompt_ids = tokenizer(prompt)["input_ids"]
+            text_ids = tokenizer(text)["input_ids"]
+            if text_ids[:len(prompt_ids)] != prompt_ids:
+                raise ValueError(f"Prompt tokens differ from the training tokens at the answer boundary: {prompt!r}")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vérifie la parité du template entre entraînement et inférence.")
+    parser.add_argument("--tokenizer", help="Nom ou chemin du tokenizer à vérifier (optionnel)")
+    args = parser.parse_args()
+
+    tokenizer = None
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    try:
+        check_template_parity(tokenizer)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    print("✅ Templates d'entraînement et d'inférence identiques")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import re
+from collections import Counter
+
+# --- Grammar ---
+# A response is a sequence of lines. A line opening with a question or answer
+# marker starts a new section; every other line continues the current one, so
+# multi-line answers are kept whole. Text before the first question is ignored.
+#
+#   marker := [ "#"* | "-" | "*" | ">" | "1." ]* [ "**" ] label [ digits ] [ "**" ] ":" [ "**" ] rest
+#   label  := Q | Question | س | سؤال                      (question)
+#           | A | R | Réponse | Reponse | ج | جواب          (answer)
+#
+# Accepted examples: "Q: ...", "**Q1 :** ...", "### Question 2 : ...", "- A: ...",
+# "س: ...", "**ج:** ...", "1. Q: ...". Markdown rules ("---") are dropped.
+QUESTION_LABELS = ("question", "q", "سؤال", "س")
+ANSWER_LABELS = ("réponse", "reponse", "r", "a", "جواب", "ج")
+
+MARKER_RE = re.compile(
+    r"^\s*(?:(?:#{1,6}|[-*>•]|\d+[.)])\s*)*"
+    r"(?:\*\*|__)?\s*"
+    r"(?P<label>Question|Réponse|Reponse|سؤال|جواب|Q|A|R|س|ج)"
+    r"\s*\d*\s*(?:\*\*|__)?\s*[:：]\s*(?:\*\*|__)?\s*"
+    r"(?P<rest>.*)$",
+    re.IGNORECASE,
+)
+RULE_RE = re.compile(r"^\s*(?:-{3,}|\*{3,}|_{3,})\s*$")
+ARABIC_RE = re.compile("[\u0600-\u06ff]")
+
+# Source trailer ("Source: X", "Source : X", "المصدر: X"), possibly in bold. It is
+# only matched from an occurrence of the label to the end of a line (fullmatch),
+# and each run of blanks/"*" is a single class next to a literal or to the
+# source, so text made of blanks is rejected in linear time. Repeated trailers
+# are stripped one at a time from the end by split_source_trailers.
+SOURCE_LABEL_RE = re.compile("Source|المصدر")
+SOURCE_TRAILER_RE = re.compile(
+    r"(?:Source|المصدر)[ \t*]*[:：][ \t*]*(?P<source>(?:[^\n]*[^\s*])?)[ \t*]*"
+)
+TRAILER_EDGE = " \t\r\n*"
+
+
+# --- Streaming helpers ---
+def iter_lines(chunks):
+    """Re-split arbitrary text chunks (a full response or a streamed one) into lines."""
+    if isinstance(chunks, str):
+        chunks = [chunks]
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split("\n")
+        yield from lines
+    if buffer:
+        yield buffer
+
+
+def classify_line(line):
+    match = MARKER_RE.match(line)
+    if not match:
+        return None, line
+    label = match.group("label").lower()
+    kind = "q" if label in QUESTION_LABELS else "a"
+    return kind, match.group("rest")
+
+
+def _join(lines):
+    return "\n".join(lines).strip().strip("*_").strip()
+
+
+def iter_qa_pairs(chunks, stats=None):
+    stats = stats if stats is not None else Counter()
+    question, answer, mode = [], [], None
+
+    def emit():
+        q, a = _join(question), _join(answer)
+        if q and a:
+            stats["pairs"] += 1
+            return {"input": q, "output": a}
+        if q:
+            stats["unanswered"] += 1
+        return None
+
+    for line in iter_lines(chunks):
+        if RULE_RE.match(line):
+            continue
+        kind, rest = classify_line(line)
+        if kind == "q":
+            if mode is not None:
+                pair = emit()
+                if pair:
+                    yield pair
+            question, answer, mode = [rest], [], "q"
+        elif kind == "a" and mode == "q":
+            answer, mode = [rest], "a"
+        elif kind == "a" and mode is None:
+            stats["orphan_answers"] += 1
+        elif kind == "a" and mode == "a":
+            # Second marker in the same answer ("A: ..." then "R: ..."): same answer, marker dropped
+            stats["repeated_answer_markers"] += 1
+            answer.append(rest)
+        elif mode == "q":
+            question.append(line)
+        elif mode == "a":
+            answer.append(line)
+
+    if mode is not None:
+        pair = emit()
+        if pair:
+            yield pair
+
+
+# --- Source trailer ---
+def _rstrip_end(text, end):
+    while end and text[end - 1] in TRAILER_EDGE:
+        end -= 1
+    return end
+
+
+def split_source_trailers(text):
+    """
+    (body, trailers): `text` without its final source trailers (Gemini's own
+    "Source : X" is often followed by the line add_source appended) and their
+    matches, last one first. Empty when the text does not end on a trailer.
+    """
+    trailers = []
+    end = _rstrip_end(text, len(text))
+    while end:
+        # A trailer starts on the last line, at its start or after a non-letter
+        start = text.rfind("\n", 0, end) + 1
+        for label in reversed(list(SOURCE_LABEL_RE.finditer(text, start, end))):
+            pos = label.start()
+            if pos >= end or (pos > start and text[pos - 1].isalnum()):
+                continue
+            match = SOURCE_TRAILER_RE.fullmatch(text, pos, end)
+            if match:
+                trailers.append(match)
+                end = _rstrip_end(text, pos)
+        # Text left on this line that is not a trailer
+        if end > start:
+            break
+    return text[:end], trailers
+
+
+def strip_source(text):
+    return split_source_trailers(text)[0]
+
+
+def normalize_source(text):
+    """A single final "Source: X" line (X from the last trailer), whatever the label and repetitions."""
+    body, trailers = split_source_trailers(text)
+    if not trailers:
+        return text
+    return f"{body}\n\nSource: {trailers[0].group('source')}"
+
+
+def add_source(answer, source):
+    if split_source_trailers(answer)[1]:
+        return answer
+    label = "المصدر" if ARABIC_RE.search(answer) else "Source"
+    return f"{answer}\n\n{label}: {source}"
+
+
+def parse_qa_pairs(text, source, stats=None):
+    pairs = []
+    for pair in iter_qa_pairs(text, stats):
+        pair["output"] = add_source(pair["output"], source)
+        pairs.append(pair)
+    return pairs
+
+
+def yield_ratio(stats, requested):
+    return stats["pairs"] / requested if requested else 0.0
@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import re
+from collections import Counter
+
+import numpy as np
+from PyPDF2 import PdfReader
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from qa_parser import split_source_trailers
+
+# --- CONFIGURATION ---
+SOURCE_CACHE_FILE = "source_cache.json"   # Cache {sha256 du PDF: source détectée}
+LABELED_PDF_DIR = os.path.join("code", "Matière familiale")
+LABELED_OUTPUTS_DIR = "outputs"            # Sorties existantes dont la ligne "Source:" sert d'étiquette
+TITLE_PAGES = 2                            # Pages lues pour les heuristiques et le classifieur
+CLASSIFIER_MIN_SIMILARITY = 0.8          # Une loi absente de l'entraînement atteint jusqu'à 0.75 (leave-one-out sur code/)
+CLASSIFIER_MIN_MARGIN = 0.1                # Écart minimal avec la deuxième loi la plus proche
+CLASSIFIER_CACHE_SIMILARITY = 0.9          # En dessous, une décision du seul classifieur n'est pas mise en cache
+TITLE_MIN_CONFIDENCE = 0.7
+DEFAULT_SOURCE = "Source juridique"        # Valeur renvoyée par detect_source_name en cas d'erreur
+
+# --- Title heuristics ---
+# Ordered by reliability: the promulgated law's own title beats the Dahir line
+# that merely promulgates it.
+TITLE_PATTERNS = [
+    (re.compile(r"\b(Loi\s+n\s*°\s*[\d][\d\s.\-]*\s+(?:relative|portant|fixant|modifiant|complétant)\b[^\n]{5,150})", re.IGNORECASE), 0.85),
+    (re.compile(r"\b(Code\s+(?:de\s+la|de\s+l'|du|des|de)\s*[A-Za-zÀ-ÿ'’\- ]{3,60})", re.IGNORECASE), 0.8),
+    (re.compile(r"\b(Dahir\s+(?:n\s*°\s*)?[\d][\d\s.\-]*[^\n]{0,150})", re.IGNORECASE), 0.7),
+]
+WORD_EXPORT_RE = re.compile(r"^Microsoft Word\s*-\s*|\.docx?$", re.IGNORECASE)
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_title_page(path, pages=TITLE_PAGES):
+    reader = PdfReader(path)
+    text = "\n".join(page.extract_text() or "" for page in reader.pages[:pages])
+    metadata_title = ""
+    if reader.metadata is not None and reader.metadata.title:
+        metadata_title = str(reader.metadata.title)
+    return text, metadata_title
+
+
+def _clean_title(title):
+    title = WHITESPACE_RE.sub(" ", WORD_EXPORT_RE.sub("", title)).strip()
+    return title.rstrip(" .,;:-")
+
+
+def title_from_text(text):
+    for pattern, confidence in TITLE_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            return _clean_title(match.group(1)), confidence
+    return None, 0.0
+
+
+def title_from_metadata(metadata_title):
+    # Metadata titles are often "Microsoft Word - scan3.docx": only keep them
+    # when they read like a law title.
+    title, confidence = title_from_text(_clean_title(metadata_title))
+    return title, confidence - 0.05 if title else 0.0
+
+
+# --- Local TF-IDF classifier ---
+class SourceClassifier:
+    """Nearest-centroid TF-IDF classifier over the already labelled PDFs."""
+
+    def __init__(self, texts, labels):
+        self.vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(3, 5), sublinear_tf=True)
+        matrix = self.vectorizer.fit_transform(texts)
+        self.labels = sorted(set(labels))
+        centroids = np.vstack([
+            np.asarray(matrix[[i for i, label in enumerate(labels) if label == name]].mean(axis=0))
+            for name in self.labels
+        ])
+        self.centroids = centroids / np.linalg.norm(centroids, axis=1, keepdims=True)
+
+    def predict(self, text):
+        """(label, similarity, margin over the second closest label; the similarity itself with one label)."""
+        vector = self.vectorizer.transform([text]).toarray()[0]
+        similarities = self.centroids @ vector
+        order = np.argsort(similarities)[::-1]
+        best = float(similarities[order[0]])
+        second = float(similarities[order[1]]) if len(order) > 1 else 0.0
+        return self.labels[order[0]], best, best - second
+
+
+def _label_from_outputs(jsonl_path):
+    sources = Counter()
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        for line in f:
+            _, trailers = split_source_trailers(json.loads(line).get("output", ""))
+            if trailers:
+                sources[trailers[0].group("source").strip()] += 1
+    return sources.most_common(1)[0][0] if sources else None
+
+
+def load_training_set(pdf_dir=LABELED_PDF_DIR, outputs_dir=LABELED_OUTPUTS_DIR):
+    texts, labels = [], []
+    if not os.path.isdir(pdf_dir) or not os.path.isdir(outputs_dir):
+        return texts, labels
+    for file in sorted(os.listdir(pdf_dir)):
+        if not file.lower().endswith(".pdf"):
+            continue
+        jsonl_path = os.path.join(outputs_dir, f"{os.path.splitext(file)[0]}.jsonl")
+        if not os.path.exists(jsonl_path):
+            continue
+        label = _label_from_outputs(jsonl_path)
+        if label:
+            text, _ = read_title_page(os.path.join(pdf_dir, file))
+            texts.append(text)
+            labels.append(label)
+    return texts, labels
+
+
+_classifier = None
+
+
+def get_classifier():
+    global _classifier
+    if _classifier is None:
+        texts, labels = load_training_set()
+        _classifier = SourceClassifier(texts, labels) if texts else False
+    return _classifier or None
+
+
+# --- Cache ---
+def load_cache(path=SOURCE_CACHE_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_cache(cache, path=SOURCE_CACHE_FILE):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+# --- Detection ---
+def detect_source(pdf_path, llm_fallback=None, fallback_text=None):
+    """
+    Name the law a PDF belongs to. Returns (source, method, confidence).
+
+    Order: cache by file hash, title-page heuristics, PDF metadata, local
+    classifier, and only then `llm_fallback(fallback_text)` when nothing
+    reached its confidence threshold. The classifier is closed-set (trained on
+    one PDF per law already in the dataset), so it only answers with a margin
+    over the second closest law, and its decision is cached only when the
+    similarity is high: a new law would otherwise be filed for good under the
+    closest known one.
+    """
+    cache = load_cache()
+    file_hash = file_sha256(pdf_path)
+    if file_hash in cache:
+        entry = cache[file_hash]
+        return entry["source"], "cache", entry["confidence"]
+
+    text, metadata_title = read_title_page(pdf_path)
+    source, method, confidence = None, None, 0.0
+    cacheable = True
+
+    for candidate_method, (title, title_confidence) in (
+        ("title_page", title_from_text(text)),
+        ("metadata", title_from_metadata(metadata_title)),
+    ):
+        if source is None and title and title_confidence >= TITLE_MIN_CONFIDENCE:
+            source, method, confidence = title, candidate_method, title_confidence
+
+    classifier = get_classifier() if source is None and text.strip() else None
+    if classifier is not None:
+        label, similarity, margin = classifier.predict(text)
+        if similarity >= CLASSIFIER_MIN_SIMILARITY and margin >= CLASSIFIER_MIN_MARGIN:
+            source, method, confidence = label, "classifier", similarity
+            cacheable = similarity >= CLASSIFIER_CACHE_SIMILARITY
+
+    if source is None:
+        if llm_fallback is None:
+            return DEFAULT_SOURCE, "default", 0.0
+        source, method, confidence = llm_fallback(fallback_text or text), "llm", 0.5
+        if source == DEFAULT_SOURCE:
+            # The LLM call failed: do not cache the placeholder.
+            return source, method, 0.0
+
+    if not cacheable:
+        return source, method, confidence
+    cache[file_hash] = {"file": os.path.basename(pdf_path), "source": source, "method": method, "confidence": confidence}
+    save_cache(cache)
+    return source, method, confidence
@@ -0,0 +1,65 @@
+import pytest
+
+pytest.importorskip("numpy")
+import legal_rewards
+from legal_rewards import (
+    CITATION_RE, ArticleIndex, citation_reward, is_arabic, language_reward, length_reward, scan, script_counts,
+    source_reward, split_trailers,
+)
+
+FAMILY_CODE = "CODE DE LA FAMILLE"
+CIVIL_STATUS = "Loi n° 37-99 relative à l'état civil"
+
+FRENCH = "Le mariage est conclu selon l'article 4 et les articles 10 et 11.\n\nSource: CODE DE LA FAMILLE"
+ARABIC = "ينعقد الزواج وفق المادة ٤ والمادة 400.\n\nالمصدر: مدونة الأسرة"
+NO_SOURCE = "Le mariage est conclu selon l'article 4."
+
+
+@pytest.fixture(autouse=True)
+def article_index(monkeypatch):
+    index = ArticleIndex({FAMILY_CODE: [1, 4, 10, 11], "مدونة الأسرة": [1, 4, 10, 11], CIVIL_STATUS: [1, 2, 3]})
+    monkeypatch.setattr(legal_rewards, "_article_index", index)
+    return index
+
+
+def test_scan_assigns_matches_to_their_text():
+    owners, matches = scan(CITATION_RE, ["", "article 3", "rien", "المادة 5 et article 6"])
+    assert owners.tolist() == [1, 3, 3]
+    assert [m.group("numbers") for m in matches] == ["3", "5", "6"]
+
+
+def test_script_counts_with_empty_texts():
+    arabic, latin = script_counts(["abc", "", "مدونة", ""])
+    assert arabic.tolist() == [0, 0, 5, 0]
+    assert latin.tolist() == [3, 0, 0, 0]
+    assert is_arabic(["abc", "", "مدونة"]).tolist() == [False, False, True]
+
+
+def test_split_trailers():
+    bodies, trailers = split_trailers([FRENCH, ARABIC, NO_SOURCE, ""])
+    assert bodies[2:] == [NO_SOURCE, ""]
+    assert [m.group("source").strip() if m else None for m in trailers] == [FAMILY_CODE, "مدونة الأسرة", None, None]
+
+
+def test_citation_reward():
+    rewards = citation_reward(None, [FRENCH, ARABIC, NO_SOURCE, "", "Voir l'article 99.\n\nSource: " + CIVIL_STATUS])
+    # Arabic: article 4 exists, 400 does not; no source line: checked against every law
+    assert rewards == [1.0, 0.0, 1.0, 0.0, -1.0]
+
+
+def test_source_reward():
+    completions = [FRENCH, ARABIC, NO_SOURCE, "", "Réponse.\n\nالمصدر: CODE DE LA FAMILLE"]
+    assert source_reward(None, completions) == [1.0, 1.0, 0.0, 0.0, 0.75]
+
+
+def test_source_reward_with_expected_source():
+    completions = [FRENCH, FRENCH, FRENCH, "Réponse.\n\nSource: loi n° 37 - 99", "Réponse.\n\nSource: Dahir inconnu"]
+    expected = [FAMILY_CODE, CIVIL_STATUS, None, CIVIL_STATUS, ""]
+    # Rows without an expected source fall back to "a law of the index"
+    assert source_reward(None, completions, source=expected) == [1.0, 0.75, 1.0, 1.0, 0.75]
+
+
+def test_language_and_length_rewards():
+    prompts = ["<|user|>\nQuelles conditions ?\n<|assistant|>\n", "<|user|>\nما هي الشروط؟\n<|assistant|>\n", "Question ?"]
+    assert language_reward(prompts, [FRENCH, ARABIC, ARABIC]) == [1.0, 1.0, 0.0]
+    assert length_reward(None, ["", "x" * 500, "x" * 1350]) == [0.5, 1.0, 0.5]
@@ -0,0 +1,39 @@
+import ast
+import os
+
+import pytest
+
+from prompt_template import ASSISTANT_TAG, USER_TAG, check_template_parity, format_example, format_prompt
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "judiciAIre UI", "backend")
+# Everything a hand-written prompt would need instead of format_prompt
+TEMPLATE_NAMES = {"PROMPT_TEMPLATE", "TRAIN_TEMPLATE", "USER_TAG", "ASSISTANT_TAG", "format_example", "format_batch"}
+TEMPLATE_MARKERS = (USER_TAG, ASSISTANT_TAG, "<|", "[INST]", "### ")
+
+
+def test_serving_prompt_is_prefix_of_training_text():
+    assert check_template_parity()
+
+
+def test_answer_follows_prompt_directly():
+    example = {"input": "Question ?", "output": "Réponse."}
+    assert format_example(example, eos_token="</s>") == format_prompt("Question ?") + "Réponse.</s>"
+
+
+@pytest.mark.parametrize("filename", ["app.py", "run.py"])
+def test_inference_builds_prompts_only_with_format_prompt(filename):
+    with open(os.path.join(BACKEND, filename), encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    imported = {
+        alias.name for node in ast.walk(tree)
+        if isinstance(node, ast.ImportFrom) and node.module == "prompt_template" for alias in node.names
+    }
+    called = {
+        node.func.id for node in ast.walk(tree) if isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+    }
+    strings = [node.value for node in ast.walk(tree) if isinstance(node, ast.Constant) and isinstance(node.value, str)]
+    names = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+
+    assert "format_prompt" in imported and "format_prompt" in called
+    assert not (imported | names) & TEMPLATE_NAMES
+    assert not [s for s in strings if any(marker in s for marker in TEMPLATE_MARKERS)]
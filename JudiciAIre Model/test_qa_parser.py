@@ -0,0 +1,56 @@
+import time
+from collections import Counter
+
+import pytest
+
+from qa_parser import add_source, iter_qa_pairs, normalize_source, split_source_trailers, strip_source
+
+
+@pytest.mark.parametrize("text", [
+    " " * 200_000,
+    "*" * 200_000,
+    " *" * 100_000,
+    "x\n" + " \t*" * 70_000 + "\n",
+    "Source:" + " " * 200_000 + "x",
+    "Source: " + "* " * 100_000,
+    "Source " * 30_000,
+])
+def test_trailer_on_blanks_and_stars_is_linear(text):
+    # The former `(?:\s*\**\s*Source...)+$` took 3 s on 800 spaces
+    start = time.perf_counter()
+    split_source_trailers(text)
+    add_source(text, "CODE DE LA FAMILLE")
+    assert time.perf_counter() - start < 2
+
+
+@pytest.mark.parametrize("text, body, sources", [
+    ("Réponse.\n\nSource: CODE DE LA FAMILLE", "Réponse.", ["CODE DE LA FAMILLE"]),
+    ("Réponse. Source : CODE DE LA FAMILLE\n\nSource: CODE DE LA FAMILLE", "Réponse.",
+     ["CODE DE LA FAMILLE", "CODE DE LA FAMILLE"]),
+    ("جواب\n\n**المصدر:** مدونة الأسرة**  ", "جواب", ["مدونة الأسرة"]),
+    ("Réponse.\nSource:", "Réponse.", [""]),
+    ("Voir OpenSource: x", "Voir OpenSource: x", []),
+    ("Source: A\nsuite de la réponse", "Source: A\nsuite de la réponse", []),
+])
+def test_split_source_trailers(text, body, sources):
+    stripped, trailers = split_source_trailers(text)
+    assert stripped == body
+    assert [match.group("source") for match in trailers] == sources
+
+
+def test_strip_and_normalize_source():
+    text = "Réponse. Source : CODE DE LA FAMILLE\n\nSource: CODE DE LA FAMILLE"
+    assert strip_source(text) == "Réponse."
+    assert normalize_source(text) == "Réponse.\n\nSource: CODE DE LA FAMILLE"
+    assert add_source("Réponse.", "X") == "Réponse.\n\nSource: X"
+    assert add_source(text, "X") == text
+
+
+def test_repeated_answer_marker_is_stripped():
+    stats = Counter()
+    pairs = list(iter_qa_pairs("Q: Question ?\nA: Première partie\nR: seconde partie\nQ: Autre ?\nR: Oui", stats))
+    assert pairs == [
+        {"input": "Question ?", "output": "Première partie\nseconde partie"},
+        {"input": "Autre ?", "output": "Oui"},
+    ]
+    assert stats["repeated_answer_markers"] == 1
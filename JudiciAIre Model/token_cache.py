@@ -0,0 +1,179 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+from prompt_template import TRAIN_TEMPLATE
+
+# Usage in training (tokenization is skipped by the trainer):
+#   train_dataset = load_or_build("all_qa.jsonl", tokenizer, max_seq_length=2048)
+#   SFTTrainer(..., train_dataset=train_dataset,
+#              args=SFTConfig(..., dataset_kwargs={"skip_prepare_dataset": True}))
+
+# --- CONFIGURATION ---
+DATA_FILE = "all_qa.jsonl"
+CACHE_DIR = "token_cache"            # Un sous-dossier par (données, tokenizer, template)
+MAX_SEQ_LENGTH = 2048
+TOKENIZE_BATCH = 1024                # Exemples par appel au tokenizer rapide
+
+
+# --- Cache keys ---
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def tokenizer_hash(tokenizer):
+    # The serialized fast tokenizer covers vocab, merges, normalizer and
+    # special tokens; slow tokenizers fall back to their vocabulary.
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        payload = backend.to_str()
+    else:
+        payload = json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False)
+    payload += json.dumps([tokenizer.bos_token, tokenizer.eos_token, tokenizer.pad_token])
+    return _sha256(payload.encode("utf-8"))
+
+
+def template_hash(template):
+    return _sha256(template.encode("utf-8"))
+
+
+def cache_key(data_file, tokenizer, template, max_seq_length, add_eos):
+    parts = [file_hash(data_file), tokenizer_hash(tokenizer), template_hash(template), str(max_seq_length), str(add_eos)]
+    return _sha256("|".join(parts).encode("utf-8"))[:16]
+
+
+# --- Build ---
+def iter_texts(data_file, template):
+    with open(data_file, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield template.format(**json.loads(line))
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def build_cache(data_file, tokenizer, template=TRAIN_TEMPLATE, max_seq_length=MAX_SEQ_LENGTH,
+                add_eos=False, cache_dir=CACHE_DIR):
+    """
+    Tokenize `data_file` once into <cache_dir>/<key>/ and return that path.
+
+    tokens.u32 holds every token id back to back, offsets.i64 the n + 1
+    boundaries. The key covers the data, the tokenizer and the template, so an
+    existing directory is reused as is; it is written under a temporary name
+    and renamed, so readers never see a partial cache.
+    """
+    key = cache_key(data_file, tokenizer, template, max_seq_length, add_eos)
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(path, "meta.json")):
+        return path
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    offsets = [0]
+    with open(os.path.join(tmp_path, "tokens.u32"), "wb") as tokens_file:
+        for texts in _batches(iter_texts(data_file, template), TOKENIZE_BATCH):
+            encoded = tokenizer(
+                texts,
+                truncation=True,
+                max_length=max_seq_length - int(add_eos),
+                return_token_type_ids=False,
+                return_attention_mask=False,
+            )["input_ids"]
+            for ids in encoded:
+                if add_eos:
+                    ids = ids + [tokenizer.eos_token_id]
+                np.asarray(ids, dtype=np.uint32).tofile(tokens_file)
+                offsets.append(offsets[-1] + len(ids))
+    np.asarray(offsets, dtype=np.int64).tofile(os.path.join(tmp_path, "offsets.i64"))
+
+    meta = {
+        "data_file": os.path.basename(data_file),
+        "tokenizer": getattr(tokenizer, "name_or_path", ""),
+        "template": template,
+        "max_seq_length": max_seq_length,
+        "add_eos": add_eos,
+        "num_examples": len(offsets) - 1,
+        "num_tokens": offsets[-1],
+    }
+    with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # Another process finished the same cache first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return path
+
+
+# --- Read ---
+class TokenCacheDataset(torch.utils.data.Dataset):
+    """Zero-copy view over a built cache; any number of processes can map the same files."""
+
+    column_names = ["input_ids"]
+
+    def __init__(self, path):
+        self.path = path
+        self.tokens = np.memmap(os.path.join(path, "tokens.u32"), dtype=np.uint32, mode="r")
+        self.offsets = np.fromfile(os.path.join(path, "offsets.i64"), dtype=np.int64)
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        # Reads straight from the mapped pages; only the returned example is widened to int64
+        return {"input_ids": self.tokens[self.offsets[index]:self.offsets[index + 1]].astype(np.int64)}
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+
+def load_or_build(data_file, tokenizer, **kwargs):
+    return TokenCacheDataset(build_cache(data_file, tokenizer, **kwargs))
+
+
+def main():
+    from transformers import AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Pré-tokenisation du corpus dans un cache mémoire-mappé.")
+    parser.add_argument("--data", default=DATA_FILE)
+    parser.add_argument("--tokenizer", required=True)
+    parser.add_argument("--max-seq-length", type=int, default=MAX_SEQ_LENGTH)
+    parser.add_argument("--add-eos", action="store_true")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    dataset = load_or_build(args.data, tokenizer, max_seq_length=args.max_seq_length,
+                            add_eos=args.add_eos, cache_dir=args.cache_dir)
+    print(f"✅ {len(dataset)} exemples, {dataset.meta['num_tokens']} tokens dans '{dataset.path}'")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import signal
+import time
+
+import numpy as np
+import torch
+
+from token_cache import CACHE_DIR, load_or_build
+
+# Command-line replacement for judiciAIr_Fine_tunning.ipynb (same model, LoRA and
+# hyper-parameters), safe to kill at any time: rerunning the same command resumes
+# from the last checkpoint, mid-epoch, with the same sample order.
+#   python train.py --data all_qa.jsonl --output-dir outputs
+#   python train.py ... --push-to-hub youssefELK/judiciaireModwanaLa   (HF_TOKEN dans l'environnement)
+# Les noyaux compilés sont mis en cache sous <output-dir>/compile_cache, par tranche de
+# longueur (UNSLOTH_COMPILE_PERSISTENT_CACHE / _CACHE_DIR / _DYNAMIC, voir
+# unsloth_compile_manager.py) : une relance ne recompile pas.
+
+# --- CONFIGURATION ---
+MODEL_NAME = "unsloth/mistral-7b-instruct-v0.3-bnb-4bit"
+DATA_FILE = "all_qa.jsonl"
+OUTPUT_DIR = "outputs"
+MAX_SEQ_LENGTH = 2048
+NUM_EPOCHS = 15
+BATCH_SIZE = 8
+GRAD_ACCUM = 4
+LEARNING_RATE = 2e-4
+SEED = 42
+CHECKPOINT_MINUTES = 20         # Intervalle entre deux checkpoints (temps réel, pas en steps)
+KEEP_CHECKPOINTS = 2            # Checkpoints conservés dans OUTPUT_DIR
+METRICS_FILE = "metrics.jsonl"  # Débit et temps par step, ajouté à chaque reprise
+DATA_STATE_FILE = "data_state.json"
+STAGING_DIR = ".checkpoint-staging"
+FINAL_DIR = "final"
+COMPILE_CACHE_DIR = "compile_cache"  # Sous OUTPUT_DIR, caches inductor / triton conservés entre exécutions
+
+
+# --- Sample order ---
+class EpochSampler(torch.utils.data.Sampler):
+    """
+    Permutation drawn from (seed, epoch) only, so a resumed run replays the same
+    order. Each epoch is padded with its first indices up to a multiple of
+    `multiple` (one optimizer step): the Trainer groups a trailing partial step
+    differently when it resumes, which would change the updates after the epoch.
+    """
+
+    def __init__(self, num_samples, seed=SEED, multiple=1):
+        self.num_samples = num_samples
+        self.seed = seed
+        self.multiple = multiple
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def order(self, epoch):
+        return np.random.default_rng([self.seed, epoch]).permutation(self.num_samples)
+
+    def fingerprint(self):
+        return hashlib.sha256(self.order(0).astype(np.int64).tobytes()).hexdigest()[:16]
+
+    def __iter__(self):
+        order = self.order(self.epoch)
+        return iter(np.resize(order, len(self)).tolist())
+
+    def __len__(self):
+        return -(-self.num_samples // self.multiple) * self.multiple
+
+
+# --- Checkpoints ---
+def _fsync_tree(path):
+    for root, _, files in os.walk(path):
+        for file in files:
+            with open(os.path.join(root, file), "rb") as f:
+                os.fsync(f.fileno())
+
+
+def data_seed(training_args):
+    return training_args.data_seed if training_args.data_seed is not None else training_args.seed
+
+
+def last_checkpoint(output_dir):
+    from transformers.trainer_utils import get_last_checkpoint
+
+    if not os.path.isdir(output_dir):
+        return None
+    # Leftover of a save interrupted before its rename
+    shutil.rmtree(os.path.join(output_dir, STAGING_DIR), ignore_errors=True)
+    return get_last_checkpoint(output_dir)
+
+
+def resumable_trainer_class(base):
+    """`base` (UnslothSFTTrainer) with seeded epoch order, token counting and atomic checkpoints."""
+
+    class ResumableSFTTrainer(base):
+        _epoch_sampler = None
+        step_tokens = 0
+
+        def _get_train_sampler(self, *args, **kwargs):
+            self._epoch_sampler = EpochSampler(len(self.train_dataset), data_seed(self.args), self._samples_per_step())
+            return self._epoch_sampler
+
+        def training_step(self, model, inputs, *args, **kwargs):
+            mask = inputs.get("attention_mask")
+            # 4D masks (padding-free CPU path) carry no per-token count
+            if mask is not None and mask.dim() == 2:
+                self.step_tokens += int(mask.sum())
+            else:
+                self.step_tokens += inputs["input_ids"].numel()
+            return super().training_step(model, inputs, *args, **kwargs)
+
+        def _samples_per_step(self):
+            return self._train_batch_size * self.args.gradient_accumulation_steps * max(self.args.world_size, 1)
+
+        def data_state(self):
+            state = {"global_step": self.state.global_step}
+            if self._epoch_sampler is not None:
+                steps_per_epoch = len(self._epoch_sampler) // self._samples_per_step()
+                state.update({
+                    "epoch": self.state.global_step // steps_per_epoch,
+                    "steps_in_epoch": self.state.global_step % steps_per_epoch,
+                    "samples_in_epoch": self.state.global_step % steps_per_epoch * self._samples_per_step(),
+                    "num_samples": self._epoch_sampler.num_samples,
+                    "seed": self._epoch_sampler.seed,
+                    "order": self._epoch_sampler.fingerprint(),
+                })
+            return state
+
+        def _save_checkpoint(self, model, trial, *args, **kwargs):
+            # The Trainer writes checkpoint-N in place; a preemption during the
+            # save would leave a partial directory that the next run resumes from.
+            # Write it under STAGING_DIR and rename it once complete instead.
+            output_dir = self.args.output_dir
+            staging_dir = os.path.join(output_dir, STAGING_DIR)
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            self.args.output_dir = staging_dir
+            try:
+                super()._save_checkpoint(model, trial, *args, **kwargs)
+            finally:
+                self.args.output_dir = output_dir
+            name = f"checkpoint-{self.state.global_step}"
+            if self.args.should_save:
+                with open(os.path.join(staging_dir, name, DATA_STATE_FILE), "w", encoding="utf-8") as f:
+                    json.dump(self.data_state(), f, indent=2)
+                _fsync_tree(os.path.join(staging_dir, name))
+                shutil.rmtree(os.path.join(output_dir, name), ignore_errors=True)
+                os.replace(os.path.join(staging_dir, name), os.path.join(output_dir, name))
+                shutil.rmtree(staging_dir, ignore_errors=True)
+                self._rotate_checkpoints(use_mtime=False, output_dir=output_dir)
+
+    return ResumableSFTTrainer
+
+
+def check_data_state(trainer, checkpoint):
+    """Refuse to resume on other data or another seed: the sample order would not be replayed."""
+    path = os.path.join(checkpoint, DATA_STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        saved = json.load(f)
+    sampler = EpochSampler(len(trainer.train_dataset), data_seed(trainer.args))
+    if (saved.get("num_samples"), saved.get("order")) != (sampler.num_samples, sampler.fingerprint()):
+        raise ValueError(
+            f"{checkpoint} was written for {saved.get('num_samples')} samples with another order; "
+            "pass --no-resume or the original --data/--seed"
+        )
+    return saved
+
+
+# --- Progress ---
+def _trainer_callback_class():
+    from transformers import TrainerCallback
+
+    class TimedCheckpointCallback(TrainerCallback):
+        """
+        Saves every `interval` seconds of wall time and on SIGTERM/SIGINT (then
+        stops), and appends step time and tokens/s of every optimizer step to
+        `metrics_path`.
+        """
+
+        def __init__(self, trainer_ref, interval, metrics_path):
+            self.trainer_ref = trainer_ref
+            self.interval = interval
+            self.metrics_path = metrics_path
+            self.stop_requested = False
+            self.last_save = self.last_step = time.monotonic()
+
+        def request_stop(self, signum, frame):
+            print(f"\n⏸️ Signal {signum} : checkpoint puis arrêt à la fin du step en cours")
+            self.stop_requested = True
+
+        def _write(self, record):
+            if self.trainer_ref().is_world_process_zero():
+                with open(self.metrics_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record) + "\n")
+
+        def on_train_begin(self, args, state, control, **kwargs):
+            self.last_save = self.last_step = time.monotonic()
+            self._write({"event": "train_begin", "time": time.time(), "step": state.global_step})
+
+        def on_step_end(self, args, state, control, **kwargs):
+            trainer = self.trainer_ref()
+            now = time.monotonic()
+            step_time = now - self.last_step
+            tokens, trainer.step_tokens = trainer.step_tokens, 0
+            self.last_step = now
+            self._write({
+                "event": "step",
+                "step": state.global_step,
+                "epoch": round(state.epoch or 0.0, 4),
+                "step_time": round(step_time, 4),
+                "tokens": tokens,
+                "tokens_per_second": round(tokens / max(step_time, 1e-8), 1),
+            })
+            if self.stop_requested or now - self.last_save >= self.interval:
+                control.should_save = True
+            if self.stop_requested:
+                control.should_training_stop = True
+            return control
+
+        def on_save(self, args, state, control, **kwargs):
+            self.last_save = time.monotonic()
+            self._write({"event": "checkpoint", "time": time.time(), "step": state.global_step})
+
+        def on_log(self, args, state, control, logs=None, **kwargs):
+            if logs:
+                self._write({"event": "log", "step": state.global_step, **logs})
+
+    return TimedCheckpointCallback
+
+
+# --- Training ---
+def configure_compile(args):
+    """
+    Compile settings of unsloth_compile_manager, read from the environment when it
+    is imported: must run before unsloth. Kernels are compiled once per length
+    bucket and their caches kept next to the checkpoints, so a resumed or repeated
+    run loads them instead of compiling again.
+    """
+    cache_dir = args.compile_cache_dir or os.path.join(args.output_dir, COMPILE_CACHE_DIR)
+    os.environ["UNSLOTH_COMPILE_PERSISTENT_CACHE"] = "0" if args.no_compile_cache else "1"
+    os.environ["UNSLOTH_COMPILE_CACHE_DIR"] = os.path.abspath(cache_dir)
+    os.environ["UNSLOTH_COMPILE_DYNAMIC"] = "1" if args.dynamic_shapes else "0"
+
+
+def load_model(model_name, max_seq_length):
+    from unsloth import FastLanguageModel
+
+    model, tokenizer = FastLanguageModel.from_pretrained(
+        model_name=model_name,
+        max_seq_length=max_seq_length,
+        dtype=None,
+        load_in_4bit=True,
+    )
+    model = FastLanguageModel.get_peft_model(
+        model,
+        r=16,
+        lora_alpha=32,
+        lora_dropout=0.05,
+        bias="none",
+        use_gradient_checkpointing=True,
+        random_state=SEED,
+        use_rslora=False,
+        loftq_config=None,
+    )
+    return model, tokenizer
+
+
+def save_final(model, tokenizer, output_dir):
+    path = os.path.join(output_dir, FINAL_DIR)
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    model.save_pretrained(tmp_path)
+    tokenizer.save_pretrained(tmp_path)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def train(args):
+    import weakref
+
+    configure_compile(args)
+    model, tokenizer = load_model(args.model, args.max_seq_length)
+    # Imported after unsloth, which swaps trl's SFTTrainer/SFTConfig for
+    # UnslothSFTTrainer/UnslothSFTConfig
+    from trl import SFTConfig, SFTTrainer
+    from unsloth import is_bfloat16_supported
+
+    dataset = load_or_build(args.data, tokenizer, max_seq_length=args.max_seq_length,
+                            add_eos=True, cache_dir=args.cache_dir)
+    config = SFTConfig(
+        output_dir=args.output_dir,
+        per_device_train_batch_size=args.batch_size,
+        gradient_accumulation_steps=args.grad_accum,
+        warmup_ratio=0.03,
+        num_train_epochs=args.epochs,
+        learning_rate=args.lr,
+        fp16=not is_bfloat16_supported(),
+        bf16=is_bfloat16_supported(),
+        logging_steps=5,
+        optim="adamw_8bit",
+        weight_decay=0.01,
+        lr_scheduler_type="linear",
+        seed=args.seed,
+        # Checkpoints are driven by wall time (TimedCheckpointCallback)
+        save_strategy="no",
+        save_total_limit=args.keep_checkpoints,
+        max_seq_length=args.max_seq_length,
+        dataset_kwargs={"skip_prepare_dataset": True},
+        report_to="none",
+    )
+    trainer = resumable_trainer_class(SFTTrainer)(
+        model=model,
+        processing_class=tokenizer,
+        train_dataset=dataset,
+        args=config,
+    )
+    callback = _trainer_callback_class()(
+        weakref.ref(trainer), args.checkpoint_minutes * 60, os.path.join(args.output_dir, METRICS_FILE),
+    )
+    trainer.add_callback(callback)
+    signal.signal(signal.SIGTERM, callback.request_stop)
+    signal.signal(signal.SIGINT, callback.request_stop)
+
+    checkpoint = None if args.no_resume else last_checkpoint(args.output_dir)
+    if checkpoint:
+        saved = check_data_state(trainer, checkpoint)
+        where = f", époque {saved['epoch']}, {saved['samples_in_epoch']} exemples déjà vus" if saved and "epoch" in saved else ""
+        print(f"🔁 Reprise depuis {checkpoint}{where}")
+    trainer.train(resume_from_checkpoint=checkpoint)
+
+    if callback.stop_requested:
+        print(f"💾 Checkpoint sauvegardé dans '{args.output_dir}', relancer la même commande pour reprendre")
+        return None
+    path = save_final(model, tokenizer, args.output_dir)
+    print(f"✅ Adaptateur final dans '{path}'")
+    if args.push_to_hub:
+        model.push_to_hub(args.push_to_hub, token=os.environ.get("HF_TOKEN"))
+        tokenizer.push_to_hub(args.push_to_hub, token=os.environ.get("HF_TOKEN"))
+        print(f"☁️ Poussé vers {args.push_to_hub}")
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fine-tuning LoRA reprenable (checkpoints atomiques, ordre des données rejoué).")
+    parser.add_argument("--data", default=DATA_FILE)
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="Cache de tokens (token_cache.py)")
+    parser.add_argument("--max-seq-length", type=int, default=MAX_SEQ_LENGTH)
+    parser.add_argument("--epochs", type=float, default=NUM_EPOCHS)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--grad-accum", type=int, default=GRAD_ACCUM)
+    parser.add_argument("--lr", type=float, default=LEARNING_RATE)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--checkpoint-minutes", type=float, default=CHECKPOINT_MINUTES)
+    parser.add_argument("--keep-checkpoints", type=int, default=KEEP_CHECKPOINTS)
+    parser.add_argument("--no-resume", action="store_true", help="Ignore les checkpoints existants")
+    parser.add_argument("--push-to-hub", metavar="REPO", help="Dépôt Hugging Face de destination (token: HF_TOKEN)")
+    parser.add_argument("--compile-cache-dir", help=f"Cache de compilation (défaut : <output-dir>/{COMPILE_CACHE_DIR})")
+    parser.add_argument("--no-compile-cache", action="store_true", help="Ne conserve pas les noyaux compilés entre exécutions")
+    parser.add_argument("--dynamic-shapes", action="store_true",
+                        help="Un noyau symbolique au lieu d'un noyau par tranche de longueur")
+    args = parser.parse_args()
+    train(args)
+
+
+if __name__ == "__main__":
+    main()
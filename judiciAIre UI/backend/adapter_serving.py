@@ -0,0 +1,274 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# One resident base model, one LoRA adapter per branch of law (trained with
+# "JudiciAIre Model/train.py"). Adapters are loaded on demand and evicted least
+# recently used; requests for different adapters share a generate() call.
+BASE_MODEL = os.getenv("BASE_MODEL_REPO_ID", "unsloth/mistral-7b-instruct-v0.3-bnb-4bit")
+ADAPTERS_FILE = os.getenv("ADAPTERS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "adapters.json"))
+MAX_LOADED_ADAPTERS = int(os.getenv("MAX_LOADED_ADAPTERS", "4"))   # ~40 Mo par adaptateur r=16 sur un 7B
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "8"))
+BATCH_WAIT_MS = float(os.getenv("BATCH_WAIT_MS", "20"))           # Attente max pour compléter un batch
+ROUTER_MIN_SIMILARITY = 0.05                                       # En dessous, domaine par défaut
+
+GenerationRequest = namedtuple("GenerationRequest", ["prompt", "adapter", "future"])
+
+
+# Adapter registry
+def load_adapter_specs(path=ADAPTERS_FILE, fallback_adapter=None):
+    """
+    Read adapters.json: {"default": domain, "domains": {domain: {"adapter": repo
+    id or path, "questions": jsonl of training questions}}}. Relative paths are
+    resolved against the file. Without the file, `fallback_adapter` serves a
+    single "famille" domain.
+    """
+    if not os.path.exists(path):
+        if not fallback_adapter:
+            raise ValueError(f"{path} not found and no fallback adapter given")
+        return {"famille": {"adapter": fallback_adapter}}, "famille"
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    root = os.path.dirname(os.path.abspath(path))
+    domains = {}
+    for name, spec in config["domains"].items():
+        spec = dict(spec)
+        for key in ("adapter", "questions"):
+            value = spec.get(key)
+            if value and (value.startswith(".") or os.path.exists(os.path.join(root, value))):
+                spec[key] = os.path.normpath(os.path.join(root, value))
+        domains[name] = spec
+    default = config.get("default") or next(iter(domains))
+    if default not in domains:
+        raise ValueError(f"Default domain {default!r} is not in {path}")
+    return domains, default
+
+
+def load_base_model(model_name=BASE_MODEL):
+    # Plain transformers + PEFT rather than unsloth's FastLanguageModel: the
+    # unsloth inference kernels apply the active adapter only, which breaks
+    # mixed-adapter batches
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    if torch.cuda.is_available():
+        model = AutoModelForCausalLM.from_pretrained(model_name, device_map={"": 0}, torch_dtype=torch.float16)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_name)
+    model.eval()
+    return model, tokenizer
+
+
+# Domain routing
+def _read_questions(path):
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                questions.append(json.loads(line)["input"])
+    return questions
+
+
+class DomainRouter:
+    """Nearest-centroid TF-IDF over each domain's training questions (as SourceClassifier)."""
+
+    def __init__(self, domains, default, min_similarity=ROUTER_MIN_SIMILARITY):
+        self.domains = domains
+        self.default = default
+        self.min_similarity = min_similarity
+        self.vectorizer = None
+        questions = {name: _read_questions(spec["questions"]) for name, spec in domains.items()
+                     if spec.get("questions") and os.path.exists(spec["questions"])}
+        questions = {name: texts for name, texts in questions.items() if texts}
+        if len(questions) < 2:
+            return
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        self.labels = sorted(questions)
+        self.vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(3, 5), sublinear_tf=True)
+        matrix = self.vectorizer.fit_transform([text for name in self.labels for text in questions[name]])
+        centroids, start = [], 0
+        for name in self.labels:
+            end = start + len(questions[name])
+            centroids.append(np.asarray(matrix[start:end].mean(axis=0)))
+            start = end
+        centroids = np.vstack(centroids)
+        self.centroids = centroids / np.linalg.norm(centroids, axis=1, keepdims=True)
+
+    def route(self, question, domain=None):
+        """Explicit `domain` if known, else the closest domain, else the default one."""
+        if domain in self.domains:
+            return domain
+        if self.vectorizer is None:
+            return self.default
+        similarities = self.centroids @ self.vectorizer.transform([question]).toarray()[0]
+        best = int(np.argmax(similarities))
+        return self.labels[best] if similarities[best] >= self.min_similarity else self.default
+
+
+# Adapter pool
+class AdapterPool:
+    """At most `capacity` LoRA adapters injected into the base model, least recently used evicted first."""
+
+    def __init__(self, base_model, domains, capacity=MAX_LOADED_ADAPTERS):
+        self.base_model = base_model
+        self.domains = domains
+        self.capacity = max(capacity, 1)
+        self.model = None
+        self.loaded = OrderedDict()
+        # Guards `loaded` between the generator thread (acquire) and the Flask
+        # threads (metrics); adapter loads run outside of it
+        self.lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    def _load(self, name):
+        start = time.perf_counter()
+        path = self.domains[name]["adapter"]
+        if self.model is None:
+            from peft import PeftModel
+
+            self.model = PeftModel.from_pretrained(self.base_model, path, adapter_name=name)
+        else:
+            self.model.load_adapter(path, adapter_name=name)
+        self.model.eval()
+        self.loads += 1
+        self.load_seconds += time.perf_counter() - start
+        logger.info(f"✅ Adapter '{name}' loaded from {path} in {time.perf_counter() - start:.1f}s")
+
+    def acquire(self, names):
+        """Load the adapters of `names` (at most `capacity` distinct) and return the model."""
+        names = set(names)
+        if len(names) > self.capacity:
+            raise ValueError(f"{len(names)} adapters requested, only {self.capacity} can be loaded")
+        for name in names:
+            if name not in self.loaded:
+                self._load(name)
+            with self.lock:
+                self.loaded[name] = True
+                self.loaded.move_to_end(name)
+        # Evicted after loading: PEFT needs at least one adapter left
+        while len(self.loaded) > self.capacity:
+            with self.lock:
+                victim = next(name for name in self.loaded if name not in names)
+            self.model.base_model.delete_adapter(victim)
+            with self.lock:
+                del self.loaded[victim]
+                self.evictions += 1
+            logger.info(f"♻️ Adapter '{victim}' evicted")
+        return self.model
+
+    def metrics(self):
+        with self.lock:
+            loaded = list(self.loaded)
+        return {
+            "loaded": loaded,
+            "capacity": self.capacity,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "load_seconds": round(self.load_seconds, 2),
+        }
+
+
+# Batched generation
+class BatchedGenerator:
+    """
+    Single worker thread owning the model: requests queued by the Flask threads
+    are grouped (up to `max_batch_size`, waiting at most `wait_ms` for more)
+    and generated together, each row with its own adapter.
+    """
+
+    def __init__(self, pool, tokenizer, max_batch_size=MAX_BATCH_SIZE, wait_ms=BATCH_WAIT_MS, **generate_kwargs):
+        self.pool = pool
+        self.tokenizer = tokenizer
+        self.max_batch_size = max(max_batch_size, 1)
+        self.wait = wait_ms / 1000
+        self.generate_kwargs = generate_kwargs
+        self.queue = queue.Queue()
+        self.pending = deque()
+        self.batches = 0
+        self.requests = 0
+        self.thread = threading.Thread(target=self._run, name="batched-generator", daemon=True)
+        self.thread.start()
+
+    def submit(self, prompt, adapter):
+        future = Future()
+        self.queue.put(GenerationRequest(prompt, adapter, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self.pending.popleft() if self.pending else self.queue.get()]
+        adapters = {batch[0].adapter}
+        deferred = []
+        deadline = time.monotonic() + self.wait
+        while len(batch) < self.max_batch_size:
+            if self.pending:
+                item = self.pending.popleft()
+            else:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            # More distinct adapters than the pool holds: next batch
+            if item.adapter not in adapters and len(adapters) >= self.pool.capacity:
+                deferred.append(item)
+                continue
+            adapters.add(item.adapter)
+            batch.append(item)
+        self.pending.extendleft(reversed(deferred))
+        return batch
+
+    def _generate(self, batch):
+        names = [item.adapter for item in batch]
+        model = self.pool.acquire(names)
+        inputs = self.tokenizer(
+            [item.prompt for item in batch], return_tensors="pt", padding=True, return_token_type_ids=False,
+        ).to(model.device)
+        kwargs = dict(self.generate_kwargs)
+        if len(set(names)) == 1:
+            model.set_adapter(names[0])
+        else:
+            kwargs["adapter_names"] = names
+        with torch.inference_mode():
+            generated = model.generate(**inputs, tokenizer=self.tokenizer, **kwargs)
+        # Left padding: every prompt ends at the same position
+        prompt_length = inputs["input_ids"].shape[1]
+        return [self.tokenizer.decode(row[prompt_length:], skip_special_tokens=True) for row in generated]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                outputs = self._generate(batch)
+            except Exception as e:
+                logger.error(f"❌ Batch generation failed: {str(e)}")
+                for item in batch:
+                    item.future.set_exception(e)
+                continue
+            self.batches += 1
+            self.requests += len(batch)
+            for item, output in zip(batch, outputs):
+                item.future.set_result(output)
+
+    def metrics(self):
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": round(self.requests / self.batches, 2) if self.batches else 0.0,
+            "queued": self.queue.qsize() + len(self.pending),
+        }
@@ -1,5 +1,6 @@
 
 import os
+import sys
 import json
 import uuid
 import logging
@@ -12,9 +13,14 @@ from pymongo.errors import ConnectionFailure, OperationFailure, DuplicateKeyErro
 import requests
 import jwt
 from clerk_backend_api import Clerk
-import torch
-from transformers import AutoTokenizer, TextStreamer, StoppingCriteria, StoppingCriteriaList
-from unsloth import FastLanguageModel
+
+# Prompt template shared with training (JudiciAIre Model/prompt_template.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "JudiciAIre Model"))
+from prompt_template import STOP_STRINGS, check_template_parity, extract_answer, format_prompt
+from adapter_serving import (
+    ADAPTERS_FILE, BASE_MODEL, BATCH_WAIT_MS, MAX_BATCH_SIZE, MAX_LOADED_ADAPTERS,
+    AdapterPool, BatchedGenerator, DomainRouter, load_adapter_specs, load_base_model,
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -74,60 +80,37 @@ except Exception as e:
     logger.error(f"❌ MongoDB setup error: {str(e)}")
     raise
 
-# Model loading
+# Model loading: one base model, one LoRA adapter per legal domain (adapters.json)
 try:
-    tokenizer = AutoTokenizer.from_pretrained("youssefELK/judiciaireModwanaLa")
-    model, _ = FastLanguageModel.from_pretrained("youssefELK/judiciaireModwanaLa")
-    model.eval()
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = model.to(device)
-    logger.info("✅ Model and tokenizer loaded successfully")
-except Exception as e:
-    logger.error(f"❌ Failed to load model or tokenizer: {str(e)}")
-    raise
-
-# Stopping criteria
-class StopAfterSourceSentence(StoppingCriteria):
-    def __init__(self, tokenizer):
-        self.tokenizer = tokenizer
-        self.triggered = False
-
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        decoded = self.tokenizer.decode(input_ids[0], skip_special_tokens=True)
-        if "Source:" in decoded and not self.triggered:
-            source_index = decoded.find("Source:")
-            after_source = decoded[source_index:]
-            if any(p in after_source for p in [".", "؟", "!", "\n"]):
-                self.triggered = True
-                return True
-        return False
-
-# Inference function
-def answer_question_stream(question: str) -> str:
-    prompt = (
-        "### Instruction :\n"
-        "Vous êtes un assistant juridique de loi marocainne. Répondez à la question suivante de manière claire, concise, "
-        "et uniquement en vous appuyant sur les textes de loi mentionnés.\n\n"
-        f"### Question :\n{question}\n\n"
-        "### Réponse :\n"
-    )
-
-    inputs = tokenizer(prompt, return_tensors="pt").to(device)
-    stopping_criteria = StoppingCriteriaList([StopAfterSourceSentence(tokenizer)])
-    streamer = TextStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
-
-    generated = model.generate(
-        **inputs,
+    domains, default_domain = load_adapter_specs(ADAPTERS_FILE, fallback_adapter=model_name)
+    base_model, tokenizer = load_base_model(BASE_MODEL)
+    check_template_parity(tokenizer)
+    adapter_pool = AdapterPool(base_model, domains, MAX_LOADED_ADAPTERS)
+    adapter_pool.acquire([default_domain])
+    domain_router = DomainRouter(domains, default_domain)
+    generator = BatchedGenerator(
+        adapter_pool,
+        tokenizer,
+        MAX_BATCH_SIZE,
+        BATCH_WAIT_MS,
         max_new_tokens=512,
         temperature=0.7,
         do_sample=True,
-        pad_token_id=tokenizer.eos_token_id,
-        streamer=streamer,
-        stopping_criteria=stopping_criteria
+        pad_token_id=tokenizer.pad_token_id,
+        stop_strings=STOP_STRINGS,
     )
+    logger.info(f"✅ Base model {BASE_MODEL} loaded, domains: {', '.join(domains)} (default: {default_domain})")
+except Exception as e:
+    logger.error(f"❌ Failed to load model or tokenizer: {str(e)}")
+    raise
 
-    output = tokenizer.decode(generated[0], skip_special_tokens=True)
-    return output.split("### Réponse :")[-1].strip()
+# Inference function
+def answer_question(question: str, domain: str = None):
+    # Same template as training: the model ends on its "Source:" line (EOS), and
+    # the stop string only guards against running on into a new turn.
+    domain = domain_router.route(question, domain)
+    generated = generator.submit(format_prompt(question), domain).result()
+    return extract_answer(generated), domain
 
 # Message standardization
 def standardize_messages(messages):
@@ -432,9 +415,10 @@ def chat():
             logger.error("❌ Missing input message")
             return jsonify({"error": "Missing input message"}), 400
 
-        response_text = answer_question_stream(message)
+        response_text, domain = answer_question(message, data.get("domain"))
         return jsonify({
             "response": response_text,
+            "domain": domain,
             "conversation_id": str(uuid.uuid4())
         })
     except Exception as e:
@@ -493,6 +477,8 @@ def health_check():
             "status": "healthy",
             "mongodb": "connected",
             "clerk": clerk_status,
+            "adapters": adapter_pool.metrics(),
+            "generation": generator.metrics(),
             "api_version": "1.0.0"
         }), 200
     except Exception as e:
@@ -1,7 +1,12 @@
+import os
+import sys
 import torch
 from unsloth import FastLanguageModel
 from transformers import AutoTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "JudiciAIre Model"))
+from prompt_template import STOP_STRINGS, extract_answer, format_prompt
+
 model_name = "ANASEEE/JudicIAreLLAMA"
 
 try:
@@ -20,15 +25,7 @@ except Exception as e:
     exit(1)
 
     
-prompt = """### Instruction :
-أنت مساعد قانوني متخصص في القانون المغربي.
-الجواب خاصو يكون واضح، قصير، وبالدارجة المغربية، ومرتكز فقط على القانون.
-
-### Question :
-شنو هي عقوبة السرقة فالقانون المغربي؟
-
-### Réponse :
-"""
+prompt = format_prompt("شنو هي عقوبة السرقة فالقانون المغربي؟")
 
 inputs = tokenizer(prompt, return_tensors="pt").to("cuda")
 outputs = model.generate(
@@ -38,6 +35,8 @@ outputs = model.generate(
     top_p=0.9,
     do_sample=True,
     eos_token_id=tokenizer.eos_token_id,
+    stop_strings=STOP_STRINGS,
+    tokenizer=tokenizer,
 )
-response = tokenizer.decode(outputs[0], skip_special_tokens=True)
+response = extract_answer(tokenizer.decode(outputs[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True))
 print("📤 Response:\n", response)
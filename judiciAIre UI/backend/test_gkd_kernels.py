@@ -0,0 +1,66 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("trl")
+from trl import GKDTrainer
+
+from unsloth_compiled_cache.UnslothGKDTrainer import chunked_generalized_jsd_loss
+
+# The chunked (optionally top-k) generalized JSD must give the loss and student-logits
+# gradient of GKDTrainer.generalized_jsd_loss on random logits (CPU), while keeping
+# fewer bytes for backward. Run with `pytest -s` to print the measured differences.
+
+BATCH, SEQ, VOCAB = 2, 64, 4096
+
+
+@pytest.fixture
+def logits():
+    generator = torch.Generator().manual_seed(0)
+    student_logits = torch.randn(BATCH, SEQ, VOCAB, generator=generator).requires_grad_()
+    teacher_logits = torch.randn(BATCH, SEQ, VOCAB, generator=generator)
+    labels = torch.randint(0, VOCAB, (BATCH, SEQ), generator=generator)
+    labels[:, : SEQ // 4] = -100
+    return student_logits, teacher_logits, labels
+
+
+def _run(loss_fn, student_logits, teacher_logits, labels, **kwargs):
+    # Bytes autograd keeps for backward, the input logits excluded
+    inputs = {student_logits.untyped_storage().data_ptr(), teacher_logits.untyped_storage().data_ptr()}
+    saved = {}
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in inputs:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+    student_logits.grad = None
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = loss_fn(student_logits, teacher_logits, labels=labels, beta=0.5, **kwargs)
+    loss.backward()
+    return loss.detach(), student_logits.grad.clone(), sum(saved.values())
+
+
+# top_k = VOCAB keeps every token: the remaining-mass bucket is empty and the loss is exact
+@pytest.mark.parametrize("top_k", [None, VOCAB])
+def test_chunked_jsd_matches_generalized_jsd_loss(logits, top_k):
+    full_loss, full_grad, full_bytes = _run(GKDTrainer.generalized_jsd_loss, *logits)
+    loss, grad, chunked_bytes = _run(chunked_generalized_jsd_loss, *logits, chunk_size=16, top_k=top_k)
+    loss_diff = float((loss - full_loss).abs())
+    grad_diff = float((grad - full_grad).abs().max() / full_grad.abs().max())
+    print(
+        f"\nchunked JSD (top_k={top_k}): loss diff {loss_diff:.2e}, max relative grad diff {grad_diff:.2e}, "
+        f"saved for backward {chunked_bytes} vs {full_bytes} bytes"
+    )
+    assert loss_diff < 1e-5
+    assert grad_diff < 1e-4
+    assert chunked_bytes < full_bytes
+
+
+def test_top_k_jsd_approaches_full_loss_on_peaked_teacher(logits):
+    student_logits, teacher_logits, labels = logits
+    # Most of the teacher mass on few tokens, as after training: a small k is nearly exact
+    teacher_logits = teacher_logits * 8
+    full_loss, _, _ = _run(GKDTrainer.generalized_jsd_loss, student_logits, teacher_logits, labels)
+    loss, _, _ = _run(chunked_generalized_jsd_loss, student_logits, teacher_logits, labels, chunk_size=16, top_k=64)
+    print(f"\ntop-64 JSD: {float(loss):.6f} vs full {float(full_loss):.6f}")
+    assert float(loss) <= float(full_loss) + 1e-6
+    assert float(loss) == pytest.approx(float(full_loss), rel=1e-2)
@@ -0,0 +1,59 @@
+import random
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("trl")
+from datasets import Dataset
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+# The fused ORPO / CPO paths (log probs, NLL and logits metrics from the final hidden
+# states) must log the same metrics as the full-logits TRL path on a tiny Llama (CPU).
+
+
+@pytest.fixture
+def tokenizer():
+    vocab = {chr(97 + i): i for i in range(26)}
+    vocab.update({"<pad>": 26, "<eos>": 27, "<bos>": 28})
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<pad>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<pad>", eos_token="<eos>", bos_token="<bos>")
+
+
+@pytest.fixture
+def dataset():
+    rng = random.Random(0)
+    words = lambda n: " ".join(rng.choice("abcdefghij") for _ in range(n))
+    return Dataset.from_list([
+        {"prompt": words(rng.randint(3, 9)), "chosen": words(rng.randint(1, 6)), "rejected": words(rng.randint(1, 6))}
+        for _ in range(8)
+    ])
+
+
+@pytest.mark.parametrize("name", ["ORPO", "CPO"])
+def test_fused_logps_metrics_match_full_logits(name, tokenizer, dataset, tmp_path):
+    __import__(f"unsloth_compiled_cache.Unsloth{name}Trainer")
+    module = sys.modules[f"unsloth_compiled_cache.Unsloth{name}Trainer"]
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(LlamaConfig(
+        vocab_size=29, hidden_size=32, intermediate_size=64, num_hidden_layers=1,
+        num_attention_heads=4, num_key_value_heads=2,
+    ))
+    args = getattr(module, f"Unsloth{name}Config")(
+        output_dir=str(tmp_path), per_device_train_batch_size=8, report_to=[], max_length=64,
+        max_prompt_length=32, optim="adamw_torch", remove_unused_columns=False,
+    )
+    trainer = getattr(module, f"_Unsloth{name}Trainer")(
+        model=model, args=args, train_dataset=dataset, processing_class=tokenizer,
+    )
+    batch = trainer._prepare_inputs(next(iter(trainer.get_train_dataloader())))
+
+    metrics = {}
+    for fused in (False, True):
+        trainer.args.fused_logps = fused
+        _, metrics[fused] = trainer.get_batch_loss_metrics(trainer.model, batch)
+    assert metrics[True].keys() == metrics[False].keys()
+    for key, value in metrics[False].items():
+        assert float(metrics[True][key]) == pytest.approx(float(value), rel=1e-4, abs=1e-6), key
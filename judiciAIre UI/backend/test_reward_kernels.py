@@ -0,0 +1,78 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("trl")
+from transformers import LlamaConfig, LlamaForSequenceClassification
+
+from unsloth_compiled_cache.UnslothRewardTrainer import pairwise_reward_loss, reward_pair_forward
+
+# The concatenated and shared-prefix reward forwards must give the loss and gradients
+# of the two-pass RewardTrainer forward on a tiny float32 Llama reward model (CPU).
+# Run with `pytest -s` to print the measured differences.
+
+PAD = 0
+PROMPT = 20
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=512, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, num_labels=1, pad_token_id=PAD,
+        attn_implementation="sdpa",
+    )
+    return LlamaForSequenceClassification(config)
+
+
+@pytest.fixture
+def inputs():
+    # Right-padded pairs sharing a 20-token prompt, as RewardDataCollatorWithPadding returns them
+    generator = torch.Generator().manual_seed(1)
+    def side(lengths):
+        input_ids = torch.full((len(lengths), PROMPT + max(lengths)), PAD)
+        attention_mask = torch.zeros_like(input_ids)
+        for b, n in enumerate(lengths):
+            input_ids[b, :PROMPT] = prompts[b]
+            input_ids[b, PROMPT:PROMPT + n] = torch.randint(1, 512, (n,), generator=generator)
+            attention_mask[b, :PROMPT + n] = 1
+        return input_ids, attention_mask
+    prompts = torch.randint(1, 512, (4, PROMPT), generator=generator)
+    input_ids_chosen, attention_mask_chosen = side([5, 9, 2, 7])
+    input_ids_rejected, attention_mask_rejected = side([8, 3, 6, 4])
+    return {
+        "input_ids_chosen": input_ids_chosen, "attention_mask_chosen": attention_mask_chosen,
+        "input_ids_rejected": input_ids_rejected, "attention_mask_rejected": attention_mask_rejected,
+    }
+
+
+def _loss_and_grads(model, inputs, mode):
+    model.zero_grad(set_to_none=True)
+    loss = pairwise_reward_loss(*reward_pair_forward(model, inputs, PAD, mode))
+    loss.backward()
+    grads = {name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None}
+    return loss.detach(), grads
+
+
+@pytest.mark.parametrize("mode", ["separate", "concatenated", "shared_prefix"])
+def test_reward_forward_matches_separate(model, inputs, mode):
+    reference_loss, reference_grads = _loss_and_grads(model, inputs, "separate")
+    loss, grads = _loss_and_grads(model, inputs, mode)
+    assert grads.keys() == reference_grads.keys()
+    loss_diff = float((loss - reference_loss).abs())
+    grad_diff = max(
+        float((grads[name] - g).abs().max() / g.abs().max().clamp(min=1e-12)) for name, g in reference_grads.items()
+    )
+    print(f"\n{mode}: loss diff {loss_diff:.2e}, max relative grad diff {grad_diff:.2e}")
+    assert loss_diff < 1e-5
+    assert grad_diff < 1e-4
+
+
+def test_shared_prefix_skips_prefix_forward_under_gradient_checkpointing(model, inputs):
+    model.gradient_checkpointing_enable()
+    model.train()
+    calls = []
+    model.register_forward_hook(lambda module, args, kwargs, output: calls.append(kwargs.get("input_ids").shape[0]), with_kwargs=True)
+    reward_pair_forward(model, inputs, PAD, "shared_prefix")
+    # A single concatenated forward over 2 * batch rows, no prompt-only forward first
+    assert calls == [8]
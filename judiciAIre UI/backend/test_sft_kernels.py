@@ -0,0 +1,128 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("trl")
+import torch.nn.functional as F
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from unsloth_compiled_cache.UnslothSFTTrainer import (
+    DataCollatorForPackedSequences, DataCollatorForPaddingFree, chunked_cross_entropy,
+)
+from unsloth_compiled_cache.unsloth_kernels import final_hidden_states
+
+# Loss / gradient parity of the SFT padding-free, packing and chunked cross-entropy
+# paths against the plain padded forward, on a tiny float32 Llama (CPU).
+# Run with `pytest -s` to print the measured differences.
+
+LENGTHS = [7, 12, 3, 9, 5]
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=4096, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, attn_implementation="sdpa",
+    )
+    return LlamaForCausalLM(config)
+
+
+@pytest.fixture
+def features():
+    generator = torch.Generator().manual_seed(1)
+    return [{"input_ids": torch.randint(1, 4096, (n,), generator=generator).tolist()} for n in LENGTHS]
+
+
+def _loss_and_grads(model, **inputs):
+    model.zero_grad(set_to_none=True)
+    loss = model(**inputs).loss
+    loss.backward()
+    grads = {name: p.grad.clone() for name, p in model.named_parameters()}
+    return loss.detach(), grads
+
+
+def _padded_loss_and_grads(model, features):
+    max_len = max(LENGTHS)
+    input_ids = torch.zeros((len(features), max_len), dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    labels = torch.full_like(input_ids, -100)
+    for b, f in enumerate(features):
+        n = len(f["input_ids"])
+        input_ids[b, :n] = labels[b, :n] = torch.as_tensor(f["input_ids"])
+        attention_mask[b, :n] = 1
+    return _loss_and_grads(model, input_ids=input_ids, attention_mask=attention_mask, labels=labels)
+
+
+def _max_grad_diff(grads, reference):
+    return max(float((grads[name] - g).abs().max() / g.abs().max().clamp(min=1e-12)) for name, g in reference.items())
+
+
+def test_padding_free_matches_padded_batch(model, features):
+    reference_loss, reference_grads = _padded_loss_and_grads(model, features)
+    batch = DataCollatorForPaddingFree(return_4d_mask=True, return_flash_attn_kwargs=False)(features)
+    loss, grads = _loss_and_grads(
+        model, input_ids=batch["input_ids"], attention_mask=batch["attention_mask"],
+        position_ids=batch["position_ids"], labels=batch["labels"],
+    )
+    loss_diff, grad_diff = float((loss - reference_loss).abs()), _max_grad_diff(grads, reference_grads)
+    print(f"\npadding-free: loss diff {loss_diff:.2e}, max relative grad diff {grad_diff:.2e}")
+    assert loss_diff < 1e-5
+    assert grad_diff < 1e-4
+
+
+def test_packed_rows_match_padded_batch(model, features):
+    reference_loss, reference_grads = _padded_loss_and_grads(model, features)
+    rows = [features[:2], features[2:]]
+    packed = [
+        {"input_ids": [t for f in row for t in f["input_ids"]],
+         "position_ids": [p for f in row for p in range(len(f["input_ids"]))]}
+        for row in rows
+    ]
+    batch = DataCollatorForPackedSequences()(packed)
+    loss, grads = _loss_and_grads(model, **batch)
+    loss_diff, grad_diff = float((loss - reference_loss).abs()), _max_grad_diff(grads, reference_grads)
+    print(f"\npacking: loss diff {loss_diff:.2e}, max relative grad diff {grad_diff:.2e}")
+    assert loss_diff < 1e-5
+    assert grad_diff < 1e-4
+
+
+@pytest.mark.parametrize("n_chunks", [1, 4, 7, -1])
+def test_chunked_cross_entropy_matches_full_logits(model, n_chunks):
+    torch.manual_seed(2)
+    input_ids = torch.randint(0, 4096, (4, 33))
+    labels = input_ids.clone()
+    labels[:, :5] = -100
+    lm_head = model.get_output_embeddings().weight
+    parameter_storages = {p.untyped_storage().data_ptr() for p in model.parameters()}
+
+    def run(chunked):
+        # Bytes autograd keeps for backward, parameters excluded: the saved-logits spike
+        saved = {}
+        def pack(tensor):
+            storage = tensor.untyped_storage()
+            if storage.data_ptr() not in parameter_storages:
+                saved[storage.data_ptr()] = storage.nbytes()
+            return tensor
+        model.zero_grad(set_to_none=True)
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            if chunked:
+                with final_hidden_states(model) as captured:
+                    model(input_ids=input_ids, logits_to_keep=1)
+                loss = chunked_cross_entropy(captured[-1], lm_head, labels, n_chunks=n_chunks)
+            else:
+                logits = model(input_ids=input_ids).logits[:, :-1].float()
+                loss = F.cross_entropy(logits.flatten(0, 1), labels[:, 1:].flatten(), ignore_index=-100)
+        loss.backward()
+        grads = {name: p.grad.clone() for name, p in model.named_parameters()}
+        return loss.detach(), grads, sum(saved.values())
+
+    full_loss, full_grads, full_bytes = run(chunked=False)
+    loss, grads, chunked_bytes = run(chunked=True)
+    loss_diff, grad_diff = float((loss - full_loss).abs()), _max_grad_diff(grads, full_grads)
+    print(
+        f"\nchunked cross-entropy (n_chunks={n_chunks}): loss diff {loss_diff:.2e}, "
+        f"max relative grad diff {grad_diff:.2e}, saved for backward {chunked_bytes} vs {full_bytes} bytes"
+    )
+    assert loss_diff < 1e-5
+    assert grad_diff < 1e-4
+    assert chunked_bytes < full_bytes
@@ -13,6 +13,9 @@ from trl.trainer.bco_trainer import (Any, AutoModelForCausalLM, BCOConfig, BCOTr
 
 
 import os
+import json
+import hashlib
+import functools
 from typing import *
 from dataclasses import dataclass, field
 from packaging.version import Version
@@ -21,24 +24,128 @@ import numpy as np
 from contextlib import nullcontext
 from torch.nn import functional as F
 from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling
+try:
+    from .unsloth_kernels import torch_compile_options, selective_log_softmax
+except ImportError:
+    from unsloth_kernels import torch_compile_options, selective_log_softmax
+
+PROMPT_KEY_BYTES = 16
+
+def prompt_embedding_key(input_ids):
+    # Row ID of a prompt in the embedding store: a hash of the token ids the embedding
+    # model sees, so it survives the dataset shuffle and map() re-runs
+    return hashlib.sha256(np.asarray(input_ids, dtype = np.int64).tobytes()).digest()[:PROMPT_KEY_BYTES]
+
+def _find_module(obj, depth = 0):
+    # The nn.Module behind an embedding function: itself, a bound method's owner, a
+    # functools.partial argument, or a closure variable
+    if isinstance(obj, nn.Module): return obj
+    if obj is None or depth > 2: return None
+    candidates = [getattr(obj, "__self__", None)]
+    if isinstance(obj, functools.partial):
+        candidates += [obj.func, *obj.args, *obj.keywords.values()]
+    for cell in getattr(obj, "__closure__", None) or ():
+        try: candidates.append(cell.cell_contents)
+        except ValueError: pass
+    for candidate in candidates:
+        module = _find_module(candidate, depth + 1)
+        if module is not None: return module
+    return None
+
+def embedding_model_hash(embedding_func, embedding_tokenizer, sample = 1024):
+    # Fingerprint of the embedding model (weights sampled like the DPO reference hash),
+    # the function wrapping it and its tokenizer. None when no model can be found
+    # behind embedding_func: the store is then not used rather than risk a stale hit.
+    module = _find_module(embedding_func)
+    if module is None: return None
+    digest = hashlib.sha256()
+    func = embedding_func.func if isinstance(embedding_func, functools.partial) else embedding_func
+    digest.update(f"{getattr(func, '__qualname__', type(func).__name__)}|{getattr(embedding_tokenizer, 'name_or_path', '')}".encode())
+    digest.update(f"{len(embedding_tokenizer)}|{embedding_tokenizer.pad_token_id}".encode())
+    for name, tensor in module.state_dict().items():
+        digest.update(f"{name}|{tuple(tensor.shape)}|{tensor.dtype}".encode())
+        if tensor.is_meta or tensor.numel() == 0: continue
+        flat = tensor.detach().reshape(-1)
+        values = flat[::max(1, flat.numel() // sample)][:sample].contiguous().cpu()
+        digest.update(values.view(torch.uint8).numpy().tobytes())
+    pass
+    return digest.hexdigest()
+
+class PromptEmbeddingStore:
+    # Persistent prompt embeddings of one embedding model for BCO's density ratio
+    # classifier. Rows live in a preallocated float32 buffer memory-mapped from disk,
+    # grown by doubling (never by concatenation), next to their PROMPT_KEY_BYTES keys.
+    # meta.json holds the committed row count and is replaced atomically once the rows
+    # are flushed, so an interrupted append only leaves unused capacity behind.
+    def __init__(self, path):
+        self.path = path
+        self.count, self.dim, self.capacity = 0, None, 0
+        self.embeddings = self.keys = None
+        self.index = {}
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding = "utf-8") as f:
+                meta = json.load(f)
+            self.count, self.dim, self.capacity = meta["count"], meta["dim"], meta["capacity"]
+            self._map()
+            self.index = {bytes(key): row for row, key in enumerate(self.keys[: self.count])}
+    pass
+
+    def __len__(self):
+        return self.count
+
+    def _map(self):
+        self.embeddings = np.memmap(
+            os.path.join(self.path, "embeddings.f32"), dtype = np.float32, mode = "r+", shape = (self.capacity, self.dim),
+        )
+        self.keys = np.memmap(
+            os.path.join(self.path, "keys.u8"), dtype = np.uint8, mode = "r+", shape = (self.capacity, PROMPT_KEY_BYTES),
+        )
 
-torch_compile_options = {
-    "epilogue_fusion"   : True,
-    "max_autotune"      : False,
-    "shape_padding"     : True,
-    "trace.enabled"     : False,
-    "triton.cudagraphs" : False,
-}
-
-@torch.compile(dynamic = True, fullgraph = True, options = torch_compile_options,)
-def selective_log_softmax(logits, index):
-    logits = logits.to(torch.float32)
-    selected_logits = torch.gather(logits, dim = -1, index = index.unsqueeze(-1)).squeeze(-1)
-    # loop to reduce peak mem consumption
-    # logsumexp_values = torch.stack([torch.logsumexp(lg, dim=-1) for lg in logits])
-    logsumexp_values = torch.logsumexp(logits, dim = -1)
-    per_token_logps = selected_logits - logsumexp_values  # log_softmax(x_i) = x_i - logsumexp(x)
-    return per_token_logps
+    def _reserve(self, n):
+        if self.count + n <= self.capacity: return
+        capacity = max(2 * self.capacity, self.count + n, 1024)
+        os.makedirs(self.path, exist_ok = True)
+        for name, row_bytes in (("embeddings.f32", 4 * self.dim), ("keys.u8", PROMPT_KEY_BYTES)):
+            with open(os.path.join(self.path, name), "ab") as f:
+                f.truncate(capacity * row_bytes)
+        pass
+        self.capacity = capacity
+        self._map()
+
+    def lookup(self, keys):
+        # Row of each key, -1 when missing
+        return np.fromiter((self.index.get(key, -1) for key in keys), dtype = np.int64, count = len(keys))
+
+    def get(self, rows):
+        return np.asarray(self.embeddings[rows])
+
+    def append(self, keys, embeddings):
+        new = {}
+        for i, key in enumerate(keys):
+            if key not in self.index: new.setdefault(key, i)
+        if not new: return
+        embeddings = np.asarray(embeddings, dtype = np.float32)
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(f"Unsloth: prompt embeddings of size {embeddings.shape[1]} do not match the store's {self.dim}.")
+        self._reserve(len(new))
+
+        rows = slice(self.count, self.count + len(new))
+        self.embeddings[rows] = embeddings[list(new.values())]
+        self.keys[rows] = np.frombuffer(b"".join(new.keys()), dtype = np.uint8).reshape(-1, PROMPT_KEY_BYTES)
+        self.embeddings.flush()
+        self.keys.flush()
+        for row, key in enumerate(new, start = self.count):
+            self.index[key] = row
+        self.count += len(new)
+
+        tmp_path = os.path.join(self.path, f"meta.json.tmp-{os.getpid()}")
+        with open(tmp_path, "w", encoding = "utf-8") as f:
+            json.dump({"count" : self.count, "dim" : self.dim, "capacity" : self.capacity}, f)
+        os.replace(tmp_path, os.path.join(self.path, "meta.json"))
+pass
 @dataclass
 class UnslothBCOConfig(BCOConfig):
     """
@@ -103,6 +210,10 @@ class UnslothBCOConfig(BCOConfig):
         default = -1,
         metadata = {'help': 'Chunk size to reduce memory usage. -1 is most efficient.'},
     )
+    prompt_embedding_cache_dir : Optional[str] = field(
+        default = 'prompt_embeddings_cache',
+        metadata = {'help': 'Where prompt embeddings for the density ratio classifier are kept across runs, per embedding model. None disables the store.'},
+    )
     def __init__(
         self,
         output_dir = None,
@@ -251,6 +362,7 @@ class UnslothBCOConfig(BCOConfig):
         max_density_ratio = 10.0,
         vllm_sampling_params = None,
         unsloth_num_chunks = -1,
+        prompt_embedding_cache_dir = 'prompt_embeddings_cache',
         **kwargs,
     ):
         if learning_rate < 1e-7: raise FloatingPointError(f'Unsloth: Your learning rate of `{learning_rate}` is too small and less than 1e-7! Consider increasing it, otherwise gradient updates will be close to 0!')
@@ -409,6 +521,7 @@ class UnslothBCOConfig(BCOConfig):
             max_density_ratio = max_density_ratio,**kwargs)
         self.vllm_sampling_params = vllm_sampling_params
         self.unsloth_num_chunks = unsloth_num_chunks
+        self.prompt_embedding_cache_dir = prompt_embedding_cache_dir
 pass
 
 class _UnslothBCOTrainer(Trainer):
@@ -903,32 +1016,72 @@ class _UnslothBCOTrainer(Trainer):
         Used for density ratio classifier training.
         """
         n_samples = min(len(dataset), sample_size)
-        rand_indices = np.random.choice(len(dataset), size=(n_samples,))
-
-        embedding_dataset = dataset.select(rand_indices)
-
-        dataloader_params = {
-            "batch_size": self.args.per_device_train_batch_size,
-            "collate_fn": self.data_collator,
-            "num_workers": self.args.dataloader_num_workers,
-            "pin_memory": self.args.dataloader_pin_memory,
-            "shuffle": False,
-        }
-
-        # prepare dataloader
-        data_loader = self.accelerator.prepare(DataLoader(embedding_dataset, **dataloader_params))
+        # Seeded and without replacement: every run draws the same rows, which the store already holds
+        rand_indices = np.sort(np.random.default_rng(self.args.seed).choice(len(dataset), size=n_samples, replace=False))
+        keys = [prompt_embedding_key(ids) for ids in dataset.select(rand_indices)["embedding_input_ids"]]
+
+        store = self._prompt_embedding_store()
+        rows = store.lookup(keys) if store is not None else np.full(n_samples, -1, dtype=np.int64)
+        missing = np.flatnonzero(rows < 0)
+        if len(missing) < n_samples:
+            print(f"Unsloth: Reusing {n_samples - len(missing)} of {n_samples} prompt embeddings from {store.path}")
+
+        new_embeddings = None
+        if len(missing) > 0:
+            dataloader_params = {
+                "batch_size": self.args.per_device_train_batch_size,
+                "collate_fn": self.data_collator,
+                "num_workers": self.args.dataloader_num_workers,
+                "pin_memory": self.args.dataloader_pin_memory,
+                "shuffle": False,
+            }
 
-        with torch.no_grad():
-            all_embeddings = torch.empty(0)
-            for padded_batch in tqdm(iterable=data_loader, desc="Building sample prompt embeddings"):
-                embeddings = self._vectorize_prompt(
-                    input_ids=padded_batch["embedding_input_ids"],
-                    attention_mask=padded_batch["embedding_attention_mask"],
-                )
-                embeddings = self.accelerator.gather_for_metrics(embeddings)
-                all_embeddings = torch.cat((all_embeddings, embeddings.cpu()))
+            # prepare dataloader
+            data_loader = self.accelerator.prepare(DataLoader(dataset.select(rand_indices[missing]), **dataloader_params))
 
-        return all_embeddings
+            with torch.no_grad():
+                filled = 0
+                for padded_batch in tqdm(iterable=data_loader, desc="Building sample prompt embeddings"):
+                    embeddings = self._vectorize_prompt(
+                        input_ids=padded_batch["embedding_input_ids"],
+                        attention_mask=padded_batch["embedding_attention_mask"],
+                    )
+                    embeddings = self.accelerator.gather_for_metrics(embeddings).float().cpu().numpy()
+                    if new_embeddings is None:
+                        # Preallocated once the embedding size is known, filled batch by batch
+                        new_embeddings = np.empty((len(missing), embeddings.shape[1]), dtype=np.float32)
+                    new_embeddings[filled : filled + len(embeddings)] = embeddings
+                    filled += len(embeddings)
+
+            if store is not None:
+                if self.accelerator.is_main_process:
+                    store.append([keys[i] for i in missing], new_embeddings)
+                # Every process must see the same rows on the next lookup, or their dataloaders would differ
+                self.accelerator.wait_for_everyone()
+                if not self.accelerator.is_main_process:
+                    self._embedding_store = PromptEmbeddingStore(store.path)
+
+        dim = new_embeddings.shape[1] if new_embeddings is not None else store.dim
+        all_embeddings = np.empty((n_samples, dim), dtype=np.float32)
+        found = np.flatnonzero(rows >= 0)
+        if len(found) > 0:
+            all_embeddings[found] = store.get(rows[found])
+        if new_embeddings is not None:
+            all_embeddings[missing] = new_embeddings
+        return torch.from_numpy(all_embeddings)
+
+    def _prompt_embedding_store(self) -> Optional[PromptEmbeddingStore]:
+        """The store of the current embedding model, or None when disabled or the model cannot be fingerprinted."""
+        if getattr(self, "_embedding_store", None) is not None:
+            return self._embedding_store
+        cache_dir = getattr(self.args, "prompt_embedding_cache_dir", None)
+        if not cache_dir:
+            return None
+        model_hash = embedding_model_hash(self.embedding_func, self.embedding_tokenizer)
+        if model_hash is None:
+            return None
+        self._embedding_store = PromptEmbeddingStore(os.path.join(cache_dir, model_hash[:24]))
+        return self._embedding_store
 
     def _prepare_deepspeed(self, model: PreTrainedModelWrapper):
         # Adapted from accelerate: https://github.com/huggingface/accelerate/blob/739b135f8367becb67ffaada12fe76e3aa60fefd/src/accelerate/accelerator.py#L1473
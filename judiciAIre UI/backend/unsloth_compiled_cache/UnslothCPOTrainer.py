@@ -21,24 +21,11 @@ import numpy as np
 from contextlib import nullcontext
 from torch.nn import functional as F
 from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling
+try:
+    from .unsloth_kernels import torch_compile_options, selective_log_softmax, fused_logps_and_nll, mean_logits, final_hidden_states
+except ImportError:
+    from unsloth_kernels import torch_compile_options, selective_log_softmax, fused_logps_and_nll, mean_logits, final_hidden_states
 
-torch_compile_options = {
-    "epilogue_fusion"   : True,
-    "max_autotune"      : False,
-    "shape_padding"     : True,
-    "trace.enabled"     : False,
-    "triton.cudagraphs" : False,
-}
-
-@torch.compile(dynamic = True, fullgraph = True, options = torch_compile_options,)
-def selective_log_softmax(logits, index):
-    logits = logits.to(torch.float32)
-    selected_logits = torch.gather(logits, dim = -1, index = index.unsqueeze(-1)).squeeze(-1)
-    # loop to reduce peak mem consumption
-    # logsumexp_values = torch.stack([torch.logsumexp(lg, dim=-1) for lg in logits])
-    logsumexp_values = torch.logsumexp(logits, dim = -1)
-    per_token_logps = selected_logits - logsumexp_values  # log_softmax(x_i) = x_i - logsumexp(x)
-    return per_token_logps
 @dataclass
 class UnslothCPOConfig(CPOConfig):
     """
@@ -108,6 +95,10 @@ class UnslothCPOConfig(CPOConfig):
         default = -1,
         metadata = {'help': 'Chunk size to reduce memory usage. -1 is most efficient.'},
     )
+    fused_logps : Optional[bool] = field(
+        default = True,
+        metadata = {'help': 'Compute log probs and the NLL loss chunk by chunk from the final hidden states instead of materializing the full logits. Falls back to full logits when the LM head cannot be fused.'},
+    )
     def __init__(
         self,
         output_dir = None,
@@ -255,6 +246,7 @@ class UnslothCPOConfig(CPOConfig):
         dataset_num_proc = None,
         vllm_sampling_params = None,
         unsloth_num_chunks = -1,
+        fused_logps = True,
         **kwargs,
     ):
         if learning_rate < 1e-7: raise FloatingPointError(f'Unsloth: Your learning rate of `{learning_rate}` is too small and less than 1e-7! Consider increasing it, otherwise gradient updates will be close to 0!')
@@ -412,6 +404,7 @@ class UnslothCPOConfig(CPOConfig):
             dataset_num_proc = dataset_num_proc,**kwargs)
         self.vllm_sampling_params = vllm_sampling_params
         self.unsloth_num_chunks = unsloth_num_chunks
+        self.fused_logps = fused_logps
 pass
 
 class _UnslothCPOTrainer(Trainer):
@@ -1029,12 +1022,32 @@ class _UnslothCPOTrainer(Trainer):
         else:
             return (per_token_logps * loss_mask).sum(-1)
 
+    def _fusable_lm_head(self, model):
+        # LM head weight when concatenated_forward may skip the logits, else None (encoder-decoder,
+        # bias, LoRA on lm_head, logit soft-capping / scaling)
+        if not getattr(self.args, "fused_logps", False) or self.is_encoder_decoder: return None
+        unwrapped = self.accelerator.unwrap_model(model)
+        lm_head = unwrapped.get_output_embeddings()
+        config = getattr(unwrapped, "config", None)
+        if type(lm_head) is not nn.Linear or lm_head.bias is not None: return None
+        if getattr(config, "final_logit_softcapping", None) or getattr(config, "logit_scale", None): return None
+        return lm_head.weight
+
+    def _metric_positions(self, all_outputs, len_chosen):
+        # Chosen / rejected positions behind the logits/* metrics, sliced the same way from the logits
+        # and, on the fused path, from the hidden states. CPO keeps every position, unlike ORPO.
+        return all_outputs[:len_chosen], all_outputs[len_chosen:]
+
     def concatenated_forward(
-        self, model: nn.Module, batch: dict[str, Union[list, torch.LongTensor]]
+        self, model: nn.Module, batch: dict[str, Union[list, torch.LongTensor]], return_logits: bool = False
     ) -> tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
         """Run the given model on the given batch of inputs, concatenating the chosen and rejected inputs together.
 
         We do this to avoid doing two forward passes, because it's faster for FSDP.
+
+        Unless `return_logits` is set, the logits are not materialized when the LM head can be fused: the log probs
+        and the NLL loss come from the final hidden states chunk by chunk, and the two logits outputs are the
+        per-sequence mean logits (all the metrics use).
         """
         concatenated_batch = self.concatenated_inputs(
             batch,
@@ -1056,12 +1069,40 @@ class _UnslothCPOTrainer(Trainer):
         if self.aux_loss_enabled:
             model_kwargs["output_router_logits"] = True
 
-        outputs = model(
-            concatenated_batch["concatenated_input_ids"],
-            attention_mask=concatenated_batch["concatenated_attention_mask"],
-            use_cache=False,
-            **model_kwargs,
-        )
+        lm_head = None if return_logits else self._fusable_lm_head(model)
+        capture = nullcontext()
+        if lm_head is not None:
+            # Only the final hidden states are kept, the LM head projects a single position
+            capture = final_hidden_states(self.accelerator.unwrap_model(model))
+            model_kwargs["logits_to_keep"] = 1
+
+        with capture as captured:
+            outputs = model(
+                concatenated_batch["concatenated_input_ids"],
+                attention_mask=concatenated_batch["concatenated_attention_mask"],
+                use_cache=False,
+                **model_kwargs,
+            )
+
+        if lm_head is not None:
+            hidden_states = captured[-1]
+            nll_labels = concatenated_batch["concatenated_labels"].clone()
+            nll_labels[len_chosen if self.cpo_alpha != 0 else 0 :] = -100
+            all_logps, nll_loss = fused_logps_and_nll(
+                hidden_states,
+                lm_head,
+                concatenated_batch["concatenated_labels"],
+                nll_labels,
+                average_log_prob=self.loss_type in ["ipo", "simpo"],
+                label_pad_token_id=self.label_pad_token_id,
+                n_chunks=self.args.unsloth_num_chunks,
+            )
+            if self.cpo_alpha == 0:
+                nll_loss = torch.tensor(0.0).to(self.accelerator.device)
+            chosen_hidden, rejected_hidden = self._metric_positions(hidden_states, len_chosen)
+            output = (all_logps[:len_chosen], all_logps[len_chosen:], mean_logits(chosen_hidden, lm_head), mean_logits(rejected_hidden, lm_head), nll_loss)
+            return output + (outputs.aux_loss,) if self.aux_loss_enabled else output
+
         all_logits = outputs.logits
 
         def cross_entropy_loss(logits, labels):
@@ -1096,8 +1137,7 @@ class _UnslothCPOTrainer(Trainer):
         chosen_logps = all_logps[:len_chosen]
         rejected_logps = all_logps[len_chosen:]
 
-        chosen_logits = all_logits[:len_chosen]
-        rejected_logits = all_logits[len_chosen:]
+        chosen_logits, rejected_logits = self._metric_positions(all_logits, len_chosen)
 
         if self.aux_loss_enabled:
             return (chosen_logps, rejected_logps, chosen_logits, rejected_logits, nll_loss, outputs.aux_loss)
@@ -13,6 +13,7 @@ from trl.trainer.dpo_trainer import (Any, AutoModelForCausalLM, BaseImageProcess
 
 
 import os
+import hashlib
 from typing import *
 from dataclasses import dataclass, field
 from packaging.version import Version
@@ -21,24 +22,35 @@ import numpy as np
 from contextlib import nullcontext
 from torch.nn import functional as F
 from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling
-
-torch_compile_options = {
-    "epilogue_fusion"   : True,
-    "max_autotune"      : False,
-    "shape_padding"     : True,
-    "trace.enabled"     : False,
-    "triton.cudagraphs" : False,
-}
-
-@torch.compile(dynamic = True, fullgraph = True, options = torch_compile_options,)
-def selective_log_softmax(logits, index):
-    logits = logits.to(torch.float32)
-    selected_logits = torch.gather(logits, dim = -1, index = index.unsqueeze(-1)).squeeze(-1)
-    # loop to reduce peak mem consumption
-    # logsumexp_values = torch.stack([torch.logsumexp(lg, dim=-1) for lg in logits])
-    logsumexp_values = torch.logsumexp(logits, dim = -1)
-    per_token_logps = selected_logits - logsumexp_values  # log_softmax(x_i) = x_i - logsumexp(x)
-    return per_token_logps
+try:
+    from .unsloth_kernels import torch_compile_options, selective_log_softmax
+except ImportError:
+    from unsloth_kernels import torch_compile_options, selective_log_softmax
+
+# shared_prompt_forward is only kept after matching concatenated_forward on a
+# training batch: logps within SHARED_PROMPT_RTOL and parameter gradients within
+# SHARED_PROMPT_GRAD_RTOL of the largest gradient
+SHARED_PROMPT_RTOL = 1e-3
+SHARED_PROMPT_GRAD_RTOL = 1e-2
+
+def _max_relative_diff(a, b):
+    return float((a.float() - b.float()).abs().max() / b.float().abs().max().clamp(min = 1e-8))
+
+def reference_model_hash(model, base_only = False, adapter_name = None, sample = 1024):
+    # Cheap fingerprint of the weights a reference pass runs with: name, shape, dtype
+    # and a strided sample of every tensor. With base_only (a PEFT model acting as its
+    # own reference), LoRA weights are skipped unless they belong to adapter_name.
+    digest = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        if base_only and "lora_" in name and (adapter_name is None or f".{adapter_name}." not in name):
+            continue
+        digest.update(f"{name}|{tuple(tensor.shape)}|{tensor.dtype}".encode())
+        if tensor.is_meta or tensor.numel() == 0: continue
+        flat = tensor.detach().reshape(-1)
+        values = flat[::max(1, flat.numel() // sample)][:sample].contiguous().cpu()
+        digest.update(values.view(torch.uint8).numpy().tobytes())
+    pass
+    return digest.hexdigest()
 @dataclass
 class UnslothDPOConfig(DPOConfig):
     """
@@ -181,6 +193,14 @@ class UnslothDPOConfig(DPOConfig):
         default = -1,
         metadata = {'help': 'Chunk size to reduce memory usage. -1 is most efficient.'},
     )
+    ref_log_probs_cache_dir : Optional[str] = field(
+        default = 'ref_logps_cache',
+        metadata = {'help': 'Where precomputed reference log probs are kept across runs. None disables the cache.'},
+    )
+    shared_prompt_forward : Optional[bool] = field(
+        default = False,
+        metadata = {'help': 'Encode each prompt once and run chosen/rejected on its KV cache instead of duplicating it. Checked against the concatenated forward (logps and gradients) on the first training batch and switched off with a warning if they differ.'},
+    )
     def __init__(
         self,
         output_dir = None,
@@ -343,6 +363,8 @@ class UnslothDPOConfig(DPOConfig):
         use_num_logits_to_keep = False,
         vllm_sampling_params = None,
         unsloth_num_chunks = -1,
+        ref_log_probs_cache_dir = 'ref_logps_cache',
+        shared_prompt_forward = False,
         **kwargs,
     ):
         if learning_rate < 1e-7: raise FloatingPointError(f'Unsloth: Your learning rate of `{learning_rate}` is too small and less than 1e-7! Consider increasing it, otherwise gradient updates will be close to 0!')
@@ -515,12 +537,15 @@ class UnslothDPOConfig(DPOConfig):
             use_num_logits_to_keep = use_num_logits_to_keep,**kwargs)
         self.vllm_sampling_params = vllm_sampling_params
         self.unsloth_num_chunks = unsloth_num_chunks
+        self.ref_log_probs_cache_dir = ref_log_probs_cache_dir
+        self.shared_prompt_forward = shared_prompt_forward
 pass
 
 class _UnslothDPOTrainer(Trainer):
     r""""""
 
     _tag_names = ["trl", "dpo"]
+    _shared_prompt_ok = None
 
     @deprecate_kwarg(
         "tokenizer", "0.16.0", "processing_class", warn_if_greater_or_equal_version=True, raise_if_both_names=True
@@ -1052,39 +1077,9 @@ class _UnslothDPOTrainer(Trainer):
 
         if self.precompute_ref_log_probs and not self._precomputed_train_ref_log_probs:
             batch_size = self.args.precompute_ref_batch_size or self.args.per_device_train_batch_size
-            dataloader_params = {
-                "batch_size": batch_size,
-                "collate_fn": self.data_collator,
-                "num_workers": self.args.dataloader_num_workers,
-                "pin_memory": self.args.dataloader_pin_memory,
-                "shuffle": False,
-            }
-
-            # prepare dataloader
-            data_loader = self.accelerator.prepare(DataLoader(self.train_dataset, **dataloader_params))
-
-            ref_chosen_logps = []
-            ref_rejected_logps = []
-            for padded_batch in tqdm(iterable=data_loader, desc="Train dataset reference log probs"):
-                ref_chosen_logp, ref_rejected_logp = self.compute_ref_log_probs(padded_batch)
-                ref_chosen_logp, ref_rejected_logp = self.accelerator.gather_for_metrics(
-                    (ref_chosen_logp, ref_rejected_logp)
-                )
-                ref_chosen_logps.append(ref_chosen_logp.cpu())
-                ref_rejected_logps.append(ref_rejected_logp.cpu())
-
-                # Unnecessary cache clearing to avoid OOM
-                empty_cache()
-                self.accelerator.free_memory()
-
-            all_ref_chosen_logps = torch.cat(ref_chosen_logps).float().numpy()
-            all_ref_rejected_logps = torch.cat(ref_rejected_logps).float().numpy()
-
-            self.train_dataset = self.train_dataset.add_column(name="ref_chosen_logps", column=all_ref_chosen_logps)
-            self.train_dataset = self.train_dataset.add_column(
-                name="ref_rejected_logps", column=all_ref_rejected_logps
+            self.train_dataset = self._add_ref_log_probs(
+                self.train_dataset, batch_size, desc="Train dataset reference log probs"
             )
-
             self._precomputed_train_ref_log_probs = True
 
         return super().get_train_dataloader()
@@ -1106,32 +1101,7 @@ class _UnslothDPOTrainer(Trainer):
 
         if self.precompute_ref_log_probs and not self._precomputed_eval_ref_log_probs:
             batch_size = self.args.precompute_ref_batch_size or self.args.per_device_eval_batch_size
-            dataloader_params = {
-                "batch_size": batch_size,
-                "collate_fn": self.data_collator,
-                "num_workers": self.args.dataloader_num_workers,
-                "pin_memory": self.args.dataloader_pin_memory,
-                "shuffle": False,
-            }
-
-            # prepare dataloader
-            data_loader = self.accelerator.prepare(DataLoader(eval_dataset, **dataloader_params))
-
-            ref_chosen_logps = []
-            ref_rejected_logps = []
-            for padded_batch in tqdm(iterable=data_loader, desc="Eval dataset reference log probs"):
-                ref_chosen_logp, ref_rejected_logp = self.compute_ref_log_probs(padded_batch)
-                ref_chosen_logp, ref_rejected_logp = self.accelerator.gather_for_metrics(
-                    (ref_chosen_logp, ref_rejected_logp)
-                )
-                ref_chosen_logps.append(ref_chosen_logp.cpu())
-                ref_rejected_logps.append(ref_rejected_logp.cpu())
-
-            all_ref_chosen_logps = torch.cat(ref_chosen_logps).float().numpy()
-            all_ref_rejected_logps = torch.cat(ref_rejected_logps).float().numpy()
-
-            eval_dataset = eval_dataset.add_column(name="ref_chosen_logps", column=all_ref_chosen_logps)
-            eval_dataset = eval_dataset.add_column(name="ref_rejected_logps", column=all_ref_rejected_logps)
+            eval_dataset = self._add_ref_log_probs(eval_dataset, batch_size, desc="Eval dataset reference log probs")
 
             # Save calculated ref_chosen_logps and ref_rejected_logps to the eval_dataset for subsequent runs
             if self.eval_dataset is not None:
@@ -1140,6 +1110,80 @@ class _UnslothDPOTrainer(Trainer):
 
         return super().get_eval_dataloader(eval_dataset=eval_dataset)
 
+    def _ref_log_probs_cache_path(self, dataset) -> Optional[str]:
+        """
+        One cache file per reference weights, tokenized dataset and the settings that change the reference
+        log probs (truncation and IPO's length normalization). Runs that only change `beta` or another loss type
+        reuse it.
+        """
+        cache_dir = getattr(self.args, "ref_log_probs_cache_dir", None)
+        fingerprint = getattr(dataset, "_fingerprint", None)
+        if not cache_dir or fingerprint is None:
+            return None
+        if self.ref_model is not None:
+            model_hash = reference_model_hash(self.accelerator.unwrap_model(self.ref_model))
+        else:
+            model_hash = reference_model_hash(
+                self.accelerator.unwrap_model(self.model), base_only=self.is_peft_model, adapter_name=self.ref_adapter_name
+            )
+        key = "|".join(
+            [model_hash, fingerprint, str(self.max_length), self.truncation_mode, str(self.loss_type == "ipo")]
+        )
+        return os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest()[:24] + ".npy")
+
+    def _add_ref_log_probs(self, dataset: Dataset, batch_size: int, desc: str) -> Dataset:
+        """Adds `ref_chosen_logps` / `ref_rejected_logps` columns, from the disk cache when available."""
+        cache_path = self._ref_log_probs_cache_path(dataset)
+        if cache_path is not None and os.path.exists(cache_path):
+            ref_logps = np.load(cache_path)
+            print(f"Unsloth: Loaded reference log probs for {len(ref_logps)} examples from {cache_path}")
+        else:
+            # Longest pairs first: each batch holds similar lengths, so little padding, and the first batch sets
+            # the memory peak, so there is no need to empty the CUDA cache after every batch.
+            lengths = np.fromiter(
+                (
+                    len(prompt) + max(len(chosen), len(rejected))
+                    for prompt, chosen, rejected in zip(
+                        dataset["prompt_input_ids"], dataset["chosen_input_ids"], dataset["rejected_input_ids"]
+                    )
+                ),
+                dtype=np.int64,
+                count=len(dataset),
+            )
+            order = np.argsort(-lengths, kind="stable")
+            data_loader = self.accelerator.prepare(
+                DataLoader(
+                    dataset,
+                    batch_size=batch_size,
+                    sampler=order.tolist(),
+                    collate_fn=self.data_collator,
+                    num_workers=self.args.dataloader_num_workers,
+                    pin_memory=self.args.dataloader_pin_memory,
+                )
+            )
+
+            sorted_logps = []
+            for padded_batch in tqdm(iterable=data_loader, desc=desc):
+                ref_chosen_logp, ref_rejected_logp = self.compute_ref_log_probs(padded_batch)
+                ref_chosen_logp, ref_rejected_logp = self.accelerator.gather_for_metrics(
+                    (ref_chosen_logp, ref_rejected_logp)
+                )
+                sorted_logps.append(torch.stack((ref_chosen_logp, ref_rejected_logp), dim=1).float().cpu())
+
+            sorted_logps = torch.cat(sorted_logps).numpy()
+            ref_logps = np.empty_like(sorted_logps)
+            ref_logps[order] = sorted_logps
+
+            if cache_path is not None and self.accelerator.is_main_process:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                tmp_path = f"{cache_path[:-4]}.tmp-{os.getpid()}.npy"
+                np.save(tmp_path, ref_logps)
+                os.replace(tmp_path, cache_path)
+
+        dataset = dataset.add_column(name="ref_chosen_logps", column=ref_logps[:, 0])
+        dataset = dataset.add_column(name="ref_rejected_logps", column=ref_logps[:, 1])
+        return dataset
+
     @contextmanager
     def null_ref_context(self):
         """Context manager for handling null reference model (that is, peft adapter manipulation)."""
@@ -1428,6 +1472,14 @@ class _UnslothDPOTrainer(Trainer):
 
         We do this to avoid doing two forward passes, because it's faster for FSDP.
         """
+        if getattr(self.args, "shared_prompt_forward", False) and not self.is_encoder_decoder:
+            if self._shared_prompt_ok is None and torch.is_grad_enabled():
+                self._shared_prompt_ok = self.check_shared_prompt_forward(model, batch)
+            if self._shared_prompt_ok:
+                output = self.shared_prompt_forward(model, batch)
+                if output is not None:
+                    return output
+
         num_examples = batch["prompt_input_ids"].shape[0]
 
         concatenated_batch = self.concatenated_inputs(batch, padding_value=self.padding_value)
@@ -1599,6 +1651,135 @@ class _UnslothDPOTrainer(Trainer):
 
         return output
 
+    def _needs_truncation(self, batch):
+        if self.max_length is None:
+            return False
+        prompt_lengths = batch["prompt_attention_mask"].sum(1)
+        completion_lengths = torch.maximum(batch["chosen_attention_mask"].sum(1), batch["rejected_attention_mask"].sum(1))
+        return bool((prompt_lengths + completion_lengths).max() > self.max_length)
+
+    def shared_prompt_forward(self, model: nn.Module, batch: dict[str, Union[list, torch.LongTensor]]):
+        """
+        Same outputs as `concatenated_forward`, but the prompt is encoded once and the chosen and rejected
+        completions each run on top of its KV cache, padded only to their own max length. For long prompts with
+        short completions this removes about half of the tokens processed per pair.
+
+        Returns `None` (fall back to the concatenated path) when the pair would need truncation, with images,
+        router logits or padding-free batches, and when the model returns no cache (e.g. gradient checkpointing
+        switches `use_cache` off during training).
+        """
+        if self.padding_free or self.aux_loss_enabled or "pixel_values" in batch:
+            return None
+        if self._needs_truncation(batch):
+            return None
+        prompt_attention_mask = batch["prompt_attention_mask"]
+        prompt_lengths = prompt_attention_mask.sum(1)
+
+        # Prompts are left-padded by the collator, so the last position holds the logit that predicts the
+        # first completion token.
+        prompt_outputs = model(
+            input_ids=batch["prompt_input_ids"],
+            attention_mask=prompt_attention_mask,
+            position_ids=(prompt_attention_mask.cumsum(1) - 1).clamp(min=0),
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        prompt_cache = prompt_outputs.past_key_values
+        if prompt_cache is None:
+            return None
+        last_prompt_logits = prompt_outputs.logits[:, -1:]
+        prompt_length = prompt_attention_mask.shape[1]
+
+        output = {}
+        for side in ("chosen", "rejected"):
+            input_ids = batch[f"{side}_input_ids"]
+            attention_mask = batch[f"{side}_attention_mask"]
+            outputs = model(
+                input_ids=input_ids,
+                attention_mask=torch.cat((prompt_attention_mask, attention_mask), dim=1),
+                position_ids=prompt_lengths.unsqueeze(1) + torch.arange(input_ids.shape[1], device=input_ids.device),
+                past_key_values=prompt_cache,
+                use_cache=True,
+            )
+            if hasattr(prompt_cache, "crop"):
+                # A Cache object grows in place: drop this completion before running the other one
+                prompt_cache.crop(prompt_length)
+
+            logits = torch.cat((last_prompt_logits, outputs.logits[:, :-1]), dim=1)
+            loss_mask = attention_mask.bool()
+            labels = input_ids.masked_fill(~loss_mask, 0)  # dummy token; ignored below
+            per_token_logps = selective_log_softmax(logits, labels).masked_fill(~loss_mask, 0)
+            logps = per_token_logps.sum(-1)
+            if self.loss_type == "ipo":
+                logps = logps / loss_mask.sum(-1)
+            output[f"{side}_logps"] = logps
+            output[f"mean_{side}_logits"] = logits[loss_mask].mean()
+
+            if self.use_weighting:
+                with torch.no_grad():
+                    # Eq (2) of the WPO paper, as in concatenated_forward
+                    weights_adjustment_factor = torch.logsumexp(2 * F.log_softmax(logits, dim=-1), dim=-1)
+                    per_token_logps_adjusted = per_token_logps - weights_adjustment_factor
+                    output[f"{side}_weights"] = (per_token_logps_adjusted * loss_mask).sum(-1) / loss_mask.sum(-1)
+            if side == "chosen" and self.args.rpo_alpha is not None:
+                output["nll_loss"] = F.cross_entropy(
+                    torch.flatten(logits, end_dim=1), torch.flatten(labels, end_dim=1), ignore_index=0
+                )
+
+        if self.use_weighting:
+            chosen_weights, rejected_weights = output.pop("chosen_weights"), output.pop("rejected_weights")
+            output["policy_weights"] = torch.clamp(torch.exp(chosen_weights + rejected_weights), max=1)
+        return output
+
+    def check_shared_prompt_forward(self, model: nn.Module, batch: dict[str, Union[list, torch.LongTensor]]):
+        """
+        Compare `shared_prompt_forward` with the concatenated path on `batch`: logps and the gradients of the
+        trainable parameters. Returns True when they match, False when they differ or the model cannot continue
+        from a prompt cache with gradients (e.g. gradient checkpointing, patched forwards), and None when this
+        batch cannot tell (the shared path would fall back anyway), so the next batch is checked instead.
+        """
+        if self.padding_free or self.aux_loss_enabled or "pixel_values" in batch:
+            return False
+        if self._needs_truncation(batch):
+            return None
+        parameters = [p for p in model.parameters() if p.requires_grad]
+        try:
+            shared = self.shared_prompt_forward(model, batch)
+            if shared is None:
+                warnings.warn("Unsloth: shared_prompt_forward disabled, the model returns no KV cache during training.")
+                return False
+            shared_logps = torch.cat((shared["chosen_logps"], shared["rejected_logps"]))
+            shared_grads = torch.autograd.grad(shared_logps.sum(), parameters, allow_unused = True)
+        except Exception as e:
+            warnings.warn(f"Unsloth: shared_prompt_forward disabled, the model failed on a cached prompt: {e}")
+            return False
+        # Reference: concatenated_forward with the shared path switched off
+        self._shared_prompt_ok = False
+        try:
+            reference = self.concatenated_forward(model, batch)
+            reference_logps = torch.cat((reference["chosen_logps"], reference["rejected_logps"]))
+            reference_grads = torch.autograd.grad(reference_logps.sum(), parameters, allow_unused = True)
+        except Exception as e:
+            warnings.warn(f"Unsloth: shared_prompt_forward disabled, the reference forward cannot be differentiated: {e}")
+            return False
+        finally:
+            self._shared_prompt_ok = None
+
+        logps_diff = _max_relative_diff(shared_logps.detach(), reference_logps.detach())
+        grad_diff = max(
+            [_max_relative_diff(a, b) for a, b in zip(shared_grads, reference_grads) if a is not None and b is not None],
+            default = 0.0,
+        )
+        if any((a is None) != (b is None) for a, b in zip(shared_grads, reference_grads)):
+            grad_diff = float("inf")
+        ok = logps_diff <= SHARED_PROMPT_RTOL and grad_diff <= SHARED_PROMPT_GRAD_RTOL
+        if not ok:
+            warnings.warn(
+                f"Unsloth: shared_prompt_forward disabled, it does not match the concatenated forward "
+                f"(logps relative diff {logps_diff:.2e}, gradient relative diff {grad_diff:.2e})."
+            )
+        return ok
+
     def get_batch_loss_metrics(
         self,
         model,
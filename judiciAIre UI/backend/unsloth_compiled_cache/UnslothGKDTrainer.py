@@ -8,6 +8,7 @@ __UNSLOTH_VERSIONING__
 from torch import Tensor
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from torch.nn import functional as F
 from trl.trainer.gkd_trainer import (Any, AutoModelForCausalLM, BaseImageProcessor, Callable, DataCollator, DataCollatorForChatML, Dataset, EvalPrediction, F, FeatureExtractionMixin, GKDConfig, GKDTrainer, GenerationConfig, Optional, PeftConfig, PreTrainedModel, PreTrainedModelWrapper, PreTrainedTokenizerBase, ProcessorMixin, SFTTrainer, TrainerCallback, Union, deepcopy, disable_dropout_in_model, empty_cache, generate_model_card, get_comet_experiment_url, is_wandb_available, nn, os, random, textwrap, torch, unwrap_model_for_generation)
 
@@ -21,24 +22,86 @@ import numpy as np
 from contextlib import nullcontext
 from torch.nn import functional as F
 from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling
+try:
+    from .unsloth_kernels import torch_compile_options, selective_log_softmax
+except ImportError:
+    from unsloth_kernels import torch_compile_options, selective_log_softmax
+
+JSD_CHUNK_SIZE = 1024
+
+def teacher_top_k(teacher_logits, top_k, temperature = 1.0, chunk_size = JSD_CHUNK_SIZE):
+    # (log_probs, indices) of the teacher's top-k tokens, each shaped (batch, seq, k).
+    # The log probs are normalized over the full vocabulary, so the remaining mass
+    # stays known once the full logits are freed.
+    log_probs, indices = [], []
+    for logits in teacher_logits.split(chunk_size, dim = 1):
+        logits = logits.to(torch.float32) / temperature
+        values, index = logits.topk(top_k, dim = -1)
+        log_probs.append(values - torch.logsumexp(logits, dim = -1, keepdim = True))
+        indices.append(index)
+    pass
+    return torch.cat(log_probs, dim = 1), torch.cat(indices, dim = 1)
+
+def _with_rest(log_probs):
+    # Append one bucket holding 1 - sum(p) to top-k log probs
+    rest = -torch.expm1(torch.logsumexp(log_probs, dim = -1, keepdim = True))
+    return torch.cat([log_probs, torch.log(rest.clamp(min = 1e-20))], dim = -1)
+
+def _jsd_chunk(student_logits, teacher, batch_index, seq_index, beta, temperature):
+    # Per-position generalized JSD of the gathered rows, in float32
+    student_log_probs = F.log_softmax(student_logits[batch_index, seq_index].to(torch.float32) / temperature, dim = -1)
+    if isinstance(teacher, tuple):
+        teacher_log_probs, indices = teacher[0][batch_index, seq_index], teacher[1][batch_index, seq_index]
+        student_log_probs = _with_rest(student_log_probs.gather(-1, indices))
+        teacher_log_probs = _with_rest(teacher_log_probs.to(torch.float32))
+    else:
+        teacher_log_probs = F.log_softmax(teacher[batch_index, seq_index].to(torch.float32) / temperature, dim = -1)
+    pass
+    beta = torch.tensor(beta, dtype = torch.float32, device = student_log_probs.device)
+    mixture_log_probs = torch.logaddexp(student_log_probs + torch.log(beta), teacher_log_probs + torch.log(1 - beta))
+    kl_teacher = (teacher_log_probs.exp() * (teacher_log_probs - mixture_log_probs)).sum(-1)
+    kl_student = (student_log_probs.exp() * (student_log_probs - mixture_log_probs)).sum(-1)
+    return beta * kl_teacher + (1 - beta) * kl_student
+
+def chunked_generalized_jsd_loss(
+    student_logits, teacher_logits, labels = None, beta = 0.5, temperature = 1.0, reduction = "batchmean",
+    chunk_size = JSD_CHUNK_SIZE, top_k = None,
+):
+    # Same loss as GKDTrainer.generalized_jsd_loss, computed over `chunk_size` unmasked
+    # positions at a time: the (positions, vocab) log-softmaxes, mixture and KL terms
+    # only ever exist for one chunk, and each chunk is recomputed in backward instead
+    # of being kept. `reduction = "none"` returns one value per position, not per
+    # vocabulary entry.
+    #
+    # With `top_k`, both distributions are restricted to the teacher's top-k tokens plus
+    # one bucket for the remaining mass (a lower bound, exact as k reaches the vocab).
+    # `teacher_logits` may then already be the `teacher_top_k` pair.
+    if top_k is not None and not isinstance(teacher_logits, tuple):
+        teacher_logits = teacher_top_k(teacher_logits, top_k, temperature, chunk_size)
+    if labels is not None:
+        batch_index, seq_index = (labels != -100).nonzero(as_tuple = True)
+    else:
+        batch_index, seq_index = torch.ones(student_logits.shape[:2], dtype = torch.bool, device = student_logits.device).nonzero(as_tuple = True)
+    pass
+    jsd = []
+    for b, t in zip(batch_index.split(chunk_size), seq_index.split(chunk_size)):
+        if torch.is_grad_enabled() and student_logits.requires_grad:
+            jsd.append(torch.utils.checkpoint.checkpoint(
+                _jsd_chunk, student_logits, teacher_logits, b, t, beta, temperature, use_reentrant = False,
+            ))
+        else:
+            jsd.append(_jsd_chunk(student_logits, teacher_logits, b, t, beta, temperature))
+    pass
+    jsd = torch.cat(jsd) if jsd else student_logits.new_zeros(0, dtype = torch.float32)
+
+    if reduction == "batchmean":
+        return jsd.sum() / max(jsd.numel(), 1)
+    elif reduction == "sum":
+        return jsd.sum()
+    elif reduction == "mean":
+        return jsd.sum() / max(jsd.numel() * student_logits.shape[-1], 1)
+    return jsd
 
-torch_compile_options = {
-    "epilogue_fusion"   : True,
-    "max_autotune"      : False,
-    "shape_padding"     : True,
-    "trace.enabled"     : False,
-    "triton.cudagraphs" : False,
-}
-
-@torch.compile(dynamic = True, fullgraph = True, options = torch_compile_options,)
-def selective_log_softmax(logits, index):
-    logits = logits.to(torch.float32)
-    selected_logits = torch.gather(logits, dim = -1, index = index.unsqueeze(-1)).squeeze(-1)
-    # loop to reduce peak mem consumption
-    # logsumexp_values = torch.stack([torch.logsumexp(lg, dim=-1) for lg in logits])
-    logsumexp_values = torch.logsumexp(logits, dim = -1)
-    per_token_logps = selected_logits - logsumexp_values  # log_softmax(x_i) = x_i - logsumexp(x)
-    return per_token_logps
 @dataclass
 class UnslothGKDConfig(GKDConfig):
     """
@@ -77,6 +140,14 @@ class UnslothGKDConfig(GKDConfig):
         default = -1,
         metadata = {'help': 'Chunk size to reduce memory usage. -1 is most efficient.'},
     )
+    jsd_chunk_size : Optional[int] = field(
+        default = 1024,
+        metadata = {'help': 'Token positions per chunk of the generalized JSD loss. None computes it over the full logits at once.'},
+    )
+    jsd_top_k : Optional[int] = field(
+        default = None,
+        metadata = {'help': "Keep only the teacher's top-k logits (plus one bucket for the rest) in the JSD loss. None uses the full vocabulary."},
+    )
     def __init__(
         self,
         output_dir = None,
@@ -227,6 +298,8 @@ class UnslothGKDConfig(GKDConfig):
         seq_kd = False,
         vllm_sampling_params = None,
         unsloth_num_chunks = -1,
+        jsd_chunk_size = 1024,
+        jsd_top_k = None,
         **kwargs,
     ):
         if learning_rate < 1e-7: raise FloatingPointError(f'Unsloth: Your learning rate of `{learning_rate}` is too small and less than 1e-7! Consider increasing it, otherwise gradient updates will be close to 0!')
@@ -387,6 +460,8 @@ class UnslothGKDConfig(GKDConfig):
             seq_kd = seq_kd,**kwargs)
         self.vllm_sampling_params = vllm_sampling_params
         self.unsloth_num_chunks = unsloth_num_chunks
+        self.jsd_chunk_size = jsd_chunk_size
+        self.jsd_top_k = jsd_top_k
 pass
 
 class _UnslothGKDTrainer(SFTTrainer):
@@ -549,33 +624,50 @@ class _UnslothGKDTrainer(SFTTrainer):
             return jsd
 
     def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
-        # compute student output
-        outputs_student = model(
-            input_ids=inputs["input_ids"],
-            attention_mask=inputs["attention_mask"],
-        )
+        chunk_size = getattr(self.args, "jsd_chunk_size", None)
+        top_k = getattr(self.args, "jsd_top_k", None)
+        prompt_lengths = inputs["prompts"].shape[1]
 
-        # compute teacher output in eval mode
+        # compute teacher output in eval mode, first: with top_k only its (batch, seq, k)
+        # top-k survives, so the full teacher logits never coexist with the student graph
         self.teacher_model.eval()
         with torch.no_grad():
             outputs_teacher = self.teacher_model(
                 input_ids=inputs["input_ids"],
                 attention_mask=inputs["attention_mask"],
             )
+            shifted_teacher_logits = outputs_teacher.logits[:, prompt_lengths - 1 : -1, :]
+            if top_k:
+                shifted_teacher_logits = teacher_top_k(shifted_teacher_logits, top_k, chunk_size=chunk_size or JSD_CHUNK_SIZE)
+                del outputs_teacher
+
+        # compute student output
+        outputs_student = model(
+            input_ids=inputs["input_ids"],
+            attention_mask=inputs["attention_mask"],
+        )
 
         # slice the logits for the generated tokens using the inputs["prompts"] lengths
-        prompt_lengths = inputs["prompts"].shape[1]
         shifted_student_logits = outputs_student.logits[:, prompt_lengths - 1 : -1, :]
-        shifted_teacher_logits = outputs_teacher.logits[:, prompt_lengths - 1 : -1, :]
         shifted_labels = inputs["labels"][:, prompt_lengths:]
 
         # compute loss
-        loss = self.generalized_jsd_loss(
-            student_logits=shifted_student_logits,
-            teacher_logits=shifted_teacher_logits,
-            labels=shifted_labels,
-            beta=self.beta,
-        )
+        if chunk_size or top_k:
+            loss = chunked_generalized_jsd_loss(
+                student_logits=shifted_student_logits,
+                teacher_logits=shifted_teacher_logits,
+                labels=shifted_labels,
+                beta=self.beta,
+                chunk_size=chunk_size or JSD_CHUNK_SIZE,
+                top_k=top_k,
+            )
+        else:
+            loss = self.generalized_jsd_loss(
+                student_logits=shifted_student_logits,
+                teacher_logits=shifted_teacher_logits,
+                labels=shifted_labels,
+                beta=self.beta,
+            )
 
         # empty cache
         empty_cache()
@@ -21,24 +21,14 @@ import numpy as np
 from contextlib import nullcontext
 from torch.nn import functional as F
 from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling
-
-torch_compile_options = {
-    "epilogue_fusion"   : True,
-    "max_autotune"      : False,
-    "shape_padding"     : True,
-    "trace.enabled"     : False,
-    "triton.cudagraphs" : False,
-}
-
-@torch.compile(dynamic = True, fullgraph = True, options = torch_compile_options,)
-def selective_log_softmax(logits, index):
-    logits = logits.to(torch.float32)
-    selected_logits = torch.gather(logits, dim = -1, index = index.unsqueeze(-1)).squeeze(-1)
-    # loop to reduce peak mem consumption
-    # logsumexp_values = torch.stack([torch.logsumexp(lg, dim=-1) for lg in logits])
-    logsumexp_values = torch.logsumexp(logits, dim = -1)
-    per_token_logps = selected_logits - logsumexp_values  # log_softmax(x_i) = x_i - logsumexp(x)
-    return per_token_logps
+try:
+    from .unsloth_compile_manager import compile_manager
+except ImportError:
+    from unsloth_compile_manager import compile_manager
+try:
+    from .unsloth_kernels import torch_compile_options, selective_log_softmax, vLLMSamplingParams, final_hidden_states
+except ImportError:
+    from unsloth_kernels import torch_compile_options, selective_log_softmax, vLLMSamplingParams, final_hidden_states
 
 def grpo_compute_loss(old_logits, new_logits, input_ids, mask, beta, advantages):
     # All Unsloth Zoo code licensed under LGPLv3
@@ -168,6 +158,42 @@ class UnslothEfficientGRPO(torch.autograd.Function):
         return (grad_input, None, None, None, None, None, None, None, None,)
     pass
 
+GRPO_MEMORY_FRACTION = 0.5 # share of the measured headroom the chunked loss may use
+GRPO_BYTES_PER_LOGIT = 16  # new + old float32 logits and the gradient buffers built from them
+
+def memory_headroom(device):
+    # Bytes that can still be allocated on `device` right now, None if unknown.
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def grpo_auto_n_chunks(trainer, bsz, seq_len, vocab_size, device, n_chunks = -1):
+    # Number of row chunks for UnslothEfficientGRPO, always a divisor of bsz.
+    # n_chunks > 0 is taken as is (closest divisor above). -1 sizes chunks so their
+    # logits fit in the measured headroom; the choice is cached per shape so the
+    # compiled chunk kernel keeps seeing the same chunk size.
+    factors = [i for i in range(1, bsz + 1) if bsz % i == 0]
+    closest_factor = lambda n: factors[min(np.searchsorted(factors, n), len(factors)-1)]
+    if n_chunks is not None and n_chunks > 0: return closest_factor(n_chunks)
+
+    cache = trainer.__dict__.setdefault("_grpo_n_chunks", {})
+    key = (bsz, seq_len, vocab_size, str(device))
+    if key not in cache:
+        headroom = memory_headroom(device)
+        if headroom is None:
+            wanted = bsz
+        else:
+            bytes_per_row = GRPO_BYTES_PER_LOGIT * seq_len * vocab_size
+            rows_per_chunk = max(1, int(headroom * GRPO_MEMORY_FRACTION) // bytes_per_row)
+            wanted = -(-bsz // rows_per_chunk)
+        cache[key] = closest_factor(wanted)
+    pass
+    return cache[key]
+
 def grpo_accumulated_loss(
     trainer,
     input_ids,
@@ -175,26 +201,30 @@ def grpo_accumulated_loss(
     completion_mask,
     advantages,
     n_chunks = -1,
+    attention_mask = None,
 ):
     # All Unsloth Zoo code licensed under LGPLv3
     bsz, qlen = input_ids.shape
-    # Find closest multiple
-    factors = [i for i in range(1, bsz + 1) if bsz % i == 0]
-    if n_chunks == -1: n_chunks = bsz
-    n_chunks = factors[min(np.searchsorted(factors, n_chunks), len(factors)-1)]
 
     mixed_dtype = torch.float16 if os.environ.get('ACCELERATE_MIXED_PRECISION', 'fp16') == 'fp16' else torch.bfloat16
-    os.environ["UNSLOTH_RETURN_HIDDEN_STATES"] = "1"
 
     completion_input_ids = input_ids[:, -logits_to_keep:]
     lm_head = trainer.model.get_output_embeddings().weight
 
     with torch.amp.autocast(device_type = "cuda", dtype = mixed_dtype):
         with torch.inference_mode(), trainer.accelerator.unwrap_model(trainer.model, keep_fp32_wrapper = False).disable_adapter():
-            old_hidden_states = trainer.model(input_ids = input_ids, logits_to_keep = logits_to_keep + 1).logits
+            old_hidden_states = trainer._get_per_token_logps(
+                trainer.model, input_ids, attention_mask, logits_to_keep, hidden_states = True,
+            )
         pass
 
-        new_hidden_states = trainer.model(input_ids = input_ids, logits_to_keep = logits_to_keep + 1).logits
+        new_hidden_states = trainer._get_per_token_logps(
+            trainer.model, input_ids, attention_mask, logits_to_keep, hidden_states = True,
+        )
+        # Measured after both forwards, i.e. with their activations already allocated
+        n_chunks = grpo_auto_n_chunks(
+            trainer, bsz, logits_to_keep + 1, lm_head.shape[0], new_hidden_states.device, n_chunks,
+        )
         
         loss, completion_length, mean_kl = UnslothEfficientGRPO.apply(
             new_hidden_states, old_hidden_states, lm_head,
@@ -215,7 +245,7 @@ def grpo_accumulated_loss(
         return loss, completion_length, mean_kl
     pass
 
-@torch.compile(dynamic = True, fullgraph = True, options = torch_compile_options)
+@compile_manager.compile(fullgraph = True, options = torch_compile_options, bucket = {0: -2, 1: -2, 2: -1, 3: -1})
 def grpo_compute_loss_slow(old_logits, new_logits, input_ids, mask, beta, advantages):
     # All Unsloth Zoo code licensed under LGPLv3
     old_logits = old_logits.to(torch.float32)
@@ -257,11 +287,6 @@ def grpo_compute_loss_slow(old_logits, new_logits, input_ids, mask, beta, advant
     pass
     return loss, completion_length, mean_kl
 
-def vLLMSamplingParams(**kwargs):
-    from vllm import SamplingParams
-    sampling_params = SamplingParams(**kwargs)
-    sampling_params._set_kwargs = kwargs
-    return sampling_params
 @dataclass
 class UnslothGRPOConfig(GRPOConfig):
     """
@@ -361,7 +386,7 @@ class UnslothGRPOConfig(GRPOConfig):
     )
     unsloth_num_chunks : Optional[int] = field(
         default = -1,
-        metadata = {'help': 'Chunk size to reduce memory usage. -1 is most efficient.'},
+        metadata = {'help': 'Number of chunks for the loss to reduce memory usage. -1 picks it from free memory.'},
     )
     def __init__(
         self,
@@ -903,14 +928,21 @@ class _UnslothGRPOTrainer(Trainer):
         return RepeatRandomSampler(eval_dataset, self.num_generations, seed=self.args.seed)
 
     # Get the per-token log probabilities for the completions for the model and the reference model
-    def _get_per_token_logps(self, model, input_ids, attention_mask, logits_to_keep):
-        if os.environ.get('UNSLOTH_USE_NEW_MODEL', '0') == '0':
+    # With hidden_states = True, the final hidden states of the last logits_to_keep + 1 positions instead
+    # (what UnslothEfficientGRPO projects chunk by chunk), through the same model call.
+    def _get_per_token_logps(self, model, input_ids, attention_mask, logits_to_keep, hidden_states = False):
+        if not hidden_states and os.environ.get('UNSLOTH_USE_NEW_MODEL', '0') == '0':
             return None # Unsloth efficient GRPO
         # Otherwise, calculate normally:
         if not hasattr(self, '_autocast_dtype'):
             self._autocast_dtype = torch.float16 if os.environ.get('ACCELERATE_MIXED_PRECISION', 'fp16') == 'fp16' else torch.bfloat16
             if os.environ.get('UNSLOTH_FORCE_FLOAT32', '0') == '1': self._autocast_dtype = torch.float16
         with torch.amp.autocast(device_type = 'cuda', dtype = self._autocast_dtype):
+            if hidden_states:
+                # Only the last position goes through the LM head here
+                with final_hidden_states(self.accelerator.unwrap_model(model)) as captured:
+                    model(input_ids = input_ids, attention_mask = attention_mask, logits_to_keep = 1)
+                return captured[-1][:, -(logits_to_keep + 1):]
             # We add 1 to `logits_to_keep` because the last logits of the sequence is later excluded
             logits = model(input_ids=input_ids, attention_mask=attention_mask, logits_to_keep=logits_to_keep + 1).logits
             logits = logits[:, :-1, :]  # (B, L-1, V), exclude the last logit: it corresponds to the next token pred
@@ -1132,6 +1164,7 @@ class _UnslothGRPOTrainer(Trainer):
             loss, completion_length, mean_kl = grpo_accumulated_loss(
                 self, _input_ids, logits_to_keep, completion_mask, advantages,
                 n_chunks = self.args.unsloth_num_chunks,
+                attention_mask = attention_mask,
             )
 
         # Log the metrics
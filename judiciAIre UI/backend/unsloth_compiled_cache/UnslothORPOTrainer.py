@@ -21,24 +21,11 @@ import numpy as np
 from contextlib import nullcontext
 from torch.nn import functional as F
 from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling
+try:
+    from .unsloth_kernels import torch_compile_options, selective_log_softmax, fused_logps_and_nll, mean_logits, final_hidden_states
+except ImportError:
+    from unsloth_kernels import torch_compile_options, selective_log_softmax, fused_logps_and_nll, mean_logits, final_hidden_states
 
-torch_compile_options = {
-    "epilogue_fusion"   : True,
-    "max_autotune"      : False,
-    "shape_padding"     : True,
-    "trace.enabled"     : False,
-    "triton.cudagraphs" : False,
-}
-
-@torch.compile(dynamic = True, fullgraph = True, options = torch_compile_options,)
-def selective_log_softmax(logits, index):
-    logits = logits.to(torch.float32)
-    selected_logits = torch.gather(logits, dim = -1, index = index.unsqueeze(-1)).squeeze(-1)
-    # loop to reduce peak mem consumption
-    # logsumexp_values = torch.stack([torch.logsumexp(lg, dim=-1) for lg in logits])
-    logsumexp_values = torch.logsumexp(logits, dim = -1)
-    per_token_logps = selected_logits - logsumexp_values  # log_softmax(x_i) = x_i - logsumexp(x)
-    return per_token_logps
 @dataclass
 class UnslothORPOConfig(ORPOConfig):
     """
@@ -93,6 +80,10 @@ class UnslothORPOConfig(ORPOConfig):
         default = -1,
         metadata = {'help': 'Chunk size to reduce memory usage. -1 is most efficient.'},
     )
+    fused_logps : Optional[bool] = field(
+        default = True,
+        metadata = {'help': 'Compute log probs and the NLL loss chunk by chunk from the final hidden states instead of materializing the full logits. Falls back to full logits when the LM head cannot be fused.'},
+    )
     def __init__(
         self,
         output_dir = None,
@@ -236,6 +227,7 @@ class UnslothORPOConfig(ORPOConfig):
         dataset_num_proc = None,
         vllm_sampling_params = None,
         unsloth_num_chunks = -1,
+        fused_logps = True,
         **kwargs,
     ):
         if learning_rate < 1e-7: raise FloatingPointError(f'Unsloth: Your learning rate of `{learning_rate}` is too small and less than 1e-7! Consider increasing it, otherwise gradient updates will be close to 0!')
@@ -389,6 +381,7 @@ class UnslothORPOConfig(ORPOConfig):
             dataset_num_proc = dataset_num_proc,**kwargs)
         self.vllm_sampling_params = vllm_sampling_params
         self.unsloth_num_chunks = unsloth_num_chunks
+        self.fused_logps = fused_logps
 pass
 
 class _UnslothORPOTrainer(Trainer):
@@ -1003,12 +996,34 @@ class _UnslothORPOTrainer(Trainer):
         else:
             return (per_token_logps * loss_mask).sum(-1)
 
+    def _fusable_lm_head(self, model):
+        # LM head weight when concatenated_forward may skip the logits, else None (encoder-decoder,
+        # bias, LoRA on lm_head, logit soft-capping / scaling)
+        if not getattr(self.args, "fused_logps", False) or self.is_encoder_decoder: return None
+        unwrapped = self.accelerator.unwrap_model(model)
+        lm_head = unwrapped.get_output_embeddings()
+        config = getattr(unwrapped, "config", None)
+        if type(lm_head) is not nn.Linear or lm_head.bias is not None: return None
+        if getattr(config, "final_logit_softcapping", None) or getattr(config, "logit_scale", None): return None
+        return lm_head.weight
+
+    def _metric_positions(self, all_outputs, len_chosen):
+        # Chosen / rejected positions behind the logits/* metrics, sliced the same way from the logits
+        # and, on the fused path, from the hidden states. ORPO drops the last position (decoder-only).
+        if not self.is_encoder_decoder:
+            return all_outputs[:len_chosen, :-1], all_outputs[len_chosen:, :-1]
+        return all_outputs[:len_chosen], all_outputs[len_chosen:]
+
     def concatenated_forward(
-        self, model: nn.Module, batch: dict[str, Union[list, torch.LongTensor]]
+        self, model: nn.Module, batch: dict[str, Union[list, torch.LongTensor]], return_logits: bool = False
     ) -> tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
         """Run the given model on the given batch of inputs, concatenating the chosen and rejected inputs together.
 
         We do this to avoid doing two forward passes, because it's faster for FSDP.
+
+        Unless `return_logits` is set, the logits are not materialized when the LM head can be fused: the log probs
+        and the NLL loss come from the final hidden states chunk by chunk, and the two logits outputs are the
+        per-sequence mean logits (all the metrics use).
         """
         concatenated_batch = self.concatenated_inputs(
             batch,
@@ -1030,12 +1045,40 @@ class _UnslothORPOTrainer(Trainer):
         if self.aux_loss_enabled:
             model_kwargs["output_router_logits"] = True
 
-        outputs = model(
-            concatenated_batch["concatenated_input_ids"],
-            attention_mask=concatenated_batch["concatenated_attention_mask"],
-            use_cache=False,
-            **model_kwargs,
-        )
+        lm_head = None if return_logits else self._fusable_lm_head(model)
+        capture = nullcontext()
+        if lm_head is not None:
+            # Only the final hidden states are kept, the LM head projects a single position
+            capture = final_hidden_states(self.accelerator.unwrap_model(model))
+            model_kwargs["logits_to_keep"] = 1
+
+        with capture as captured:
+            outputs = model(
+                concatenated_batch["concatenated_input_ids"],
+                attention_mask=concatenated_batch["concatenated_attention_mask"],
+                use_cache=False,
+                **model_kwargs,
+            )
+
+        if lm_head is not None:
+            hidden_states = captured[-1]
+            labels = concatenated_batch["concatenated_input_ids"].masked_fill(
+                concatenated_batch["concatenated_attention_mask"] != 1, self.label_pad_token_id
+            )
+            labels[len_chosen:] = -100  # orpo chosen nll loss is computed over the full prompt and response
+            all_logps, chosen_nll_loss = fused_logps_and_nll(
+                hidden_states,
+                lm_head,
+                concatenated_batch["concatenated_labels"],
+                labels,
+                average_log_prob=True,
+                label_pad_token_id=self.label_pad_token_id,
+                n_chunks=self.args.unsloth_num_chunks,
+            )
+            chosen_hidden, rejected_hidden = self._metric_positions(hidden_states, len_chosen)
+            output = (all_logps[:len_chosen], all_logps[len_chosen:], mean_logits(chosen_hidden, lm_head), mean_logits(rejected_hidden, lm_head), chosen_nll_loss)
+            return output + (outputs.aux_loss,) if self.aux_loss_enabled else output
+
         all_logits = outputs.logits
 
         def cross_entropy_loss(logits, labels):
@@ -1072,12 +1115,7 @@ class _UnslothORPOTrainer(Trainer):
         chosen_logps = all_logps[:len_chosen]
         rejected_logps = all_logps[len_chosen:]
 
-        if not self.is_encoder_decoder:
-            chosen_logits = all_logits[:len_chosen, :-1, :]
-            rejected_logits = all_logits[len_chosen:, :-1, :]
-        else:
-            chosen_logits = all_logits[:len_chosen]
-            rejected_logits = all_logits[len_chosen:]
+        chosen_logits, rejected_logits = self._metric_positions(all_logits, len_chosen)
 
         if self.aux_loss_enabled:
             return (chosen_logps, rejected_logps, chosen_logits, rejected_logits, chosen_nll_loss, outputs.aux_loss)
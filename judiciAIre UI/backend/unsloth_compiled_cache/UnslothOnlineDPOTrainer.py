@@ -21,29 +21,11 @@ import numpy as np
 from contextlib import nullcontext
 from torch.nn import functional as F
 from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling
+try:
+    from .unsloth_kernels import torch_compile_options, selective_log_softmax, UnslothRolloutEngine, vLLMSamplingParams, UnslothRewardService
+except ImportError:
+    from unsloth_kernels import torch_compile_options, selective_log_softmax, UnslothRolloutEngine, vLLMSamplingParams, UnslothRewardService
 
-torch_compile_options = {
-    "epilogue_fusion"   : True,
-    "max_autotune"      : False,
-    "shape_padding"     : True,
-    "trace.enabled"     : False,
-    "triton.cudagraphs" : False,
-}
-
-@torch.compile(dynamic = True, fullgraph = True, options = torch_compile_options,)
-def selective_log_softmax(logits, index):
-    logits = logits.to(torch.float32)
-    selected_logits = torch.gather(logits, dim = -1, index = index.unsqueeze(-1)).squeeze(-1)
-    # loop to reduce peak mem consumption
-    # logsumexp_values = torch.stack([torch.logsumexp(lg, dim=-1) for lg in logits])
-    logsumexp_values = torch.logsumexp(logits, dim = -1)
-    per_token_logps = selected_logits - logsumexp_values  # log_softmax(x_i) = x_i - logsumexp(x)
-    return per_token_logps
-def vLLMSamplingParams(**kwargs):
-    from vllm import SamplingParams
-    sampling_params = SamplingParams(**kwargs)
-    sampling_params._set_kwargs = kwargs
-    return sampling_params
 @dataclass
 class UnslothOnlineDPOConfig(OnlineDPOConfig):
     """
@@ -105,6 +87,14 @@ class UnslothOnlineDPOConfig(OnlineDPOConfig):
         default = -1,
         metadata = {'help': 'Chunk size to reduce memory usage. -1 is most efficient.'},
     )
+    rollout_engine : Optional[bool] = field(
+        default = True,
+        metadata = {'help': 'Generate rollouts with UnslothRolloutEngine: one prefill per prompt shared by its samples, and sampled-token log probs recorded during generation. Falls back to `generate` for unsupported generation settings.'},
+    )
+    judge_cache_size : Optional[int] = field(
+        default = 4096,
+        metadata = {'help': 'Judge verdicts kept in an LRU cache keyed on (prompt, completion pair). 0 disables the cache.'},
+    )
     def __init__(
         self,
         output_dir = None,
@@ -247,6 +237,8 @@ class UnslothOnlineDPOConfig(OnlineDPOConfig):
         ds3_gather_for_generation = True,
         vllm_sampling_params = None,
         unsloth_num_chunks = -1,
+        rollout_engine = True,
+        judge_cache_size = 4096,
         **kwargs,
     ):
         if learning_rate < 1e-7: raise FloatingPointError(f'Unsloth: Your learning rate of `{learning_rate}` is too small and less than 1e-7! Consider increasing it, otherwise gradient updates will be close to 0!')
@@ -399,6 +391,8 @@ class UnslothOnlineDPOConfig(OnlineDPOConfig):
             ds3_gather_for_generation = ds3_gather_for_generation,**kwargs)
         self.vllm_sampling_params = vllm_sampling_params
         self.unsloth_num_chunks = unsloth_num_chunks
+        self.rollout_engine = rollout_engine
+        self.judge_cache_size = judge_cache_size
 pass
 
 class _UnslothOnlineDPOTrainer(Trainer):
@@ -737,13 +731,24 @@ class _UnslothOnlineDPOTrainer(Trainer):
         with unwrap_model_for_generation(
             model, self.accelerator, gather_deepspeed3_params=self.args.ds3_gather_for_generation
         ) as unwrapped_model:
-            output = unwrapped_model.generate(
-                input_ids=prompt_ids,
-                attention_mask=prompt_mask,
-                generation_config=self.generation_config,
-            )
+            if getattr(self.args, "rollout_engine", False):
+                # Prefill each prompt once and fork its cache for the 2 samples (same order as the repeat)
+                rollout_engine = UnslothRolloutEngine(self.generation_config, pad_token_id, eos_token_id)
+                completion_ids, _ = rollout_engine.generate(
+                    unwrapped_model,
+                    inputs["prompt_input_ids"],
+                    inputs["prompt_attention_mask"],
+                    num_samples=2,
+                    return_logprobs=False,
+                )
+            else:
+                output = unwrapped_model.generate(
+                    input_ids=prompt_ids,
+                    attention_mask=prompt_mask,
+                    generation_config=self.generation_config,
+                )
+                completion_ids = output[:, prompt_ids.size(1) :]
 
-        completion_ids = output[:, prompt_ids.size(1) :]
         completion_ids, completion_mask = truncate_right(completion_ids, eos_token_id, pad_token_id)
 
         return prompt_ids, prompt_mask, completion_ids, completion_mask
@@ -770,6 +775,12 @@ class _UnslothOnlineDPOTrainer(Trainer):
         logprobs = torch.take_along_dim(logits.log_softmax(dim=-1), completion_ids.unsqueeze(-1), dim=2).squeeze(-1)
         return logprobs
 
+    @property
+    def reward_service(self):
+        if getattr(self, "_reward_service", None) is None:
+            self._reward_service = UnslothRewardService(self, cache_size = getattr(self.args, "judge_cache_size", 4096))
+        return self._reward_service
+
     def training_step(
         self, model: nn.Module, inputs: dict[str, Union[torch.Tensor, Any]], num_items_in_batch: Optional[int] = None
     ) -> torch.Tensor:
@@ -806,12 +817,11 @@ class _UnslothOnlineDPOTrainer(Trainer):
             # independent of the model's chat template, we use the raw conversation data, and apply our own chat
             # template to it.
             if is_conversational({"prompt": prompts[0]}):
-                environment = jinja2.Environment()
-                template = environment.from_string(SIMPLE_CHAT_TEMPLATE)
+                template = self.reward_service.template()
                 prompts = [template.render(messages=prompt) for prompt in prompts]
                 completions = [template.render(messages=completion) for completion in completions]
 
-            ranks_of_first_completion = self.judge.judge(
+            ranks_of_first_completion = self.reward_service.judge_texts(
                 prompts, list(zip(completions[:batch_size], completions[batch_size:]))
             )
 
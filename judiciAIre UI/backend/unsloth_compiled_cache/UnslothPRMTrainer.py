@@ -21,24 +21,86 @@ import numpy as np
 from contextlib import nullcontext
 from torch.nn import functional as F
 from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling
+try:
+    from .unsloth_kernels import torch_compile_options, selective_log_softmax
+except ImportError:
+    from unsloth_kernels import torch_compile_options, selective_log_softmax
+
+def _lengths(sequences):
+    return np.fromiter(map(len, sequences), dtype = np.int64, count = len(sequences))
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype = np.int64)
+    np.cumsum(lengths, out = offsets[1:])
+    return offsets
+
+def tokenize_prm_batch(
+    batch,
+    tokenizer,
+    separator_ids,
+    max_length = None,
+    max_prompt_length = None,
+    max_completion_length = None,
+    train_on_last_step_only = False,
+    is_eval = False,
+):
+    # Batched PRMTrainer.tokenize_row for `dataset.map(..., batched = True)`: the
+    # prompts and every step of every row go through one tokenizer call, then the
+    # step + separator layout and the step labels are placed with NumPy offsets.
+    # separator_ids is tokenizer.encode(step_separator, add_special_tokens = False),
+    # computed once by the caller.
+    prompts = batch["prompt"]
+    steps_per_row = _lengths(batch["completions"])
+    steps = [step for completions in batch["completions"] for step in completions]
+    encoded = tokenizer(prompts + steps, add_special_tokens = False)["input_ids"]
+    prompts_ids, steps_ids = encoded[:len(prompts)], encoded[len(prompts):]
+
+    # Every step becomes its tokens followed by the separator, labelled on its last token
+    step_lengths = _lengths(steps_ids)
+    separator = np.asarray(separator_ids, dtype = np.int64)
+    step_starts = _offsets(step_lengths + len(separator))
+    completion_ids = np.empty(step_starts[-1], dtype = np.int64)
+    step_of_token = np.repeat(np.arange(len(steps_ids)), step_lengths)
+    token_starts = _offsets(step_lengths)
+    positions = step_starts[step_of_token] + np.arange(token_starts[-1]) - token_starts[step_of_token]
+    completion_ids[positions] = np.fromiter(
+        (token for ids in steps_ids for token in ids), dtype = np.int64, count = token_starts[-1],
+    )
+    separator_positions = (step_starts[:-1] + step_lengths)[:, None] + np.arange(len(separator))
+    completion_ids[separator_positions.reshape(-1)] = np.tile(separator, len(steps_ids))
 
-torch_compile_options = {
-    "epilogue_fusion"   : True,
-    "max_autotune"      : False,
-    "shape_padding"     : True,
-    "trace.enabled"     : False,
-    "triton.cudagraphs" : False,
-}
-
-@torch.compile(dynamic = True, fullgraph = True, options = torch_compile_options,)
-def selective_log_softmax(logits, index):
-    logits = logits.to(torch.float32)
-    selected_logits = torch.gather(logits, dim = -1, index = index.unsqueeze(-1)).squeeze(-1)
-    # loop to reduce peak mem consumption
-    # logsumexp_values = torch.stack([torch.logsumexp(lg, dim=-1) for lg in logits])
-    logsumexp_values = torch.logsumexp(logits, dim = -1)
-    per_token_logps = selected_logits - logsumexp_values  # log_softmax(x_i) = x_i - logsumexp(x)
-    return per_token_logps
+    row_starts = _offsets(steps_per_row)
+    step_labels = np.fromiter(
+        (int(label) for labels in batch["labels"] for label in labels), dtype = np.int64, count = row_starts[-1],
+    )
+    if train_on_last_step_only and not is_eval:
+        last_step = np.zeros(len(step_labels), dtype = bool)
+        last_step[row_starts[1:][steps_per_row > 0] - 1] = True
+        step_labels = np.where(last_step, step_labels, -100)
+    completion_labels = np.full(len(completion_ids), -100, dtype = np.int64)
+    # A step with no token and an empty separator owns no position to carry its label
+    labelled = step_starts[1:] > step_starts[:-1]
+    completion_labels[step_starts[1:][labelled] - 1] = step_labels[labelled]
+
+    completion_starts = step_starts[row_starts]
+    bos = [] if tokenizer.bos_token_id is None else [tokenizer.bos_token_id]
+    input_ids, labels = [], []
+    for row, prompt_ids in enumerate(prompts_ids):
+        prompt_ids = bos + prompt_ids
+        if max_prompt_length is not None:
+            prompt_ids = prompt_ids[-max_prompt_length:]
+        start, end = completion_starts[row], completion_starts[row + 1]
+        if max_completion_length is not None:
+            end = min(end, start + max_completion_length)
+        row_ids = prompt_ids + completion_ids[start:end].tolist()
+        row_labels = [-100] * len(prompt_ids) + completion_labels[start:end].tolist()
+        if max_length is not None:
+            row_ids = row_ids[:max_length]
+            row_labels = row_labels[:max_length]
+        input_ids.append(row_ids)
+        labels.append(row_labels)
+    pass
+    return {"input_ids": input_ids, "labels": labels}
 @dataclass
 class UnslothPRMConfig(PRMConfig):
     """
@@ -434,7 +496,7 @@ class _UnslothPRMTrainer(Trainer):
             with PartialState().local_main_process_first():
                 fn_kwargs = {
                     "tokenizer": processing_class,
-                    "step_separator": args.step_separator,
+                    "separator_ids": processing_class.encode(args.step_separator, add_special_tokens=False),
                     "max_length": args.max_length,
                     "max_prompt_length": args.max_prompt_length,
                     "max_completion_length": args.max_completion_length,
@@ -442,8 +504,9 @@ class _UnslothPRMTrainer(Trainer):
                 }
                 train_fn_kwargs = {**fn_kwargs, "is_eval": False}
                 train_dataset = train_dataset.map(
-                    self.tokenize_row,
+                    tokenize_prm_batch,
                     fn_kwargs=train_fn_kwargs,
+                    batched=True,
                     num_proc=args.dataset_num_proc,
                     remove_columns=train_dataset.features,
                     desc="Tokenizing train dataset",
@@ -458,8 +521,9 @@ class _UnslothPRMTrainer(Trainer):
                 eval_fn_kwargs = {**fn_kwargs, "is_eval": True}
                 if eval_dataset is not None:
                     eval_dataset = eval_dataset.map(
-                        self.tokenize_row,
+                        tokenize_prm_batch,
                         fn_kwargs=eval_fn_kwargs,
+                        batched=True,
                         num_proc=args.dataset_num_proc,
                         remove_columns=eval_dataset.features,
                         desc="Tokenizing eval dataset",
@@ -539,45 +603,19 @@ class _UnslothPRMTrainer(Trainer):
          'labels': [-100, -100, -100, -100, -100, -100, -100, -100, 1, -100, -100, -100, -100, -100, -100, -100, -100, -100, -100, -100, -100, -100, -100, 0]}
         ```
         """
-        # Tokenize the prompt and completions
-        prompt_ids = tokenizer(features["prompt"], add_special_tokens=False)["input_ids"]
-        completions_ids = [
-            tokenizer(completion, add_special_tokens=False)["input_ids"] for completion in features["completions"]
-        ]
-        if train_on_last_step_only and not is_eval:
-            labels = [-100] * (len(features["labels"]) - 1) + [int(features["labels"][-1])]
-        else:
-            labels = [int(label) for label in features["labels"]]
-
-        # Get the ID of the separator token and add it to the completions
-        separator_ids = tokenizer.encode(step_separator, add_special_tokens=False)
-        completions_ids = [completion + separator_ids for completion in completions_ids]
-
-        # Create the label
-        labels = [[-100] * (len(completion) - 1) + [label] for completion, label in zip(completions_ids, labels)]
-
-        # Join the completions and labels steps
-        completion_ids = list(chain(*completions_ids))
-        labels = list(chain(*labels))
-
-        if tokenizer.bos_token_id is not None:
-            prompt_ids = [tokenizer.bos_token_id] + prompt_ids
-
-        # Truncate prompt and completion sequences
-        if max_prompt_length is not None:
-            prompt_ids = prompt_ids[-max_prompt_length:]
-        if max_completion_length is not None:
-            completion_ids = completion_ids[:max_completion_length]
-            labels = labels[:max_completion_length]
-
-        input_ids = prompt_ids + completion_ids
-        labels = [-100] * len(prompt_ids) + labels
-
-        if max_length is not None:
-            input_ids = input_ids[:max_length]
-            labels = labels[:max_length]
-
-        return {"input_ids": input_ids, "labels": labels}
+        # One-row batch through the batched tokenization used by the trainer
+        batch = {key: [features[key]] for key in ("prompt", "completions", "labels")}
+        tokenized = tokenize_prm_batch(
+            batch,
+            tokenizer,
+            separator_ids=tokenizer.encode(step_separator, add_special_tokens=False),
+            max_length=max_length,
+            max_prompt_length=max_prompt_length,
+            max_completion_length=max_completion_length,
+            train_on_last_step_only=train_on_last_step_only,
+            is_eval=is_eval,
+        )
+        return {"input_ids": tokenized["input_ids"][0], "labels": tokenized["labels"][0]}
 
     def create_model_card(
         self,
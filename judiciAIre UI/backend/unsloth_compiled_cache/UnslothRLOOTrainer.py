@@ -21,24 +21,12 @@ import numpy as np
 from contextlib import nullcontext
 from torch.nn import functional as F
 from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling
+try:
+    from .unsloth_kernels import torch_compile_options, selective_log_softmax, UnslothRolloutEngine
+except ImportError:
+    from unsloth_kernels import torch_compile_options, selective_log_softmax, UnslothRolloutEngine
 
-torch_compile_options = {
-    "epilogue_fusion"   : True,
-    "max_autotune"      : False,
-    "shape_padding"     : True,
-    "trace.enabled"     : False,
-    "triton.cudagraphs" : False,
-}
-
-@torch.compile(dynamic = True, fullgraph = True, options = torch_compile_options,)
-def selective_log_softmax(logits, index):
-    logits = logits.to(torch.float32)
-    selected_logits = torch.gather(logits, dim = -1, index = index.unsqueeze(-1)).squeeze(-1)
-    # loop to reduce peak mem consumption
-    # logsumexp_values = torch.stack([torch.logsumexp(lg, dim=-1) for lg in logits])
-    logsumexp_values = torch.logsumexp(logits, dim = -1)
-    per_token_logps = selected_logits - logsumexp_values  # log_softmax(x_i) = x_i - logsumexp(x)
-    return per_token_logps
+pass
 @dataclass
 class UnslothRLOOConfig(RLOOConfig):
     """
@@ -86,6 +74,10 @@ class UnslothRLOOConfig(RLOOConfig):
         default = -1,
         metadata = {'help': 'Chunk size to reduce memory usage. -1 is most efficient.'},
     )
+    rollout_engine : Optional[bool] = field(
+        default = True,
+        metadata = {'help': 'Generate rollouts with UnslothRolloutEngine: one prefill per prompt shared by its samples, and sampled-token log probs recorded during generation. Falls back to `generate` for unsupported generation settings.'},
+    )
     def __init__(
         self,
         output_dir = None,
@@ -247,6 +239,7 @@ class UnslothRLOOConfig(RLOOConfig):
         ds3_gather_for_generation = True,
         vllm_sampling_params = None,
         unsloth_num_chunks = -1,
+        rollout_engine = True,
         **kwargs,
     ):
         if learning_rate < 1e-7: raise FloatingPointError(f'Unsloth: Your learning rate of `{learning_rate}` is too small and less than 1e-7! Consider increasing it, otherwise gradient updates will be close to 0!')
@@ -418,6 +411,7 @@ class UnslothRLOOConfig(RLOOConfig):
             ds3_gather_for_generation = ds3_gather_for_generation,**kwargs)
         self.vllm_sampling_params = vllm_sampling_params
         self.unsloth_num_chunks = unsloth_num_chunks
+        self.rollout_engine = rollout_engine
 pass
 
 class _UnslothRLOOTrainer(Trainer):
@@ -615,6 +609,7 @@ class _UnslothRLOOTrainer(Trainer):
             top_p=1.0,
             do_sample=True,
         )
+        rollout_engine = UnslothRolloutEngine(generation_config, processing_class.pad_token_id, processing_class.eos_token_id)
 
         accelerator.print("===training policy===")
         start_time = time.time()
@@ -654,8 +649,8 @@ class _UnslothRLOOTrainer(Trainer):
             self.state.episode += 1 * args.batch_size
             data = next(iter_dataloader)
             with torch.no_grad():
-                queries = data["input_ids"].to(device)
-                queries = queries.repeat(args.rloo_k, 1)
+                prompts = data["input_ids"].to(device)
+                queries = prompts.repeat(args.rloo_k, 1)
                 context_length = queries.shape[1]
                 responses = []
                 postprocessed_responses = []
@@ -668,23 +663,33 @@ class _UnslothRLOOTrainer(Trainer):
                 with unwrap_model_for_generation(
                     self.model, self.accelerator, gather_deepspeed3_params=self.args.ds3_gather_for_generation
                 ) as unwrapped_model:
-                    query_responses, logitss = batch_generation(
-                        unwrapped_model,
-                        queries,
-                        args.local_rollout_forward_batch_size,
-                        processing_class.pad_token_id,
-                        generation_config,
-                    )
+                    rollout_logprobs = None
+                    if getattr(args, "rollout_engine", False):
+                        # One prefill per prompt for its rloo_k samples, same order as `queries`
+                        query_responses, rollout_logprobs = rollout_engine.batch_generate(
+                            unwrapped_model, prompts, num_samples=args.rloo_k, batch_size=args.local_rollout_forward_batch_size
+                        )
+                    else:
+                        query_responses, logitss = batch_generation(
+                            unwrapped_model,
+                            queries,
+                            args.local_rollout_forward_batch_size,
+                            processing_class.pad_token_id,
+                            generation_config,
+                        )
 
                 # Process responses in batches
                 for i in range(0, queries.shape[0], args.local_rollout_forward_batch_size):
                     query = queries[i : i + args.local_rollout_forward_batch_size]
                     query_response = query_responses[i : i + args.local_rollout_forward_batch_size]
                     response = query_response[:, context_length:]
-                    logits = logitss[i : i + args.local_rollout_forward_batch_size]
-                    logprob = selective_log_softmax(logits, response)
-                    del logits
-                    torch.cuda.empty_cache()
+                    if rollout_logprobs is not None:
+                        logprob = rollout_logprobs[i : i + args.local_rollout_forward_batch_size]
+                    else:
+                        logits = logitss[i : i + args.local_rollout_forward_batch_size]
+                        logprob = selective_log_softmax(logits, response)
+                        del logits
+                        torch.cuda.empty_cache()
 
                     ref_output = forward(ref_policy, query_response, processing_class.pad_token_id)
                     ref_logits = ref_output.logits[:, context_length - 1 : -1]
@@ -21,24 +21,113 @@ import numpy as np
 from contextlib import nullcontext
 from torch.nn import functional as F
 from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling
+try:
+    from .unsloth_kernels import torch_compile_options, selective_log_softmax
+except ImportError:
+    from unsloth_kernels import torch_compile_options, selective_log_softmax
+
+MIN_SHARED_PREFIX = 16
+
+def _pad_right(tensor, width, value):
+    return F.pad(tensor, (0, width - tensor.shape[1]), value = value)
+
+def _fork_cache(past_key_values, index):
+    # Repeat every cached row for the chosen and the rejected completion
+    if hasattr(past_key_values, "reorder_cache"):
+        past_key_values.reorder_cache(index)
+        return past_key_values
+    return tuple(tuple(state.index_select(0, index) for state in layer) for layer in past_key_values)
+
+def _drops_cache(model):
+    # transformers forces use_cache = False under gradient checkpointing in training,
+    # so a prefix forward would be wasted: decide before running it
+    if not (model.training and torch.is_grad_enabled()): return False
+    return any(getattr(module, "gradient_checkpointing", False) for module in model.modules())
+
+def shared_prefix_length(inputs):
+    # Longest prefix shared by every chosen/rejected pair of the batch, keeping at
+    # least one token of each completion so both rewards are read on new tokens
+    chosen, rejected = inputs["input_ids_chosen"], inputs["input_ids_rejected"]
+    width = min(chosen.shape[1], rejected.shape[1])
+    common = (chosen[:, :width] == rejected[:, :width]).long().cumprod(-1).sum(-1)
+    lengths = torch.minimum(inputs["attention_mask_chosen"].sum(-1), inputs["attention_mask_rejected"].sum(-1))
+    return int(torch.minimum(common, lengths - 1).min())
+
+def reward_pair_forward(model, inputs, pad_token_id, mode = "concatenated", min_shared_prefix = MIN_SHARED_PREFIX):
+    # (rewards_chosen, rewards_rejected) of a RewardDataCollatorWithPadding batch.
+    #   "separate"      : one forward per side, as RewardTrainer does
+    #   "concatenated"  : both sides right-padded to a common width and stacked,
+    #                     one forward for 2 * batch rows
+    #   "shared_prefix" : the prompt shared by each pair is run once with the KV
+    #                     cache, then both completions attend to the forked cache.
+    #                     Falls back to "concatenated" below min_shared_prefix tokens,
+    #                     under gradient checkpointing in training (no cache is
+    #                     returned) or when the model returns no cache.
+    # Right padding leaves the real tokens untouched under the causal mask and the
+    # sequence classification head pools at the last non-pad token, so every mode
+    # returns the same rewards. pad_token_id must be the model config's pad token.
+    chosen, rejected = inputs["input_ids_chosen"], inputs["input_ids_rejected"]
+    chosen_mask, rejected_mask = inputs["attention_mask_chosen"], inputs["attention_mask_rejected"]
+    batch_size = chosen.shape[0]
+    if mode == "separate":
+        rewards_chosen = model(input_ids = chosen, attention_mask = chosen_mask, return_dict = True)["logits"]
+        rewards_rejected = model(input_ids = rejected, attention_mask = rejected_mask, return_dict = True)["logits"]
+        return rewards_chosen, rewards_rejected
+
+    prefix = 0
+    if mode == "shared_prefix" and not _drops_cache(model):
+        prefix = shared_prefix_length(inputs)
+    past_key_values = None
+    if prefix >= max(min_shared_prefix, 1):
+        past_key_values = model(
+            input_ids = chosen[:, :prefix],
+            attention_mask = chosen_mask[:, :prefix],
+            use_cache = True,
+            return_dict = True,
+        ).get("past_key_values")
+    if past_key_values is None:
+        prefix = 0
+    pass
+
+    chosen, rejected = chosen[:, prefix:], rejected[:, prefix:]
+    chosen_mask, rejected_mask = chosen_mask[:, prefix:], rejected_mask[:, prefix:]
+    # Columns past the longest row are padding on both sides
+    width = int(max(chosen_mask.sum(-1).max(), rejected_mask.sum(-1).max()))
+    input_ids = torch.cat([
+        _pad_right(chosen[:, :width], width, pad_token_id),
+        _pad_right(rejected[:, :width], width, pad_token_id),
+    ])
+    attention_mask = torch.cat([
+        _pad_right(chosen_mask[:, :width], width, 0),
+        _pad_right(rejected_mask[:, :width], width, 0),
+    ])
+    if past_key_values is None:
+        rewards = model(input_ids = input_ids, attention_mask = attention_mask, return_dict = True)["logits"]
+    else:
+        index = torch.arange(batch_size, device = input_ids.device).repeat(2)
+        past_key_values = _fork_cache(past_key_values, index)
+        attention_mask = torch.cat([attention_mask.new_ones(2 * batch_size, prefix), attention_mask], dim = 1)
+        position_ids = torch.arange(prefix, prefix + width, device = input_ids.device).expand(2 * batch_size, -1)
+        rewards = model(
+            input_ids = input_ids,
+            attention_mask = attention_mask,
+            position_ids = position_ids,
+            past_key_values = past_key_values,
+            use_cache = True,
+            return_dict = True,
+        )["logits"]
+    pass
+    return rewards[:batch_size], rewards[batch_size:]
+
+def pairwise_reward_loss(rewards_chosen, rewards_rejected, margin = None, center_rewards_coefficient = None):
+    if margin is not None:
+        loss = -nn.functional.logsigmoid(rewards_chosen - rewards_rejected - margin).mean()
+    else:
+        loss = -nn.functional.logsigmoid(rewards_chosen - rewards_rejected).mean()
+    if center_rewards_coefficient is not None:
+        loss += center_rewards_coefficient * torch.mean((rewards_chosen + rewards_rejected) ** 2)
+    return loss
 
-torch_compile_options = {
-    "epilogue_fusion"   : True,
-    "max_autotune"      : False,
-    "shape_padding"     : True,
-    "trace.enabled"     : False,
-    "triton.cudagraphs" : False,
-}
-
-@torch.compile(dynamic = True, fullgraph = True, options = torch_compile_options,)
-def selective_log_softmax(logits, index):
-    logits = logits.to(torch.float32)
-    selected_logits = torch.gather(logits, dim = -1, index = index.unsqueeze(-1)).squeeze(-1)
-    # loop to reduce peak mem consumption
-    # logsumexp_values = torch.stack([torch.logsumexp(lg, dim=-1) for lg in logits])
-    logsumexp_values = torch.logsumexp(logits, dim = -1)
-    per_token_logps = selected_logits - logsumexp_values  # log_softmax(x_i) = x_i - logsumexp(x)
-    return per_token_logps
 @dataclass
 class UnslothRewardConfig(RewardConfig):
     """
@@ -73,6 +162,10 @@ class UnslothRewardConfig(RewardConfig):
         default = -1,
         metadata = {'help': 'Chunk size to reduce memory usage. -1 is most efficient.'},
     )
+    reward_forward : Optional[str] = field(
+        default = 'shared_prefix',
+        metadata = {'help': 'How chosen and rejected are scored: "separate" (two forwards), "concatenated" (one forward) or "shared_prefix" (shared prompt run once, falls back to "concatenated").'},
+    )
     def __init__(
         self,
         output_dir = None,
@@ -208,6 +301,7 @@ class UnslothRewardConfig(RewardConfig):
         center_rewards_coefficient = None,
         vllm_sampling_params = None,
         unsloth_num_chunks = -1,
+        reward_forward = 'shared_prefix',
         **kwargs,
     ):
         if learning_rate < 1e-7: raise FloatingPointError(f'Unsloth: Your learning rate of `{learning_rate}` is too small and less than 1e-7! Consider increasing it, otherwise gradient updates will be close to 0!')
@@ -353,6 +447,7 @@ class UnslothRewardConfig(RewardConfig):
             center_rewards_coefficient = center_rewards_coefficient,**kwargs)
         self.vllm_sampling_params = vllm_sampling_params
         self.unsloth_num_chunks = unsloth_num_chunks
+        self.reward_forward = reward_forward
 pass
 
 class _UnslothRewardTrainer(Trainer):
@@ -539,24 +634,19 @@ class _UnslothRewardTrainer(Trainer):
         return_outputs=False,
         num_items_in_batch=None,
     ) -> Union[torch.Tensor, tuple[torch.Tensor, dict[str, torch.Tensor]]]:
-        rewards_chosen = model(
-            input_ids=inputs["input_ids_chosen"],
-            attention_mask=inputs["attention_mask_chosen"],
-            return_dict=True,
-        )["logits"]
-        rewards_rejected = model(
-            input_ids=inputs["input_ids_rejected"],
-            attention_mask=inputs["attention_mask_rejected"],
-            return_dict=True,
-        )["logits"]
+        rewards_chosen, rewards_rejected = reward_pair_forward(
+            model,
+            inputs,
+            pad_token_id=self._reward_pad_token_id(model),
+            mode=getattr(self.args, "reward_forward", "separate"),
+        )
         # calculate loss, optionally modulate with margin
-        if "margin" in inputs:
-            loss = -nn.functional.logsigmoid(rewards_chosen - rewards_rejected - inputs["margin"]).mean()
-        else:
-            loss = -nn.functional.logsigmoid(rewards_chosen - rewards_rejected).mean()
-
-        if self.args.center_rewards_coefficient is not None:
-            loss += self.args.center_rewards_coefficient * torch.mean((rewards_chosen + rewards_rejected) ** 2)
+        loss = pairwise_reward_loss(
+            rewards_chosen,
+            rewards_rejected,
+            margin=inputs.get("margin"),
+            center_rewards_coefficient=self.args.center_rewards_coefficient,
+        )
 
         if return_outputs:
             return loss, {
@@ -565,6 +655,30 @@ class _UnslothRewardTrainer(Trainer):
             }
         return loss
 
+    def _reward_pad_token_id(self, model):
+        # The classification head finds the last token through config.pad_token_id,
+        # so the extra padding of the concatenated batch must use that same id
+        pad_token_id = getattr(self.accelerator.unwrap_model(model).config, "pad_token_id", None)
+        if pad_token_id is None:
+            pad_token_id = getattr(self.processing_class, "pad_token_id", None)
+        return 0 if pad_token_id is None else pad_token_id
+
+    def _get_train_sampler(self, *args, **kwargs):
+        # group_by_length on the pair length: batches of similar lengths keep the
+        # common width of the concatenated forward close to every row
+        if not (self.args.group_by_length and self.use_reward_data_collator):
+            return super()._get_train_sampler(*args, **kwargs)
+        from transformers.trainer_pt_utils import LengthGroupedSampler
+        lengths = [
+            max(len(chosen), len(rejected))
+            for chosen, rejected in zip(self.train_dataset["input_ids_chosen"], self.train_dataset["input_ids_rejected"])
+        ]
+        return LengthGroupedSampler(
+            self.args.train_batch_size * self.args.gradient_accumulation_steps,
+            dataset=self.train_dataset,
+            lengths=lengths,
+        )
+
     def prediction_step(
         self,
         model: Union[PreTrainedModel, nn.Module],
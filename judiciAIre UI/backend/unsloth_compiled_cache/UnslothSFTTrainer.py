@@ -13,6 +13,7 @@ from trl.trainer.sft_trainer import (Any, AutoModelForCausalLM, AutoTokenizer, B
 
 
 import os
+import time
 from typing import *
 from dataclasses import dataclass, field
 from packaging.version import Version
@@ -21,24 +22,244 @@ import numpy as np
 from contextlib import nullcontext
 from torch.nn import functional as F
 from transformers import DataCollatorForSeq2Seq, DataCollatorForLanguageModeling
+try:
+    from .unsloth_kernels import torch_compile_options, selective_log_softmax, final_hidden_states
+except ImportError:
+    from unsloth_kernels import torch_compile_options, selective_log_softmax, final_hidden_states
+
+def best_fit_decreasing(lengths, capacity):
+    # Bin-pack sequence lengths into rows of at most `capacity` tokens.
+    # Longest first, each one into the fullest row that still has room.
+    import bisect
+    order = np.argsort(-np.asarray(lengths, dtype = np.int64), kind = "stable")
+    bins = []          # list of index lists
+    free = []          # sorted (remaining_capacity, bin_id)
+    for idx in order.tolist():
+        length = int(lengths[idx])
+        j = bisect.bisect_left(free, (length, -1))
+        if j == len(free):
+            bins.append([idx])
+            bisect.insort(free, (capacity - length, len(bins) - 1))
+        else:
+            remaining, bin_id = free.pop(j)
+            bins[bin_id].append(idx)
+            bisect.insort(free, (remaining - length, bin_id))
+    pass
+    return bins
+
+def padding_ratio(row_lengths, batch_size):
+    # Fraction of padded positions when rows are batched in order and padded to the longest row.
+    row_lengths = np.asarray(row_lengths, dtype = np.int64)
+    if len(row_lengths) == 0: return 0.0
+    total = 0
+    for i in range(0, len(row_lengths), batch_size):
+        chunk = row_lengths[i : i + batch_size]
+        total += int(chunk.max()) * len(chunk)
+    return 1.0 - float(row_lengths.sum()) / total
+
+def pack_dataset(dataset, max_seq_length, batch_size):
+    # Packs a tokenized map-style dataset into rows of at most max_seq_length tokens.
+    # Each row keeps position_ids restarting at 0 for every document, which is what
+    # DataCollatorForPackedSequences uses to rebuild per-document attention.
+    input_ids = dataset["input_ids"]
+    has_labels = "labels" in dataset.column_names
+    labels = dataset["labels"] if has_labels else None
+    lengths = np.fromiter((len(x) for x in input_ids), dtype = np.int64, count = len(input_ids))
+    bins = best_fit_decreasing(lengths, max_seq_length)
+
+    packed = {"input_ids": [], "position_ids": []}
+    if has_labels: packed["labels"] = []
+    for row in bins:
+        packed["input_ids"].append([t for i in row for t in input_ids[i]])
+        packed["position_ids"].append([p for i in row for p in range(lengths[i])])
+        if has_labels: packed["labels"].append([t for i in row for t in labels[i]])
+    pass
+    row_lengths = [len(x) for x in packed["input_ids"]]
+    report = {
+        "examples"       : len(lengths),
+        "rows"           : len(bins),
+        "padding_before" : padding_ratio(lengths, batch_size),
+        "padding_after"  : padding_ratio(row_lengths, batch_size),
+    }
+    report["throughput_gain"] = (1.0 - report["padding_after"]) / max(1.0 - report["padding_before"], 1e-8)
+    return Dataset.from_dict(packed), report
+
+@dataclass
+class DataCollatorForPackedSequences:
+    """
+    Collates rows produced by `pack_dataset`.
+
+    Documents inside a row cannot see each other: position_ids restart at every
+    document and the label of each document's first token is ignored so no token is
+    predicted across a boundary. Flash-attention models get `cu_seq_lens_*` /
+    `max_length_*` over the flattened batch (each document, and each row's padding,
+    is its own sequence) and no attention mask. Other attention implementations get
+    a 4D block-diagonal causal mask (additive, already inverted as transformers
+    expects for custom 4D masks), which is quadratic in the row length.
+    """
+    pad_token_id : int = 0
+    dtype        : Any = torch.float32
+    return_4d_mask : bool = True
+    return_flash_attn_kwargs : bool = False
+
+    def __call__(self, features):
+        lengths = [len(f["input_ids"]) for f in features]
+        max_len = max(lengths)
+        bsz = len(features)
+        input_ids    = torch.full((bsz, max_len), self.pad_token_id, dtype = torch.long)
+        labels       = torch.full((bsz, max_len), -100, dtype = torch.long)
+        position_ids = torch.zeros((bsz, max_len), dtype = torch.long)
+        for b, f in enumerate(features):
+            n = lengths[b]
+            input_ids[b, :n] = torch.as_tensor(f["input_ids"], dtype = torch.long)
+            position_ids[b, :n] = torch.as_tensor(f["position_ids"], dtype = torch.long)
+            labels[b, :n] = torch.as_tensor(f.get("labels", f["input_ids"]), dtype = torch.long)
+        pass
+        is_start = position_ids == 0
+        valid = torch.arange(max_len).unsqueeze(0) < torch.as_tensor(lengths).unsqueeze(1)
+        labels[is_start & valid] = -100
+        batch = {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+        if self.return_4d_mask:
+            # Padding forms one extra "document" so its rows never attend to real tokens.
+            doc_ids = torch.cumsum((is_start & valid).long(), dim = 1)
+            doc_ids[~valid] = doc_ids.max() + 1
+            same_doc = doc_ids.unsqueeze(2) == doc_ids.unsqueeze(1)
+            causal = torch.ones((max_len, max_len), dtype = torch.bool).tril_()
+            allowed = same_doc & causal
+            mask = torch.zeros((bsz, 1, max_len, max_len), dtype = self.dtype)
+            mask.masked_fill_(~allowed.unsqueeze(1), torch.finfo(self.dtype).min)
+            batch["attention_mask"] = mask
+        pass
+        if self.return_flash_attn_kwargs:
+            # A sequence starts at every document and at the first padding position of a row
+            first_pad = ~valid & torch.cat((torch.ones((bsz, 1), dtype = torch.bool), valid[:, :-1]), dim = 1)
+            starts = torch.nonzero(((is_start & valid) | first_pad).flatten()).flatten()
+            cu_seq_lens = torch.cat((starts, torch.tensor([bsz * max_len]))).to(torch.int32)
+            batch["cu_seq_lens_q"] = batch["cu_seq_lens_k"] = cu_seq_lens
+            batch["max_length_q"]  = batch["max_length_k"]  = int(torch.diff(cu_seq_lens).max())
+        pass
+        return batch
+pass
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    """
+    Length-bucketed batches bounded by a token budget instead of a fixed batch size.
+
+    Examples are sorted by length (random tie-break), cut into batches whose summed
+    length stays under `max_tokens`, and only the batch order is reshuffled each
+    epoch, so `len()` is stable for the Trainer's step computation.
+    """
+    def __init__(self, lengths, max_tokens, seed = 0):
+        lengths = np.asarray(lengths, dtype = np.int64)
+        rng = np.random.default_rng(seed)
+        order = np.lexsort((rng.random(len(lengths)), lengths))
+        self.batches = []
+        batch, tokens = [], 0
+        for idx in order.tolist():
+            n = int(lengths[idx])
+            if batch and tokens + n > max_tokens:
+                self.batches.append(batch)
+                batch, tokens = [], 0
+            batch.append(idx)
+            tokens += n
+        pass
+        if batch: self.batches.append(batch)
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        for i in rng.permutation(len(self.batches)).tolist():
+            yield self.batches[i]
+
+    def __len__(self):
+        return len(self.batches)
+pass
+
+@dataclass
+class DataCollatorForPaddingFree(DataCollatorForPackedSequences):
+    """
+    Flattens a batch into a single (1, total_tokens) row with no padding.
+
+    Attention is handled as for packed rows, with the whole batch as one row.
+    """
+    return_4d_mask           : bool = False
+    return_flash_attn_kwargs : bool = True
+
+    def __call__(self, features):
+        lengths = [len(f["input_ids"]) for f in features]
+        row = {
+            "input_ids"    : [t for f in features for t in f["input_ids"]],
+            "position_ids" : [p for n in lengths for p in range(n)],
+        }
+        if all("labels" in f for f in features):
+            row["labels"] = [t for f in features for t in f["labels"]]
+        return super().__call__([row])
+pass
+
+LOSS_CHUNK_BYTES = 256 * 1024 * 1024 # float32 logits budget of one chunk when unsloth_num_chunks = -1
+
+class UnslothChunkedCrossEntropy(torch.autograd.Function):
+    # Fused LM head + cross entropy, chunked over tokens like UnslothEfficientGRPO:
+    # gradients are computed chunk by chunk during forward, so at most
+    # (chunk_size, vocab) logits exist at a time instead of (batch, seq, vocab).
+    @staticmethod
+    def forward(ctx, hidden_states, lm_head, labels, chunk_size, divisor):
+        need_weight_grad = lm_head.requires_grad
+        grad_hidden = torch.empty_like(hidden_states)
+        grad_weight = torch.zeros(lm_head.shape, dtype = torch.float32, device = lm_head.device) if need_weight_grad else None
+        loss = torch.zeros((), dtype = torch.float32, device = hidden_states.device)
+
+        for start in range(0, hidden_states.shape[0], chunk_size):
+            hidden_j = hidden_states[start : start + chunk_size]
+            labels_j = labels[start : start + chunk_size]
+            logits_j = torch.matmul(hidden_j, lm_head.t()).to(torch.float32)
+            logsumexp_j = torch.logsumexp(logits_j, dim = -1)
+            loss += (logsumexp_j - logits_j.gather(-1, labels_j.unsqueeze(-1)).squeeze(-1)).sum()
+
+            # d loss / d logits = softmax - one_hot, built in place over the chunk's logits
+            grad_logits_j = logits_j.sub_(logsumexp_j.unsqueeze(-1)).exp_()
+            grad_logits_j[torch.arange(labels_j.shape[0], device = labels_j.device), labels_j] -= 1.0
+            grad_logits_j.div_(divisor)
+            grad_hidden[start : start + chunk_size] = torch.matmul(grad_logits_j.to(lm_head.dtype), lm_head)
+            if need_weight_grad:
+                grad_weight.addmm_(grad_logits_j.t(), hidden_j.to(torch.float32))
+        pass
+
+        ctx.weight_dtype = lm_head.dtype
+        ctx.save_for_backward(grad_hidden, grad_weight)
+        return loss / divisor
+    pass
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_hidden, grad_weight = ctx.saved_tensors
+        grad_hidden = grad_hidden * grad_output.to(grad_hidden.dtype)
+        if grad_weight is not None:
+            grad_weight = (grad_weight * grad_output).to(ctx.weight_dtype)
+        return (grad_hidden, grad_weight, None, None, None,)
+    pass
+
+def chunked_cross_entropy(hidden_states, lm_head, labels, n_chunks = -1, num_items_in_batch = None):
+    # Causal LM loss from the final hidden states (batch, seq, hidden) and the LM head
+    # weight. Labels are shifted here like the model's own loss; positions labelled
+    # -100 (prompt, padding, packed document starts) never reach the LM head.
+    shift_labels = labels[:, 1:]
+    mask = shift_labels != -100
+    hidden_states = hidden_states[:, :-1][mask]
+    shift_labels = shift_labels[mask]
+    n_tokens = shift_labels.shape[0]
+    if n_chunks is None or n_chunks <= 0:
+        chunk_size = max(1, LOSS_CHUNK_BYTES // (4 * lm_head.shape[0]))
+    else:
+        chunk_size = max(1, -(-n_tokens // n_chunks))
+    divisor = float(num_items_in_batch) if num_items_in_batch is not None else float(max(n_tokens, 1))
+    return UnslothChunkedCrossEntropy.apply(hidden_states, lm_head, shift_labels, chunk_size, divisor)
 
-torch_compile_options = {
-    "epilogue_fusion"   : True,
-    "max_autotune"      : False,
-    "shape_padding"     : True,
-    "trace.enabled"     : False,
-    "triton.cudagraphs" : False,
-}
-
-@torch.compile(dynamic = True, fullgraph = True, options = torch_compile_options,)
-def selective_log_softmax(logits, index):
-    logits = logits.to(torch.float32)
-    selected_logits = torch.gather(logits, dim = -1, index = index.unsqueeze(-1)).squeeze(-1)
-    # loop to reduce peak mem consumption
-    # logsumexp_values = torch.stack([torch.logsumexp(lg, dim=-1) for lg in logits])
-    logsumexp_values = torch.logsumexp(logits, dim = -1)
-    per_token_logps = selected_logits - logsumexp_values  # log_softmax(x_i) = x_i - logsumexp(x)
-    return per_token_logps
 @dataclass
 class UnslothSFTConfig(SFTConfig):
     """
@@ -95,6 +316,18 @@ class UnslothSFTConfig(SFTConfig):
         default = -1,
         metadata = {'help': 'Chunk size to reduce memory usage. -1 is most efficient.'},
     )
+    chunked_cross_entropy : Optional[bool] = field(
+        default = False,
+        metadata = {'help': 'Compute the loss from hidden states in token chunks (unsloth_num_chunks, -1 = auto) without full-vocabulary logits.'},
+    )
+    padding_free : Optional[bool] = field(
+        default = False,
+        metadata = {'help': 'Flatten each batch into one unpadded row with cumulative sequence lengths.'},
+    )
+    max_tokens_per_batch : Optional[int] = field(
+        default = None,
+        metadata = {'help': 'Token budget per padding-free batch. None keeps per_device_train_batch_size examples on average.'},
+    )
     def __init__(
         self,
         output_dir = None,
@@ -237,6 +470,9 @@ class UnslothSFTConfig(SFTConfig):
         chars_per_token = None,
         vllm_sampling_params = None,
         unsloth_num_chunks = -1,
+        padding_free = False,
+        max_tokens_per_batch = None,
+        chunked_cross_entropy = False,
         **kwargs,
     ):
         if learning_rate < 1e-7: raise FloatingPointError(f'Unsloth: Your learning rate of `{learning_rate}` is too small and less than 1e-7! Consider increasing it, otherwise gradient updates will be close to 0!')
@@ -389,6 +625,9 @@ class UnslothSFTConfig(SFTConfig):
             chars_per_token = chars_per_token,**kwargs)
         self.vllm_sampling_params = vllm_sampling_params
         self.unsloth_num_chunks = unsloth_num_chunks
+        self.padding_free = padding_free
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.chunked_cross_entropy = chunked_cross_entropy
 pass
 
 class _UnslothSFTTrainer(Trainer):
@@ -467,11 +706,25 @@ class _UnslothSFTTrainer(Trainer):
                     )
 
         # Data collator
-        if data_collator is None:
+        if getattr(self, "_packing_collator", None) is not None:
+            # Packed rows carry position_ids and need per-document attention
+            if data_collator is not None:
+                warnings.warn(
+                    f"Unsloth: packing = True replaces the given {data_collator.__class__.__name__} with "
+                    "DataCollatorForPackedSequences, which keeps the documents of a packed row apart. "
+                    "Set packing = False to use your own data collator."
+                )
+            use_flash = getattr(model.config, "_attn_implementation", None) == "flash_attention_2"
+            self._packing_collator.return_4d_mask = not use_flash
+            self._packing_collator.return_flash_attn_kwargs = use_flash
+            data_collator = self._packing_collator
+        elif data_collator is None:
             data_collator = DataCollatorForLanguageModeling(tokenizer=processing_class, mlm=False)
 
         # Initialize the metrics
         self._metrics = defaultdict(list)
+        self._effective_tokens = 0
+        self._throughput_start = None
 
         # Initialize the Trainer. Parent class will handle:
         # - DeepSpeed configuration (through create_accelerator_and_postprocess)
@@ -728,23 +981,77 @@ class _UnslothSFTTrainer(Trainer):
             pass
         pass
         if packing:
-            print("Unsloth: Hugging Face's packing is currently buggy - we're disabling it for now!")
-            return dataset
-    
             if max_seq_length == 0:
                 raise ValueError("When packing is enabled, `max_seq_length` can't be `None`.")
+            if isinstance(dataset, IterableDataset):
+                print("Unsloth: Packing needs a map-style dataset - skipping packing for the streamed dataset.")
+                return dataset
     
-            if use_desc: map_kwargs["desc"] = f"Unsloth: Packing {dataset_name} dataset"
-            dataset = dataset.select_columns(used_column_names).map(
-                pack_examples,
-                batched = True,
-                fn_kwargs = {"seq_length": max_seq_length,},
-                **map_kwargs,
+            if "labels" in column_names and "labels" not in used_column_names: used_column_names.append("labels")
+            batch_size = getattr(args, "per_device_train_batch_size", 8)
+            dataset, report = pack_dataset(
+                dataset.select_columns([c for c in used_column_names if c != "attention_mask"]),
+                max_seq_length, batch_size,
+            )
+            print(
+                f"Unsloth: Packed {report['examples']} {dataset_name} examples into {report['rows']} rows of <= {max_seq_length} tokens. "
+                f"Padding {report['padding_before']:.1%} -> {report['padding_after']:.1%} "
+                f"(~{report['throughput_gain']:.2f}x effective tokens per step)."
+            )
+            self._packing_report = report
+            mask_dtype = torch.bfloat16 if getattr(args, "bf16", False) else torch.float16 if getattr(args, "fp16", False) else torch.float32
+            self._packing_collator = DataCollatorForPackedSequences(
+                pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+                dtype = mask_dtype,
             )
         pass
         return dataset
     
+    def get_train_dataloader(self):
+        # Packed rows already hold several documents, so packing takes precedence
+        if not getattr(self.args, "padding_free", False) or not isinstance(self.train_dataset, Dataset) \
+            or getattr(self, "_packing_collator", None) is not None:
+            return super().get_train_dataloader()
+
+        train_dataset = self._remove_unused_columns(self.train_dataset, description = "training")
+        lengths = np.fromiter((len(x) for x in train_dataset["input_ids"]), dtype = np.int64, count = len(train_dataset))
+        max_tokens = self.args.max_tokens_per_batch
+        if max_tokens is None:
+            max_tokens = int(self._train_batch_size * lengths.mean())
+        max_tokens = max(max_tokens, int(lengths.max()))
+        batch_sampler = TokenBudgetBatchSampler(lengths, max_tokens, seed = self.args.seed)
+
+        tokenizer = getattr(self.processing_class, "tokenizer", self.processing_class)
+        use_flash = getattr(self.model.config, "_attn_implementation", None) == "flash_attention_2"
+        data_collator = DataCollatorForPaddingFree(
+            pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+            dtype = self.model.get_input_embeddings().weight.dtype,
+            return_4d_mask = not use_flash,
+            return_flash_attn_kwargs = use_flash,
+        )
+        padded_tokens = sum(len(b) * int(lengths[b].max()) for b in batch_sampler.batches)
+        print(
+            f"Unsloth: Padding-free batching - {len(batch_sampler)} batches of <= {max_tokens} tokens, "
+            f"{len(lengths) / len(batch_sampler):.1f} examples per batch on average, "
+            f"{1.0 - lengths.sum() / padded_tokens:.1%} padding avoided vs padding each batch to its longest example."
+        )
+        dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_sampler = batch_sampler,
+            collate_fn = data_collator,
+            num_workers = self.args.dataloader_num_workers,
+            pin_memory = self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(dataloader)
+
     def compute_loss(self, model, inputs, return_outputs = False, num_items_in_batch = None):
+        # Count supervised (non padding) tokens for effective_tokens_per_second
+        if model.training and "labels" in inputs:
+            if self._throughput_start is None: self._throughput_start = time.perf_counter()
+            self._effective_tokens += int((inputs["labels"] != -100).sum())
+        if getattr(self.args, "chunked_cross_entropy", False) and not return_outputs and "labels" in inputs:
+            loss = self._chunked_cross_entropy_loss(model, inputs, num_items_in_batch)
+            if loss is not None: return loss
         outputs = super().compute_loss(
             model,
             inputs,
@@ -753,6 +1060,32 @@ class _UnslothSFTTrainer(Trainer):
         )
         return outputs
 
+    def _chunked_cross_entropy_loss(self, model, inputs, num_items_in_batch):
+        # Returns None when the LM head cannot be fused (bias, LoRA on lm_head,
+        # logit soft-capping / scaling), so compute_loss falls back to full logits.
+        unwrapped = self.accelerator.unwrap_model(model)
+        lm_head = unwrapped.get_output_embeddings()
+        config = getattr(unwrapped, "config", None)
+        if type(lm_head) is not nn.Linear or lm_head.bias is not None: return None
+        if getattr(config, "final_logit_softcapping", None) or getattr(config, "logit_scale", None): return None
+
+        labels = inputs["labels"]
+        model_inputs = {key: value for key, value in inputs.items() if key != "labels"}
+        # Only the final hidden states are kept, the LM head projects a single position
+        with final_hidden_states(unwrapped) as captured:
+            model(**model_inputs, logits_to_keep = 1)
+        if not self.model_accepts_loss_kwargs:
+            # training_step divides by gradient_accumulation_steps itself in that case
+            num_items_in_batch = None
+        loss = chunked_cross_entropy(
+            captured[-1], lm_head.weight, labels,
+            n_chunks = self.args.unsloth_num_chunks,
+            num_items_in_batch = num_items_in_batch,
+        )
+        if self.args.average_tokens_across_devices and num_items_in_batch is not None:
+            loss = loss * self.accelerator.num_processes
+        return loss
+
     def log(self, logs: dict[str, float], start_time: Optional[float] = None) -> None:
         metrics = {key: sum(val) / len(val) for key, val in self._metrics.items()}  # average the metrics
 
@@ -762,6 +1095,10 @@ class _UnslothSFTTrainer(Trainer):
             metrics = {f"eval_{key}": val for key, val in metrics.items()}
 
         logs = {**logs, **metrics}
+        if self._effective_tokens and not next(iter(logs.keys())).startswith("eval_"):
+            now = time.perf_counter()
+            logs["effective_tokens_per_second"] = round(self._effective_tokens / max(now - self._throughput_start, 1e-8), 2)
+            self._effective_tokens, self._throughput_start = 0, now
         if version.parse(transformers.__version__) >= version.parse("4.47.0.dev0"):
             super().log(logs, start_time)
         else:  # transformers<=4.46
@@ -0,0 +1,29 @@
+import importlib
+
+# Lazy exports: `from unsloth_compiled_cache import UnslothSFTTrainer` imports
+# UnslothSFTTrainer.py (and the trl trainer it wraps) on first access only, so
+# importing one trainer does not load the fourteen others. Shared kernels live
+# in unsloth_kernels.py, the compile cache in unsloth_compile_manager.py.
+
+TRAINERS = [
+    "BCO", "CPO", "DPO", "GKD", "GRPO", "KTO", "NashMD", "ORPO",
+    "OnlineDPO", "PPO", "PRM", "RLOO", "Reward", "SFT", "XPO",
+]
+
+_EXPORTS = {}
+for _trainer in TRAINERS:
+    _EXPORTS[f"Unsloth{_trainer}Trainer"] = f"Unsloth{_trainer}Trainer"
+    _EXPORTS[f"Unsloth{_trainer}Config"]  = f"Unsloth{_trainer}Trainer"
+pass
+
+__all__ = sorted(_EXPORTS)
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
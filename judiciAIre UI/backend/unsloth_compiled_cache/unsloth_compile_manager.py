@@ -0,0 +1,294 @@
+import os
+import time
+import atexit
+import functools
+import itertools
+import contextlib
+import torch
+import torch.nn.functional as F
+
+# One compile manager shared by every Unsloth*Trainer module: the compiled
+# kernels (selective_log_softmax, grpo_compute_loss_slow, ...) go through
+# compile_manager.compile instead of torch.compile.
+#   UNSLOTH_COMPILE_PERSISTENT_CACHE : '1' keeps the inductor / triton caches and the
+#                                      portable artifacts file across runs (opt-in)
+#   UNSLOTH_COMPILE_CACHE_DIR        : where they are kept
+#   UNSLOTH_COMPILE_DYNAMIC          : '1' one symbolic kernel (default), '0' one static
+#                                      kernel per length bucket
+#   UNSLOTH_COMPILE_BUCKETS          : length buckets per power of two in static mode
+#   UNSLOTH_COMPILE_MIN_BUCKET       : shorter sequences are padded up to this length,
+#                                      so lengths 0 and 1 never specialize a new graph
+
+ARTIFACTS_FILE = "compile_artifacts.bin"
+
+def _default_cache_dir():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "torch_compile_cache")
+
+def _pad_dim(tensor, dim, length):
+    dim = dim % tensor.dim()
+    pad = [0, 0] * (tensor.dim() - dim - 1) + [0, length - tensor.shape[dim]]
+    return F.pad(tensor, pad)
+
+class CompiledFunction:
+    # torch.compile'd `fn` called on bucketed lengths. bucket maps a positional
+    # argument to its length dimension; the first one gives the length.
+    # output_bucket is the output dimension that follows it position by position,
+    # None when the function reduces over it.
+    # Lengths up to min_bucket are padded with zeros (a copy of at most min_bucket
+    # positions; zeros must be neutral for reductions, e.g. a zero mask). Longer
+    # inputs are never padded: in static mode a position-wise function runs on
+    # bucket-sized windows (views) of each leading row and the outputs are
+    # concatenated, reductions use the symbolic kernel.
+    def __init__(self, manager, fn, bucket = None, output_bucket = None, **compile_kwargs):
+        functools.update_wrapper(self, fn)
+        self.manager         = manager
+        self.fn              = fn
+        self.bucket          = bucket or {}
+        self.output_bucket   = output_bucket
+        self.compile_kwargs  = compile_kwargs
+        self.compiled        = None
+        self.calls           = 0
+        self.compiles        = 0
+        self.compile_seconds = 0.0
+        self.lengths         = set()
+    pass
+
+    @property
+    def windowed(self):
+        return bool(self.bucket) and self.output_bucket is not None and not self.manager.dynamic
+
+    def _compiled_fn(self):
+        if self.compiled is None:
+            dynamic = self.manager.dynamic or not self.windowed
+            self.compiled = torch.compile(self.fn, dynamic = dynamic, **self.compile_kwargs)
+        return self.compiled
+
+    def _call(self, *args, **kwargs):
+        from torch._dynamo.utils import counters
+        graphs = counters["stats"]["unique_graphs"]
+        start = time.perf_counter()
+        with self.manager.config_context():
+            output = self._compiled_fn()(*args, **kwargs)
+        # Dynamo traced a new graph: first call, new bucket or failed guard
+        if counters["stats"]["unique_graphs"] != graphs:
+            self.compiles += 1
+            self.compile_seconds += time.perf_counter() - start
+        return output
+
+    def _call_windows(self, args, kwargs, length):
+        # Indexing each leading row first keeps the window strides a function of the
+        # bucket alone; a view of the whole batch would carry the full length in its
+        # strides and specialize a new static graph per length.
+        bucket = {position: dim - args[position].dim() if dim >= 0 else dim for position, dim in self.bucket.items()}
+        first, dim = next(iter(bucket.items()))
+        leading = args[first].shape[:args[first].dim() + dim]
+        windows = self.manager.bucket_windows(length)
+        self.lengths.update(size for _, size in windows)
+        rows = []
+        for index in itertools.product(*(range(n) for n in leading)):
+            pieces, end = [], 0
+            for start, size in windows:
+                window_args = list(args)
+                for position, dim in bucket.items():
+                    window = args[position][index].narrow(dim, start, size)
+                    window_args[position] = window[(None,) * len(index)]
+                output = self._call(*window_args, **kwargs)[(0,) * len(index)]
+                pieces.append(output.narrow(self.output_bucket, end - start, start + size - end))
+                end = start + size
+            pass
+            rows.append(torch.cat(pieces, dim = self.output_bucket))
+        pass
+        return torch.stack(rows).reshape(*leading, *rows[0].shape)
+
+    def __call__(self, *args, **kwargs):
+        length = None
+        if self.bucket:
+            first, dim = next(iter(self.bucket.items()))
+            length = args[first].shape[dim]
+            if self.windowed and length > self.manager.min_bucket:
+                self.calls += 1
+                return self._call_windows(args, kwargs, length)
+            target = self.manager.bucket_length(length) if length <= self.manager.min_bucket else length
+            if target != length:
+                args = list(args)
+                for position, dim in self.bucket.items():
+                    args[position] = _pad_dim(args[position], dim, target)
+            self.lengths.add(target)
+        pass
+        output = self._call(*args, **kwargs)
+        self.calls += 1
+        if length is not None and self.output_bucket is not None and output.shape[self.output_bucket] != length:
+            output = output.narrow(self.output_bucket, 0, length)
+        return output
+
+    def metrics(self):
+        return {
+            "calls"           : self.calls,
+            "compiles"        : self.compiles,
+            "recompiles"      : max(self.compiles - 1, 0),
+            "compile_seconds" : round(self.compile_seconds, 3),
+            "lengths"         : len(self.lengths),
+        }
+pass
+
+class UnslothCompileManager:
+    def __init__(
+        self,
+        cache_dir = None,
+        dynamic = None,
+        buckets_per_octave = None,
+        min_bucket = None,
+        persistent_cache = None,
+    ):
+        self.cache_dir = cache_dir or os.environ.get("UNSLOTH_COMPILE_CACHE_DIR") or _default_cache_dir()
+        self.dynamic = dynamic if dynamic is not None else os.environ.get("UNSLOTH_COMPILE_DYNAMIC", "1") == "1"
+        self.buckets_per_octave = buckets_per_octave if buckets_per_octave is not None else \
+            int(os.environ.get("UNSLOTH_COMPILE_BUCKETS", "4"))
+        self.min_bucket = min_bucket if min_bucket is not None else int(os.environ.get("UNSLOTH_COMPILE_MIN_BUCKET", "16"))
+        self.functions = {}
+        self.artifacts_loaded = False
+        self.persistent_cache = False
+        if persistent_cache if persistent_cache is not None else os.environ.get("UNSLOTH_COMPILE_PERSISTENT_CACHE", "0") == "1":
+            self.enable_persistent_cache()
+    pass
+
+    def enable_persistent_cache(self, cache_dir = None):
+        # Inductor's FX graph and AOTAutograd caches default to /tmp, which does
+        # not survive a new container / Colab session. Inductor and triton read
+        # their cache directories from the environment, so these two variables are
+        # process-wide; the cache flags themselves are only set around the
+        # manager's own calls (config_context).
+        if self.persistent_cache: return self.artifacts_loaded
+        self.cache_dir = cache_dir or self.cache_dir
+        try:
+            # Inductor writes its /tmp default back to the environment on first use
+            from torch._inductor.runtime.cache_dir_utils import default_cache_dir
+            if os.environ.get("TORCHINDUCTOR_CACHE_DIR") == os.path.abspath(default_cache_dir()):
+                del os.environ["TORCHINDUCTOR_CACHE_DIR"]
+        except ImportError:
+            pass
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(self.cache_dir, "inductor"))
+        os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(self.cache_dir, "triton"))
+        self.persistent_cache = True
+        atexit.register(self.save_artifacts)
+        return self.load_artifacts()
+
+    def config_context(self):
+        # Config for the manager's own compilations, restored after each call
+        # instead of changing torch._inductor / torch._dynamo globally
+        import torch._inductor.config as inductor_config
+        import torch._dynamo.config as dynamo_config
+        inductor_patch, dynamo_patch = {}, {}
+        if self.persistent_cache:
+            inductor_patch["fx_graph_cache"] = True
+            if hasattr(inductor_config, "autograd_cache"):
+                inductor_patch["autograd_cache"] = True
+        if not self.dynamic:
+            # One static graph per bucket, well under the default limit of 8 otherwise
+            for name in ("recompile_limit", "cache_size_limit"):
+                if hasattr(dynamo_config, name):
+                    dynamo_patch[name] = max(getattr(dynamo_config, name), 64)
+        pass
+        stack = contextlib.ExitStack()
+        if inductor_patch: stack.enter_context(inductor_config.patch(inductor_patch))
+        if dynamo_patch:   stack.enter_context(dynamo_config.patch(dynamo_patch))
+        return stack
+
+    @property
+    def artifacts_path(self):
+        return os.path.join(self.cache_dir, ARTIFACTS_FILE)
+
+    def load_artifacts(self):
+        # Portable single-file cache (torch >= 2.7): copying it to a new machine
+        # is enough to skip compilation there
+        if not hasattr(torch.compiler, "load_cache_artifacts") or not os.path.exists(self.artifacts_path):
+            return False
+        try:
+            with open(self.artifacts_path, "rb") as f:
+                torch.compiler.load_cache_artifacts(f.read())
+            self.artifacts_loaded = True
+        except Exception as e:
+            print(f"Unsloth: Could not load compile artifacts from {self.artifacts_path}: {e}")
+        return self.artifacts_loaded
+
+    def save_artifacts(self):
+        if not self.persistent_cache or not hasattr(torch.compiler, "save_cache_artifacts"):
+            return False
+        if not any(function.compiles for function in self.functions.values()):
+            return False
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is None:
+            return False
+        os.makedirs(self.cache_dir, exist_ok = True)
+        tmp_path = f"{self.artifacts_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            f.write(artifacts[0])
+        os.replace(tmp_path, self.artifacts_path)
+        return True
+
+    def bucket_length(self, length):
+        # min_bucket below it; in static mode the next multiple of
+        # 2**floor(log2(length)) / buckets_per_octave, i.e. at most
+        # 1 / buckets_per_octave padding
+        if length <= self.min_bucket:
+            return self.min_bucket
+        if self.dynamic or self.buckets_per_octave <= 0:
+            return length
+        step = max((1 << (length.bit_length() - 1)) // self.buckets_per_octave, 1)
+        return -(-length // step) * step
+
+    def bucket_windows(self, length):
+        # (start, size) windows of bucket sizes covering range(length) without
+        # padding: the largest bucket that fits, then a window ending at `length`
+        # for the rest, which recomputes at most 1 / buckets_per_octave of it.
+        if self.dynamic or self.buckets_per_octave <= 0 or length <= self.min_bucket:
+            return [(0, self.bucket_length(length))]
+        step = max((1 << (length.bit_length() - 1)) // self.buckets_per_octave, 1)
+        head = max(length // step * step, self.min_bucket)
+        windows = [(0, head)]
+        if head < length:
+            size = self.bucket_length(length - head)
+            windows.append((length - size, size))
+        return windows
+
+    def bucket_lengths(self, max_length):
+        # A symbolic kernel covers every length from its first call
+        lengths = [self.bucket_length(0)]
+        while not self.dynamic and lengths[-1] < max_length:
+            lengths.append(self.bucket_length(lengths[-1] + 1))
+        return lengths
+
+    def compile(self, fn = None, bucket = None, output_bucket = None, **compile_kwargs):
+        # Decorator, with or without arguments, replacing @torch.compile(dynamic = ...)
+        if fn is None:
+            return functools.partial(self.compile, bucket = bucket, output_bucket = output_bucket, **compile_kwargs)
+        compiled = CompiledFunction(self, fn, bucket = bucket, output_bucket = output_bucket, **compile_kwargs)
+        self.functions[f"{fn.__module__}.{fn.__qualname__}"] = compiled
+        return compiled
+
+    def warmup(self, compiled, make_args, max_length):
+        # Compile every bucket up to max_length (forward and backward) before
+        # training instead of on the first batches; with a warm cache this only
+        # loads the kernels. make_args(length) returns the positional arguments.
+        for length in self.bucket_lengths(max_length):
+            output = compiled(*make_args(length))
+            output = output[0] if isinstance(output, (tuple, list)) else output
+            if output.requires_grad:
+                output.float().sum().backward()
+        pass
+        return compiled.metrics()
+
+    def metrics(self):
+        from torch._dynamo.utils import counters
+        return {
+            "functions"            : {name: function.metrics() for name, function in self.functions.items()},
+            "compile_seconds"      : round(sum(f.compile_seconds for f in self.functions.values()), 3),
+            "recompiles"           : sum(max(f.compiles - 1, 0) for f in self.functions.values()),
+            "fx_graph_cache_hits"  : counters["inductor"]["fxgraph_cache_hit"],
+            "fx_graph_cache_miss"  : counters["inductor"]["fxgraph_cache_miss"],
+            "artifacts_loaded"     : self.artifacts_loaded,
+            "persistent_cache"     : self.persistent_cache,
+        }
+pass
+
+compile_manager = UnslothCompileManager()
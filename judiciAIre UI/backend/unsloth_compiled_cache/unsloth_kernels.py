@@ -0,0 +1,353 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import torch
+import torch.utils.checkpoint
+from torch.nn import functional as F
+try:
+    from .unsloth_compile_manager import compile_manager
+except ImportError:
+    from unsloth_compile_manager import compile_manager
+
+# Single copy of the kernels and helpers shared by the Unsloth*Trainer modules,
+# which import them from here: one compiled selective_log_softmax per process
+# whatever the number of trainers loaded.
+
+torch_compile_options = {
+    "epilogue_fusion"   : True,
+    "max_autotune"      : False,
+    "shape_padding"     : True,
+    "trace.enabled"     : False,
+    "triton.cudagraphs" : False,
+}
+
+@compile_manager.compile(fullgraph = True, options = torch_compile_options, bucket = {0: -2, 1: -1}, output_bucket = -1)
+def selective_log_softmax(logits, index):
+    logits = logits.to(torch.float32)
+    selected_logits = torch.gather(logits, dim = -1, index = index.unsqueeze(-1)).squeeze(-1)
+    # loop to reduce peak mem consumption
+    # logsumexp_values = torch.stack([torch.logsumexp(lg, dim=-1) for lg in logits])
+    logsumexp_values = torch.logsumexp(logits, dim = -1)
+    per_token_logps = selected_logits - logsumexp_values  # log_softmax(x_i) = x_i - logsumexp(x)
+    return per_token_logps
+
+LOGPS_CHUNK_BYTES = 256 * 1024 * 1024 # float32 logits budget of one chunk when unsloth_num_chunks = -1
+
+def _chunk_logps(hidden_states, lm_head, targets):
+    return selective_log_softmax(torch.matmul(hidden_states, lm_head.t()), targets)
+
+def chunked_token_logps(hidden_states, lm_head, targets, n_chunks = -1):
+    # Log probs of `targets` (n,) under the logits hidden_states (n, hidden) @ lm_head.T,
+    # chunk by chunk. Each chunk is recomputed in backward, so at most (chunk_size, vocab)
+    # logits exist at a time instead of (batch, seq, vocab).
+    n_tokens = targets.shape[0]
+    if n_chunks is None or n_chunks <= 0:
+        chunk_size = max(1, LOGPS_CHUNK_BYTES // (4 * lm_head.shape[0]))
+    else:
+        chunk_size = max(1, -(-n_tokens // n_chunks))
+    need_grad = torch.is_grad_enabled() and (hidden_states.requires_grad or lm_head.requires_grad)
+    logps = []
+    for hidden_j, targets_j in zip(hidden_states.split(chunk_size), targets.split(chunk_size)):
+        if need_grad:
+            logps.append(torch.utils.checkpoint.checkpoint(_chunk_logps, hidden_j, lm_head, targets_j, use_reentrant = False))
+        else:
+            logps.append(_chunk_logps(hidden_j, lm_head, targets_j))
+    pass
+    return torch.cat(logps) if logps else hidden_states.new_zeros(0, dtype = torch.float32)
+
+def fused_logps_and_nll(
+    hidden_states, lm_head, labels, nll_labels, average_log_prob = False, label_pad_token_id = -100, n_chunks = -1,
+):
+    # Decoder-only equivalent of get_batch_logps(logits, labels) and of the mean cross
+    # entropy over `nll_labels` (ignore index -100), from the final hidden states
+    # (batch, seq, hidden) in a single chunked pass: positions used by either share one
+    # LM head product, and positions used by neither never reach the LM head.
+    hidden_states = hidden_states[:, :-1]
+    labels = labels[:, 1:]
+    nll_labels = nll_labels[:, 1:]
+    loss_mask = labels != label_pad_token_id
+    nll_mask = nll_labels != -100
+    targets = torch.where(loss_mask, labels, torch.where(nll_mask, nll_labels, 0))
+    rows = loss_mask | nll_mask
+
+    per_token_logps = torch.zeros(rows.shape, dtype = torch.float32, device = hidden_states.device)
+    per_token_logps[rows] = chunked_token_logps(hidden_states[rows], lm_head, targets[rows], n_chunks = n_chunks)
+
+    all_logps = (per_token_logps * loss_mask).sum(-1)
+    if average_log_prob:
+        all_logps = all_logps / loss_mask.sum(-1)
+    nll_loss = -(per_token_logps * nll_mask).sum() / nll_mask.sum()
+    return all_logps, nll_loss
+
+@contextmanager
+def final_hidden_states(model):
+    # Records the decoder's last_hidden_state (final norm applied: what the LM head
+    # projects) during a causal LM forward run inside the block, so callers can use
+    # logits_to_keep = 1 and project the hidden states themselves. Unlike
+    # output_hidden_states = True, only the final layer's output is kept alive, and
+    # unlike UNSLOTH_RETURN_HIDDEN_STATES nothing process-wide changes: only forwards
+    # from the calling thread are recorded.
+    captured = []
+    thread = threading.get_ident()
+    def hook(module, args, output):
+        if threading.get_ident() == thread: captured.append(output[0])
+    handle = model.get_decoder().register_forward_hook(hook)
+    try:
+        yield captured
+    finally:
+        handle.remove()
+    pass
+
+@torch.no_grad()
+def mean_logits(hidden_states, lm_head):
+    # logits.mean(-1) == hidden_states @ lm_head.mean(0): the per-sequence mean of the
+    # logits for the logged metrics, without any (seq, vocab) tensor
+    lm_head_mean = lm_head.to(torch.float32).mean(0)
+    return torch.matmul(hidden_states.to(torch.float32), lm_head_mean).mean(-1)
+
+class UnslothRewardService:
+    # Scores completion pairs for the online preference trainers (OnlineDPO, NashMD, XPO):
+    # both completion sets go through the reward model in one forward, the judge's chat
+    # template is compiled once per process, and judge verdicts are kept in an LRU cache
+    # keyed on (prompt, completion pair) hashes, so repeated completions skip the judge.
+    _template = None
+
+    def __init__(self, trainer, cache_size = 4096):
+        self.trainer = trainer
+        self.cache_size = cache_size
+        self.verdicts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    pass
+
+    @classmethod
+    def template(cls):
+        if cls._template is None:
+            import jinja2
+            from trl.trainer.utils import SIMPLE_CHAT_TEMPLATE
+            cls._template = jinja2.Environment().from_string(SIMPLE_CHAT_TEMPLATE)
+        return cls._template
+
+    def scores(self, first_ids, second_ids, context_length):
+        # Reward model scores of two (batch, seq) sets sharing the same prompts, from one
+        # forward over both, right padded to a common width. The EOS penalty is checked
+        # before padding, since the pad token may be the EOS token.
+        from trl.trainer.utils import get_reward
+        trainer = self.trainer
+        pad_token_id = trainer.processing_class.pad_token_id
+        width = max(first_ids.shape[1], second_ids.shape[1])
+        input_ids = torch.cat([
+            F.pad(first_ids, (0, width - first_ids.shape[1]), value = pad_token_id),
+            F.pad(second_ids, (0, width - second_ids.shape[1]), value = pad_token_id),
+        ])
+        with torch.no_grad():
+            _, scores, _ = get_reward(trainer.reward_model, input_ids, pad_token_id, context_length)
+
+        if trainer.args.missing_eos_penalty is not None:
+            eos_token_id = trainer.processing_class.eos_token_id
+            contain_eos = torch.cat([
+                torch.any(first_ids == eos_token_id, dim = -1), torch.any(second_ids == eos_token_id, dim = -1),
+            ])
+            scores[~contain_eos] -= trainer.args.missing_eos_penalty
+        return scores.split(first_ids.shape[0])
+
+    def judge(self, prompts, first_ids, second_ids, context_length, return_scores = False):
+        # Decode both completion sets in one call, format conversational data with the
+        # shared template, then judge the (first, second) pairs through the cache.
+        from trl.data_utils import is_conversational
+        n = first_ids.shape[0]
+        completions = self.trainer.processing_class.batch_decode(
+            first_ids[:, context_length:].tolist() + second_ids[:, context_length:].tolist(), skip_special_tokens = True,
+        )
+        completions = [completion.strip() for completion in completions]
+        if is_conversational({"prompt": prompts[0]}):
+            template = self.template()
+            prompts = [template.render(messages = prompt) for prompt in prompts]
+            completions = [template.render(messages = [{"role": "assistant", "content": c}]) for c in completions]
+        return self.judge_texts(prompts, list(zip(completions[:n], completions[n:])), return_scores = return_scores)
+
+    @staticmethod
+    def _key(prompt, pair, return_scores):
+        text = "\x1f".join((prompt, pair[0], pair[1], str(return_scores)))
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def judge_texts(self, prompts, pairs, return_scores = False):
+        # Verdicts of `self.trainer.judge` for formatted (prompt, pair) strings; only the
+        # pairs missing from the cache are sent, in a single judge call.
+        keys = [self._key(prompt, pair, return_scores) for prompt, pair in zip(prompts, pairs)]
+        first_index = {}
+        for i, key in enumerate(keys):
+            if key not in self.verdicts: first_index.setdefault(key, i)
+        missing = list(first_index.values())
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        verdicts = {}
+        if missing:
+            if return_scores:
+                results = self.trainer.judge.judge([prompts[i] for i in missing], [pairs[i] for i in missing], return_scores = True)
+            else:
+                results = self.trainer.judge.judge([prompts[i] for i in missing], [pairs[i] for i in missing])
+            verdicts = {keys[i]: result for i, result in zip(missing, results)}
+
+        output = []
+        for key in keys:
+            if key in verdicts:
+                output.append(verdicts[key])
+            else:
+                output.append(self.verdicts[key])
+                self.verdicts.move_to_end(key)
+        pass
+        if self.cache_size:
+            self.verdicts.update(verdicts)
+            while len(self.verdicts) > self.cache_size:
+                self.verdicts.popitem(last = False)
+        return output
+pass
+
+class UnslothRolloutEngine:
+    # Sampling loop shared by the PPO, RLOO and OnlineDPO rollouts. Each prompt is
+    # prefilled once and its KV cache forked for its `num_samples` completions (the
+    # trainers used to repeat the prompts before `generate`), and the log prob of each
+    # sampled token under the temperature-scaled distribution is recorded while
+    # sampling, so no (batch, response, vocab) scores are kept and no scoring forward
+    # is needed afterwards. Generation settings the loop does not implement fall back
+    # to `generate`.
+    DEFAULTS = {
+        "num_beams" : 1, "num_return_sequences" : 1, "repetition_penalty" : 1.0, "no_repeat_ngram_size" : 0,
+        "min_length" : 0, "min_new_tokens" : None, "min_p" : None, "typical_p" : 1.0, "epsilon_cutoff" : 0.0,
+        "eta_cutoff" : 0.0, "bad_words_ids" : None, "suppress_tokens" : None, "begin_suppress_tokens" : None,
+        "sequence_bias" : None, "forced_bos_token_id" : None, "forced_eos_token_id" : None, "guidance_scale" : None,
+    }
+
+    def __init__(self, generation_config, pad_token_id, eos_token_id = None):
+        self.generation_config = generation_config
+        self.pad_token_id = pad_token_id
+        self.eos_token_id = eos_token_id
+    pass
+
+    def supports(self, model):
+        config = self.generation_config
+        if getattr(model.config, "is_encoder_decoder", False) or config.max_new_tokens is None: return False
+        if config.use_cache is False: return False
+        if model.training and getattr(model, "is_gradient_checkpointing", False): return False
+        return all(getattr(config, name, default) == default for name, default in self.DEFAULTS.items())
+
+    def _eos_token_ids(self, model, device):
+        eos_token_id = self.generation_config.eos_token_id
+        if eos_token_id is None: eos_token_id = getattr(getattr(model, "generation_config", None), "eos_token_id", None)
+        if eos_token_id is None: eos_token_id = self.eos_token_id
+        if eos_token_id is None: eos_token_id = []
+        if isinstance(eos_token_id, int): eos_token_id = [eos_token_id]
+        return torch.tensor(eos_token_id, dtype = torch.long, device = device)
+
+    def _sample(self, scores):
+        # `scores` are already divided by the temperature
+        config = self.generation_config
+        if not config.do_sample:
+            return scores.argmax(-1)
+        if config.top_k and config.top_k < scores.shape[-1]:
+            kth_score = torch.topk(scores, int(config.top_k), dim = -1).values[:, -1:]
+            scores = scores.masked_fill(scores < kth_score, float("-inf"))
+        if config.top_p is not None and config.top_p < 1.0:
+            sorted_scores, sorted_indices = torch.sort(scores, descending = False)
+            remove = sorted_scores.softmax(-1).cumsum(-1) <= (1 - config.top_p)
+            remove[:, -1] = False
+            scores = scores.masked_fill(remove.scatter(1, sorted_indices, remove), float("-inf"))
+        return torch.multinomial(scores.softmax(-1), 1).squeeze(-1)
+
+    @staticmethod
+    def _fork_cache(cache, index):
+        if hasattr(cache, "reorder_cache"):
+            cache.reorder_cache(index)
+            return cache
+        return tuple(tuple(tensor.index_select(0, index) for tensor in layer) for layer in cache)
+
+    @torch.no_grad()
+    def generate(self, model, input_ids, attention_mask, num_samples = 1, return_logprobs = True):
+        # (completion_ids, logprobs) of shape (num_samples * batch, response), sample-major
+        # like `input_ids.repeat(num_samples, 1)`. Rows are right padded after their EOS.
+        # logprobs is None without `return_logprobs`.
+        batch_size = input_ids.shape[0]
+        index = torch.arange(batch_size, device = input_ids.device).repeat(num_samples)
+        if not self.supports(model):
+            return self._generate_fallback(model, input_ids[index], attention_mask[index], return_logprobs)
+
+        config = self.generation_config
+        temperature = (config.temperature or 1.0) if config.do_sample else 1.0
+        eos_token_ids = self._eos_token_ids(model, input_ids.device)
+        position_ids = (attention_mask.long().cumsum(-1) - 1).masked_fill(attention_mask == 0, 1)
+        outputs = model(
+            input_ids = input_ids, attention_mask = attention_mask, position_ids = position_ids,
+            use_cache = True, logits_to_keep = 1,
+        )
+        if outputs.past_key_values is None:
+            return self._generate_fallback(model, input_ids[index], attention_mask[index], return_logprobs)
+
+        # Fork: every sample continues from the same prefill
+        cache = self._fork_cache(outputs.past_key_values, index)
+        logits = outputs.logits[:, -1].index_select(0, index)
+        attention_mask = attention_mask.index_select(0, index)
+        position = position_ids[:, -1].index_select(0, index)
+        finished = torch.zeros(index.shape[0], dtype = torch.bool, device = input_ids.device)
+        tokens, logprobs = [], []
+        for step in range(config.max_new_tokens):
+            scores = logits.to(torch.float32) / temperature
+            next_tokens = self._sample(scores)
+            if return_logprobs:
+                logprob = scores.log_softmax(-1).gather(-1, next_tokens.unsqueeze(-1)).squeeze(-1)
+                logprobs.append(logprob.masked_fill(finished, 0.0))
+            next_tokens = next_tokens.masked_fill(finished, self.pad_token_id)
+            tokens.append(next_tokens)
+            finished = finished | torch.isin(next_tokens, eos_token_ids)
+            if finished.all() or step == config.max_new_tokens - 1: break
+
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim = 1)
+            position = position + 1
+            outputs = model(
+                input_ids = next_tokens.unsqueeze(-1), attention_mask = attention_mask, position_ids = position.unsqueeze(-1),
+                past_key_values = cache, use_cache = True,
+            )
+            cache = outputs.past_key_values
+            logits = outputs.logits[:, -1]
+        pass
+        return torch.stack(tokens, 1), torch.stack(logprobs, 1) if return_logprobs else None
+
+    def _generate_fallback(self, model, input_ids, attention_mask, return_logprobs):
+        output = model.generate(
+            input_ids = input_ids, attention_mask = attention_mask, generation_config = self.generation_config,
+            return_dict_in_generate = True, output_scores = return_logprobs,
+        )
+        completion_ids = output.sequences[:, input_ids.shape[1]:]
+        if not return_logprobs:
+            return completion_ids, None
+        return completion_ids, selective_log_softmax(torch.stack(output.scores, 1), completion_ids)
+
+    def batch_generate(self, model, queries, num_samples = 1, batch_size = None):
+        # Drop-in for trl's `batch_generation` on left padded `queries`, returning
+        # (query_responses, logprobs) instead of (query_responses, logits). At most
+        # `batch_size` sequences are generated at once; the output is sample-major, i.e.
+        # lines up with `queries.repeat(num_samples, 1)`.
+        n_queries = queries.shape[0]
+        attention_mask = queries != self.pad_token_id
+        queries_per_chunk = max(1, (batch_size or n_queries * num_samples) // num_samples)
+        completions, logprobs = [], []
+        for start in range(0, n_queries, queries_per_chunk):
+            completion_ids, logprob = self.generate(
+                model, queries[start : start + queries_per_chunk], attention_mask[start : start + queries_per_chunk], num_samples,
+            )
+            completions.append(completion_ids.view(num_samples, -1, completion_ids.shape[-1]))
+            logprobs.append(logprob.view(num_samples, -1, logprob.shape[-1]))
+        pass
+        width = max(completion_ids.shape[-1] for completion_ids in completions)
+        completions = torch.cat([F.pad(c, (0, width - c.shape[-1]), value = self.pad_token_id) for c in completions], dim = 1)
+        logprobs = torch.cat([F.pad(l, (0, width - l.shape[-1]), value = 0.0) for l in logprobs], dim = 1)
+        query_responses = torch.cat([queries.repeat(num_samples, 1), completions.flatten(0, 1)], dim = 1)
+        return query_responses, logprobs.flatten(0, 1)
+
+def vLLMSamplingParams(**kwargs):
+    from vllm import SamplingParams
+    sampling_params = SamplingParams(**kwargs)
+    sampling_params._set_kwargs = kwargs
+    return sampling_params